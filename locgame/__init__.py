@@ -1 +1,12 @@
-from . import  models, environments, training
+import importlib
+
+# The submodules are imported on first access so that importing a
+# single submodule, like locgame.save_io, does not import the others
+SUBMODULES = {"models", "environments", "training", "experience",
+              "simulator", "timing", "env_pool", "save_io",
+              "traces"}
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module("."+name, __name__)
+    raise AttributeError("module 'locgame' has no attribute "+name)
@@ -0,0 +1,510 @@
+"""
+Description:
+    - A machine-wide registry of Unity worker ids
+    - A service that keeps Unity environments warm across experiments
+      and leases them out to runners
+    - A client side lease that follows the gym interface of the
+      wrapped Unity environments
+
+Unity environments can take tens of seconds to boot. The EnvPool owns
+its Unity processes for as long as it is running and proxies the reset
+and step calls of each lease to a warm instance. A lease's float_params
+and engine settings are applied through the side channels and take
+effect at the lease's first reset.
+
+    $ python3 training_scripts/run_env_pool.py localhost:6100 <env_name> 8
+
+Then set "env_pool": "localhost:6100" in the hyperparameters.
+
+Messages on the pool's connections are pickled, so connections are
+authenticated with a secret key. The key is read from the
+LOCGAME_POOL_KEY environment variable. Otherwise a random key is
+generated by the pool and saved to ~/.locgame/pool_key, readable only
+by its owner, where the clients of the same user find it. Clients on
+other machines must set LOCGAME_POOL_KEY to the contents of that file.
+TCP addresses without a host listen on the loopback interface only.
+"""
+
+import os
+import time
+import fcntl
+import threading
+import numpy as np
+from multiprocessing.connection import Listener, Client
+
+KEY_PATH = "~/.locgame/pool_key"
+REGISTRY_PATH = "~/.locgame/worker_ids"
+LOOPBACK = "127.0.0.1"
+
+def get_authkey(create=False, path=KEY_PATH):
+    """
+    Returns the authkey of the env pool connections. The key is read
+    from the LOCGAME_POOL_KEY environment variable if it is set and
+    from the key file otherwise.
+
+    create: bool
+        if true and no key exists, a random key is generated and saved
+        to the key file with owner only permissions
+    path: str
+        the key file
+    """
+    key = os.environ.get("LOCGAME_POOL_KEY", None)
+    if key is not None: return key.encode()
+    path = os.path.expanduser(path)
+    if create and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # O_EXCL so that concurrent pools agree on a single key
+            fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(os.urandom(32).hex())
+        except FileExistsError:
+            pass
+    s = "no env pool key, set LOCGAME_POOL_KEY or start the pool first"
+    assert os.path.exists(path), s
+    with open(path, 'r') as f:
+        return f.read().strip().encode()
+
+def parse_address(address):
+    """
+    Converts an address string to a multiprocessing.connection address.
+    Strings of the form "host:port" are tcp addresses and all others
+    are unix socket paths. A missing host, as in ":6100", is the
+    loopback interface.
+
+    address: str
+    """
+    if ":" in address:
+        host,port = address.rsplit(":",1)
+        if host == "": host = LOOPBACK
+        return (host, int(port))
+    return os.path.expanduser(address)
+
+class WorkerIdRegistry:
+    """
+    Hands out Unity worker ids without collisions between the processes
+    of a machine. Each claimed id holds an exclusive lock on a file in
+    the registry folder. The locks are released by the operating system
+    when the owning process exits, so the ids of crashed processes are
+    reclaimed automatically.
+    """
+    def __init__(self, path=REGISTRY_PATH, max_id=500):
+        """
+        path: str
+            the registry folder. shared by all processes of the machine
+        max_id: int
+            ids are claimed from 1 to max_id
+        """
+        self.path = os.path.expanduser(path)
+        self.max_id = max_id
+        os.makedirs(self.path, exist_ok=True)
+        self.files = dict()
+
+    def claim(self, start=1):
+        """
+        Claims the first free id at or after start, wrapping around at
+        max_id.
+
+        start: int
+            the preferred id
+
+        Returns:
+            worker_id: int
+        """
+        start = (int(start)-1)%self.max_id
+        for i in range(self.max_id):
+            worker_id = (start+i)%self.max_id+1
+            if worker_id in self.files: continue
+            path = os.path.join(self.path, str(worker_id)+".lock")
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            f.truncate(0)
+            f.write(str(os.getpid()))
+            f.flush()
+            self.files[worker_id] = f
+            return worker_id
+        raise RuntimeError("no free unity worker ids in "+self.path)
+
+    def release(self, worker_id):
+        """
+        worker_id: int
+            a previously claimed id
+        """
+        f = self.files.pop(worker_id, None)
+        if f is None: return
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+_REGISTRY = None
+def get_registry():
+    """
+    Returns the registry of this process
+    """
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = WorkerIdRegistry()
+    return _REGISTRY
+
+class EnvPool:
+    """
+    Owns a set of Unity environments and serves leases on them. Each
+    client connection holds a single lease. An idle instance of the
+    requested build is reused when one exists. Otherwise a new instance
+    is launched. Leases are returned to the pool when their connection
+    closes, including when the client process dies.
+
+    Messages are (cmd, args) tuples and replies are (status, result)
+    tuples where status is "ok" or "error".
+        ("lease", (env_name, float_params, seed, engine_config))
+            -> instance id
+        ("reset", ()) -> obs
+        ("step", (action,)) -> (obs, rew, done, info)
+        ("params", (float_params,)) -> None
+        ("release", ()) -> None
+    """
+    def __init__(self, address, max_instances=None, time_scale=None,
+                                    authkey=None,
+                                    verbose=True,
+                                    engine_profile="default"):
+        """
+        address: str
+            "host:port" or a unix socket path to listen on
+        max_instances: int or None
+            the maximum number of unity instances. leases wait for an
+            idle instance once the maximum is reached. if None, no
+            maximum is imposed
+        time_scale: float or None
+            if argued, overrides the time scale of the engine_profile
+        authkey: bytes or None
+            defaults to get_authkey, which generates a key if none
+            exists
+        verbose: bool
+        engine_profile: str
+            the engine settings of instances whose leases do not argue
+            their own. See locgame.environments.ENGINE_PROFILES
+        """
+        from locgame.environments import get_engine_config
+        self.address = address
+        self.max_instances = max_instances
+        self.engine_config = get_engine_config(engine_profile)
+        if time_scale is not None:
+            self.engine_config['time_scale'] = time_scale
+        if authkey is None: authkey = get_authkey(create=True)
+        self.authkey = authkey
+        self.verbose = verbose
+        self.instances = []
+        self.lock = threading.Condition()
+        self.registry = get_registry()
+
+    def launch(self, env_name, seed=0):
+        """
+        Launches a unity instance. The returned instance is marked as
+        leased and is not yet a part of the pool.
+
+        env_name: str
+            the path to the unity build
+        seed: int
+
+        Returns:
+            inst: dict
+        """
+        from mlagents_envs.environment import UnityEnvironment
+        from gym_unity.envs import UnityToGymWrapper
+        from mlagents_envs.side_channel.engine_configuration_channel import EngineConfigurationChannel
+        from mlagents_envs.side_channel.environment_parameters_channel import EnvironmentParametersChannel
+        path = os.path.expanduser(env_name)
+        channel = EngineConfigurationChannel()
+        env_channel = EnvironmentParametersChannel()
+        channel.set_configuration_parameters(**self.engine_config)
+        worker_id = self.registry.claim(int(seed)%500+1)
+        try:
+            env = UnityEnvironment(file_name=path,
+                                   side_channels=[channel,env_channel],
+                                   worker_id=worker_id,
+                                   seed=int(seed))
+        except:
+            self.registry.release(worker_id)
+            raise
+        env = UnityToGymWrapper(env, allow_multiple_obs=True)
+        inst = {
+            "env": env,
+            "channel": channel,
+            "env_channel": env_channel,
+            "env_name": env_name,
+            "worker_id": worker_id,
+            "leased": True,
+            "n_leases": 0,
+        }
+        if self.verbose:
+            print("Launched", env_name, "with worker id", worker_id)
+        return inst
+
+    def prelaunch(self, env_name, n_instances, seed=0):
+        """
+        Boots n_instances idle instances of the argued build.
+
+        env_name: str
+        n_instances: int
+        seed: int
+            the instances are seeded with consecutive seeds
+        """
+        for i in range(n_instances):
+            inst = self.launch(env_name, seed=seed+i)
+            inst['leased'] = False
+            with self.lock:
+                self.instances.append(inst)
+                self.lock.notify_all()
+
+    def lease(self, env_name, float_params=dict(), seed=0,
+                                                   engine_config=None):
+        """
+        Leases an instance of the argued build and configures its
+        float_params and engine settings.
+
+        env_name: str
+        float_params: dict
+        seed: int
+            only used if a new instance is launched
+        engine_config: dict or None
+            the engine settings of the lease. See
+            locgame.environments.get_engine_config. if None, the
+            pool's engine settings are used
+
+        Returns:
+            inst: dict
+        """
+        with self.lock:
+            while True:
+                for inst in self.instances:
+                    if not inst['leased'] and\
+                            inst['env_name'] == env_name:
+                        inst['leased'] = True
+                        break
+                else:
+                    inst = None
+                if inst is not None: break
+                n = len(self.instances)
+                if self.max_instances is None or n<self.max_instances:
+                    # A placeholder keeps the instance count honest
+                    # while the new instance boots
+                    inst = {"env_name": None, "leased": True}
+                    self.instances.append(inst)
+                    break
+                self.lock.wait()
+        if inst['env_name'] is None:
+            try:
+                new_inst = self.launch(env_name, seed=seed)
+            except:
+                with self.lock:
+                    self.instances.remove(inst)
+                    self.lock.notify_all()
+                raise
+            with self.lock:
+                inst.update(new_inst)
+        self.set_float_params(inst, float_params)
+        # The lease's settings fall back to the pool's settings. Unity
+        # keeps the value of a setting that neither of them argues
+        if engine_config is None: engine_config = self.engine_config
+        engine_config = {**self.engine_config, **engine_config}
+        inst['channel'].set_configuration_parameters(**engine_config)
+        inst['n_leases'] += 1
+        return inst
+
+    def set_float_params(self, inst, float_params):
+        """
+        Sends the game settings to an instance. The settings take
+        effect at the instance's next reset.
+
+        inst: dict
+        float_params: dict or None
+        """
+        if float_params is None: float_params = dict()
+        for k,v in float_params.items():
+            inst['env_channel'].set_float_parameter(k, float(v))
+
+    def release(self, inst):
+        """
+        Returns a leased instance to the pool.
+
+        inst: dict
+        """
+        with self.lock:
+            inst['leased'] = False
+            self.lock.notify_all()
+
+    def remove(self, inst):
+        """
+        Closes an instance and removes it from the pool. Used when an
+        instance fails.
+
+        inst: dict
+        """
+        with self.lock:
+            if inst in self.instances:
+                self.instances.remove(inst)
+            self.lock.notify_all()
+        try: inst['env'].close()
+        except: pass
+        self.registry.release(inst['worker_id'])
+
+    def serve_client(self, conn):
+        """
+        Handles the requests of a single client connection until it
+        closes.
+
+        conn: multiprocessing Connection
+        """
+        inst = None
+        try:
+            while True:
+                cmd,args = conn.recv()
+                try:
+                    if cmd == "lease":
+                        assert inst is None, "connection already leased"
+                        inst = self.lease(*args)
+                        result = inst['worker_id']
+                    elif cmd == "reset":
+                        result = inst['env'].reset()
+                    elif cmd == "step":
+                        result = inst['env'].step(*args)
+                    elif cmd == "params":
+                        self.set_float_params(inst, *args)
+                        result = None
+                    elif cmd == "release":
+                        if inst is not None: self.release(inst)
+                        inst = None
+                        result = None
+                    else:
+                        raise ValueError("unknown command "+str(cmd))
+                except Exception as e:
+                    # A failed instance is not returned to the pool
+                    if inst is not None and cmd in {"reset","step"}:
+                        self.remove(inst)
+                        inst = None
+                    conn.send(("error", repr(e)))
+                    continue
+                conn.send(("ok", result))
+        except (EOFError, OSError):
+            pass
+        finally:
+            if inst is not None: self.release(inst)
+            conn.close()
+
+    def serve(self):
+        """
+        Accepts client connections until interrupted. Each connection is
+        handled in its own thread.
+        """
+        listener = Listener(parse_address(self.address),
+                            authkey=self.authkey)
+        if self.verbose:
+            print("Env pool listening on", self.address)
+        try:
+            while True:
+                conn = listener.accept()
+                thread = threading.Thread(target=self.serve_client,
+                                          args=(conn,), daemon=True)
+                thread.start()
+        finally:
+            listener.close()
+            self.close()
+
+    def close(self):
+        """
+        Closes all unity instances
+        """
+        with self.lock:
+            instances = [x for x in self.instances\
+                                if x['env_name'] is not None]
+            self.instances = []
+        for inst in instances:
+            try: inst['env'].close()
+            except: pass
+            self.registry.release(inst['worker_id'])
+
+class PooledEnv:
+    """
+    A lease on a warm unity environment held by an EnvPool. Follows the
+    interface of the gym wrapped unity environments so that it can
+    replace them in UnityGymEnv. Closing the env returns the lease.
+    """
+    def __init__(self, address, env_name, float_params=dict(), seed=0,
+                                               authkey=None,
+                                               timeout=None,
+                                               engine_config=None):
+        """
+        address: str
+            the address of the EnvPool. "host:port" or a unix socket
+            path
+        env_name: str
+            the path to the unity build
+        float_params: dict
+            the settings applied to the leased instance
+        seed: int
+            used if the pool launches a new instance for the lease
+        authkey: bytes or None
+            defaults to get_authkey()
+        timeout: float or None
+            the maximum seconds to wait for the pool to come up
+        engine_config: dict or None
+            the engine settings applied to the leased instance. if
+            None, the pool's settings are used
+        """
+        if authkey is None: authkey = get_authkey()
+        start = time.time()
+        while True:
+            try:
+                self.conn = Client(parse_address(address),
+                                   authkey=authkey)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                if timeout is None or time.time()-start > timeout:
+                    raise
+                time.sleep(1)
+        self.worker_id = self.request("lease", env_name, float_params,
+                                                         seed,
+                                                         engine_config)
+
+    def request(self, cmd, *args):
+        """
+        Sends a request to the pool and returns its result.
+
+        cmd: str
+        args: the arguments of the command
+        """
+        self.conn.send((cmd, args))
+        status,result = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError("env pool "+cmd+" failed: "+result)
+        return result
+
+    def reset(self):
+        return self.request("reset")
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings of the leased instance. The settings
+        take effect at the next reset.
+
+        float_params: dict
+        """
+        self.request("params", float_params)
+
+    def step(self, action):
+        """
+        action: ndarray
+        """
+        return self.request("step", np.asarray(action))
+
+    def close(self):
+        if self.conn is None: return
+        try:
+            self.request("release")
+        except (EOFError, OSError):
+            pass
+        self.conn.close()
+        self.conn = None
@@ -1,22 +1,139 @@
 import os
 import numpy as np
-from skimage.color import rgb2grey
 import time
 from ml_utils.utils import try_key
-from a2c.utils import next_state, sample_action, cuda_if
 import torch
-import gym
 import torch.nn.functional as F
 from collections import deque
-from mlagents_envs.environment import UnityEnvironment
-from gym_unity.envs import UnityToGymWrapper
-from mlagents_envs.side_channel.engine_configuration_channel import EngineConfigurationChannel
-from mlagents_envs.side_channel.environment_parameters_channel import EnvironmentParametersChannel
+from locgame.simulator import LocationSim
+# The backend packages (gym, mlagents_envs, gym_unity, skimage, a2c) are
+# imported where they are first used so that importing this module
+# stays cheap for processes that never make those environments
+from locgame.env_pool import PooledEnv, get_registry
+from locgame.traces import TraceRecorder, TraceReader, get_trace_path
+
+# Named Unity engine settings applied through the
+# EngineConfigurationChannel. Profiles other than default can change
+# what the model sees. Use training_scripts/engine_benchmark.py to
+# measure their speed and observation equivalence for a build.
+ENGINE_KEYS = {"width", "height", "quality_level", "time_scale",
+               "target_frame_rate", "capture_frame_rate"}
+ENGINE_PROFILES = {
+    # The settings used before engine profiles existed
+    "default": {"time_scale": 1},
+    # Runs the game logic faster than real time without touching the
+    # render settings
+    "fast": {"time_scale": 20, "target_frame_rate": -1},
+    # Also lowers the render quality and the window resolution. The
+    # agent's camera resolution is set by the build
+    "fastest": {"time_scale": 100, "target_frame_rate": -1,
+                "quality_level": 0, "width": 84, "height": 84},
+}
+
+def get_engine_config(engine_profile="default", engine_params=None):
+    """
+    Returns the engine settings of a named profile
+
+    engine_profile: str
+        a key of ENGINE_PROFILES
+    engine_params: dict or None
+        settings that override the profile's settings
+        keys: ENGINE_KEYS
+
+    Returns:
+        config: dict
+            keyword arguments for
+            EngineConfigurationChannel.set_configuration_parameters
+    """
+    if engine_profile is None: engine_profile = "default"
+    s = "unknown engine_profile "+str(engine_profile)
+    assert engine_profile in ENGINE_PROFILES, s
+    config = {**ENGINE_PROFILES[engine_profile]}
+    if engine_params is not None:
+        for k in engine_params.keys():
+            assert k in ENGINE_KEYS, "unknown engine param "+str(k)
+        config.update(engine_params)
+    return config
+
+def launch_unity(env_name, float_params=dict(), time_scale=None,
+                                              seed=time.time(),
+                                              worker_id=None,
+                                              engine_config=None):
+    """
+    Launches a unity process with the engine configuration and
+    environment parameters side channels. The worker id is claimed from
+    the machine's worker id registry and must be released by the
+    caller when the process is closed.
+
+    env_name: str
+        the path to the game
+    float_params: dict or None
+        the environment parameters
+    time_scale: float or None
+        if argued, overrides the time scale of the engine_config
+    seed: int
+    worker_id: int or None
+        the preferred worker id
+    engine_config: dict or None
+        the engine settings. See get_engine_config. defaults to the
+        default profile
+
+    Returns:
+        env: UnityEnvironment
+        channels: dict
+            keys: "engine", "env_params"
+        worker_id: int
+            the claimed worker id
+    """
+    from mlagents_envs.environment import UnityEnvironment
+    from mlagents_envs.side_channel.engine_configuration_channel import EngineConfigurationChannel
+    from mlagents_envs.side_channel.environment_parameters_channel import EnvironmentParametersChannel
+    seed = int(seed)
+    if float_params is None: float_params = dict()
+    path = os.path.expanduser(env_name)
+    channel = EngineConfigurationChannel()
+    env_channel = EnvironmentParametersChannel()
+    if engine_config is None: engine_config = get_engine_config()
+    engine_config = {**engine_config}
+    if time_scale is not None: engine_config['time_scale'] = time_scale
+    channel.set_configuration_parameters(**engine_config)
+    for k,v in float_params.items():
+        if k=="validation" and v>=1:
+            print("Game in validation mode")
+        env_channel.set_float_parameter(k, float(v))
+    if worker_id is None: worker_id = seed%500+1
+    registry = get_registry()
+    worker_id = registry.claim(worker_id)
+    env_made = False
+    n_loops = 0
+    while not env_made and n_loops < 50:
+        try:
+            env = UnityEnvironment(file_name=path,
+                               side_channels=[channel,env_channel],
+                               worker_id=int(worker_id),
+                               seed=int(seed))
+            env_made = True
+        except:
+            s = "Error encountered making environment, "
+            s += "trying new worker_id"
+            print(s)
+            registry.release(worker_id)
+            worker_id =int(worker_id+1+np.random.random()*100)%500
+            worker_id = registry.claim(worker_id)
+            try: env.close()
+            except: pass
+            n_loops += 1
+    if not env_made:
+        registry.release(worker_id)
+        assert False, "could not launch "+str(env_name)
+    channels = {"engine": channel, "env_params": env_channel}
+    return env, channels, worker_id
 
 class GymEnv:
     def __init__(self, env_name, prep_fxn, seed=int(time.time()),
                                            worker_id=None,
                                            float_params=dict(),
+                                           uint8_obs=False,
                                            **kwargs):
         """
         env_name: str
@@ -33,13 +150,25 @@ class GymEnv:
             this should be a dict of argument settings for the unity
             environment
             keys: varies by environment
+        uint8_obs: bool
+            if true, the observations are returned as uint8 tensors
+            and the prep_fxn is not applied. Use to_float_obs to apply
+            the prep_fxn normalization to the uint8 observations.
+            Requires a prep_fxn found in UINT8_PREPS
         """
         self.env_name = env_name
-        self.prep_fxn = globals()[prep_fxn]
+        self.prep_fxn = prep_fxn
+        self.uint8_obs = uint8_obs
+        self.prep = PrepEngine(prep_fxn, uint8_obs=uint8_obs)
         self.seed = seed
         self.worker_id = worker_id
         self.float_params = float_params
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+        # Optional TraceRecorder that records the raw rows
+        self.recorder = None
 
+        import gym
         self.env = gym.make(self.env_name)
         obs,action_targ = self.reset()
         self.shape = obs.shape
@@ -47,16 +176,70 @@ class GymEnv:
         # Discrete action spaces are not yet implemented
         self.is_discrete = True
 
+    def split_obs(self, obs):
+        """
+        Splits a raw observation into its frame and its target
+
+        obs: ndarray (H,W,C)
+            the observation returned by the environment
+
+        Returns:
+            frame: ndarray (H,W,C)
+            targ: ndarray (4,)
+        """
+        return obs, np.zeros(4, dtype=np.float32)
+
     def prep_obs(self, obs):
         """
         obs: list or ndarray
             the observation returned by the environment
         """
-        obs = self.prep_fxn(obs.transpose(2,0,1))
-        return [torch.from_numpy(obs),torch.zeros(4)]
+        frame,targ = self.split_obs(obs)
+        obs = self.prep(frame[None])[0]
+        return [torch.from_numpy(obs),torch.from_numpy(targ)]
 
-    def reset(self):
+    def reset_raw(self):
+        """
+        Resets the environment without prepping the observation
+        """
         obs = self.env.reset()
+        if self.recorder is not None:
+            frame,targ = self.split_obs(obs)
+            self.recorder.record(frame, targ, reset=True)
+        return obs
+
+    def step_raw(self, pred):
+        """
+        Steps the environment without prepping the observation
+
+        pred: torch tensor (..., N)
+            the outputs from the model
+
+        Returns:
+            obs: the raw observation returned by the environment
+            rew: float
+            done: bool
+            info: dict
+        """
+        action = self.get_action(pred)
+        obs,rew,done,info = self.env.step(action)
+        if self.recorder is not None:
+            frame,targ = self.split_obs(obs)
+            self.recorder.record(frame, targ, rew=rew, done=done,
+                                              action=action)
+        return obs,rew,done,info
+
+    def set_float_params(self, float_params):
+        """
+        Gym environments have no settings. The float_params are only
+        recorded.
+
+        float_params: dict
+        """
+        self.float_params = float_params
+
+    def reset(self):
+        obs = self.reset_raw()
         return self.prep_obs(obs)
 
     def step(self,pred):
@@ -65,9 +248,11 @@ class GymEnv:
             the action to take in this step. type can vary depending
             on the environment type
         """
-        action = self.get_action(pred)
-        obs,rew,done,info = self.env.step(action)
+        obs,rew,done,info = self.step_raw(pred)
+        if self.timer is not None: t = self.timer.start()
         obs,targ = self.prep_obs(obs)
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
         targ[:2] = np.clip(targ[:2],-1,1)
         return obs, targ, rew, done, info
 
@@ -81,6 +266,7 @@ class GymEnv:
             the outputs from the model
         """
         if self.is_discrete:
+            from a2c.utils import sample_action
             probs = F.softmax(preds, dim=-1)
             action = sample_action(probs.data)
             return int(action.item())
@@ -90,11 +276,16 @@ class GymEnv:
 
     def close(self):
         self.env.close()
+        if self.recorder is not None: self.recorder.close()
 
 class UnityGymEnv:
     def __init__(self, env_name, prep_fxn, seed=int(time.time()),
                                            worker_id=None,
                                            float_params=dict(),
+                                           uint8_obs=False,
+                                           env_pool=None,
+                                           engine_profile="default",
+                                           engine_params=None,
                                            **kwargs):
         """
         env_name: str
@@ -111,28 +302,64 @@ class UnityGymEnv:
             this should be a dict of argument settings for the unity
             environment
             keys: varies by environment
+        uint8_obs: bool
+            if true, the observations are returned as uint8 tensors
+            and the prep_fxn is not applied. Use to_float_obs to apply
+            the prep_fxn normalization to the uint8 observations.
+            Requires a prep_fxn found in UINT8_PREPS
+        env_pool: str or None
+            the address of an EnvPool service. if argued, a warm unity
+            instance is leased from the pool instead of launching a
+            new one
+        engine_profile: str
+            the name of the unity engine settings. See ENGINE_PROFILES
+        engine_params: dict or None
+            engine settings that override those of the profile
         """
         self.env_name = env_name
-        self.prep_fxn = globals()[prep_fxn]
+        self.prep_fxn = prep_fxn
+        self.uint8_obs = uint8_obs
+        self.prep = PrepEngine(prep_fxn, uint8_obs=uint8_obs)
         self.seed = seed
         self.worker_id = worker_id
         self.float_params = float_params
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+        # Optional TraceRecorder that records the raw rows
+        self.recorder = None
 
-        self.env = self.make_unity_env(env_name,
-                                       seed=self.seed,
-                                       worker_id=self.worker_id,
-                                       float_params=float_params,
-                                       **kwargs)
+        # The worker id claimed from the machine's registry
+        self.claimed_id = None
+        # The side channels of a launched unity process
+        self.channels = None
+        self.engine_config = get_engine_config(engine_profile,
+                                               engine_params)
+        if env_pool is not None:
+            self.env = PooledEnv(env_pool, env_name,
+                                 float_params=float_params,
+                                 seed=self.seed,
+                                 engine_config=self.engine_config)
+        else:
+            self.env = self.make_unity_env(
+                env_name,
+                seed=self.seed,
+                worker_id=self.worker_id,
+                float_params=float_params,
+                engine_config=self.engine_config,
+                **kwargs
+            )
         obs,action_targ = self.reset()
         self.shape = obs.shape
         self.targ_shape = action_targ.shape
         # Discrete action spaces are not yet implemented
         self.is_discrete = False
 
-    def make_unity_env(self, env_name, float_params=dict(), time_scale=1,
-                                                      seed=time.time(),
-                                                      worker_id=None,
-                                                      **kwargs):
+    def make_unity_env(self, env_name, float_params=dict(),
+                                       time_scale=None,
+                                       seed=time.time(),
+                                       worker_id=None,
+                                       engine_config=None,
+                                       **kwargs):
         """
         creates a gym environment from a unity game
 
@@ -142,46 +369,44 @@ class UnityGymEnv:
             this should be a dict of argument settings for the unity
             environment
             keys: varies by environment
-        time_scale: float
+        time_scale: float or None
             argument to set Unity's time scale. This applies less to
             gym wrapped versions of Unity Environments, I believe..
-            but I'm not sure
+            but I'm not sure. if argued, overrides the time scale of
+            the engine_config
         seed: int
             the seed for randomness
         worker_id: int
-            must specify a unique worker id for each unity process
-            on this machine
+            the preferred worker id. the id that is used is claimed
+            from the machine's worker id registry so that it is unique
+            among the unity processes on this machine
+        engine_config: dict or None
+            the engine settings. See get_engine_config. defaults to
+            the default profile
         """
-        seed = int(seed)
-        if float_params is None: float_params = dict()
-        path = os.path.expanduser(env_name)
-        channel = EngineConfigurationChannel()
-        env_channel = EnvironmentParametersChannel()
-        channel.set_configuration_parameters(time_scale = 1)
-        for k,v in float_params.items():
-            if k=="validation" and v>=1:
-                print("Game in validation mode")
-            env_channel.set_float_parameter(k, float(v))
-        if worker_id is None: worker_id = seed%500+1
-        env_made = False
-        n_loops = 0
-        while not env_made and n_loops < 50:
-            try:
-                env = UnityEnvironment(file_name=path,
-                                   side_channels=[channel,env_channel],
-                                   worker_id=int(worker_id),
-                                   seed=int(seed))
-                env_made = True
-                env = UnityToGymWrapper(env, allow_multiple_obs=True)
-            except:
-                s = "Error encountered making environment, "
-                s += "trying new worker_id"
-                print(s)
-                worker_id =int(worker_id+1+np.random.random()*100)%500
-                try: env.close()
-                except: pass
-                n_loops += 1
-        return env
+        from gym_unity.envs import UnityToGymWrapper
+        env,channels,worker_id = launch_unity(env_name,
+                                              float_params=float_params,
+                                              time_scale=time_scale,
+                                              seed=seed,
+                                              worker_id=worker_id,
+                                              engine_config=engine_config)
+        self.claimed_id = worker_id
+        self.channels = channels
+        return UnityToGymWrapper(env, allow_multiple_obs=True)
+
+    def split_obs(self, obs):
+        """
+        Splits a raw observation into its frame and its target
+
+        obs: list [ndarray (H,W,C), ndarray (5,)]
+            the observation returned by the environment
+
+        Returns:
+            frame: ndarray (H,W,C)
+            targ: ndarray (5,)
+        """
+        return obs[0], obs[1]
 
     def prep_obs(self, obs):
         """
@@ -189,16 +414,65 @@ class UnityGymEnv:
             the observation returned by the environment
         """
         if not isinstance(obs, list):
-            obs = obs.transpose(2,0,1)
-            return torch.from_numpy(self.prep_fxn(obs))
-        prepped_obs = self.prep_fxn(obs[0].transpose(2,0,1))
+            return torch.from_numpy(self.prep(obs[None])[0])
+        prepped_obs = self.prep(obs[0][None])[0]
         # Handles the additional observations passed by the env
         prepped_obs = [prepped_obs, *obs[1:]]
         prepped_obs = [torch.from_numpy(x) for x in prepped_obs]
         return prepped_obs
 
-    def reset(self):
+    def reset_raw(self):
+        """
+        Resets the environment without prepping the observation
+        """
         obs = self.env.reset()
+        if self.recorder is not None:
+            frame,targ = self.split_obs(obs)
+            self.recorder.record(frame, targ, reset=True)
+        return obs
+
+    def step_raw(self, pred):
+        """
+        Steps the environment without prepping the observation
+
+        pred: torch tensor (..., N)
+            the outputs from the model
+
+        Returns:
+            obs: the raw observation returned by the environment
+            rew: float
+            done: bool
+            info: dict
+        """
+        action = self.get_action(pred)
+        obs,rew,done,info = self.env.step(action)
+        if self.recorder is not None:
+            frame,targ = self.split_obs(obs)
+            self.recorder.record(frame, targ, rew=rew, done=done,
+                                              action=action)
+        return obs,rew,done,info
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings of the running unity process through
+        the environment parameters channel. The settings take effect at
+        the next reset. Settings that are not argued keep their current
+        values.
+
+        float_params: dict
+            keys: varies by environment
+        """
+        if float_params is None: float_params = dict()
+        self.float_params = {**float_params}
+        if self.channels is None:
+            # Leased environments are configured by the pool
+            self.env.set_float_params(self.float_params)
+            return
+        for k,v in self.float_params.items():
+            self.channels['env_params'].set_float_parameter(k, float(v))
+
+    def reset(self):
+        obs = self.reset_raw()
         return self.prep_obs(obs)
 
     def step(self,pred):
@@ -207,9 +481,11 @@ class UnityGymEnv:
             the action to take in this step. type can vary depending
             on the environment type
         """
-        action = self.get_action(pred)
-        obs,rew,done,info = self.env.step(action)
+        obs,rew,done,info = self.step_raw(pred)
+        if self.timer is not None: t = self.timer.start()
         obs,targ = self.prep_obs(obs)
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
         targ[:2] = np.clip(targ[:2],-1,1)
         return obs, targ, rew, done, info
 
@@ -223,6 +499,7 @@ class UnityGymEnv:
             the outputs from the model
         """
         if self.is_discrete:
+            from a2c.utils import sample_action
             probs = F.softmax(preds, dim=-1)
             action = sample_action(probs.data)
             return int(action.item())
@@ -232,53 +509,1164 @@ class UnityGymEnv:
     
     def close(self):
         self.env.close()
+        if self.recorder is not None: self.recorder.close()
+        if self.claimed_id is not None:
+            get_registry().release(self.claimed_id)
+            self.claimed_id = None
+
+class VecEnv:
+    """
+    Owns K environments and steps them together so that a runner can
+    make a single batched model call per step. Environments that reach
+    a done are automatically reset. The terminal observation and target
+    of a done environment are returned in the environment's info dict
+    under the keys "terminal_obs" and "terminal_targ".
+
+    The raw frames of each step are gathered into a single buffer and
+    prepped in one batched pass of the first environment's PrepEngine.
+    The observations returned by step are views of one of two reused
+    output buffers and are only valid until the next-but-one call to
+    step. Copy them if they need to live longer.
+    """
+    def __init__(self, envs):
+        """
+        envs: list of UnityGymEnv or GymEnv
+            the environments to be vectorized. all must have the same
+            observation and target shapes and prep_fxn
+        """
+        self.envs = envs
+        self.n_envs = len(envs)
+        self.shape = envs[0].shape
+        self.targ_shape = envs[0].targ_shape
+        self.is_discrete = envs[0].is_discrete
+        self.prep = envs[0].prep
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+        self.frames = None
+        self.outs = [None, None]
+        self.out_idx = 0
+
+    def __len__(self):
+        return self.n_envs
+
+    def get_frames(self, frame):
+        """
+        Returns the reused raw frame buffer. The buffer is allocated
+        from the first frame it is used for.
+
+        frame: ndarray (H,W,C)
+
+        Returns:
+            frames: ndarray (K,H,W,C)
+        """
+        if self.frames is None:
+            shape = (self.n_envs, *frame.shape)
+            self.frames = np.empty(shape, dtype=frame.dtype)
+        return self.frames
+
+    def get_out(self):
+        """
+        Alternates between two reused output buffers
+
+        Returns:
+            out: ndarray (K,C,H,W)
+        """
+        self.out_idx = (self.out_idx+1)%2
+        if self.outs[self.out_idx] is None:
+            self.outs[self.out_idx] = self.prep.alloc(self.n_envs,
+                                               self.frames.shape[1:])
+        return self.outs[self.out_idx]
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings of each of the environments. The
+        settings take effect at each environment's next reset.
+
+        float_params: dict
+        """
+        for env in self.envs:
+            env.set_float_params(float_params)
+
+    def reset(self, idxs=None):
+        """
+        idxs: list of ints or None
+            the indices of the environments to reset. if None, all
+            environments are reset
+
+        Returns:
+            obsrs: torch float tensor (K,C,H,W)
+            targs: torch float tensor (K,5)
+        """
+        if idxs is None: idxs = range(self.n_envs)
+        targs = []
+        for j,i in enumerate(idxs):
+            frame,targ = self.envs[i].split_obs(self.envs[i].reset_raw())
+            self.get_frames(frame)[j] = frame
+            targs.append(targ)
+        # The reset observations are owned by the caller
+        obsrs = self.prep(self.frames[:len(targs)])
+        return torch.from_numpy(obsrs), torch.from_numpy(np.stack(targs))
+
+    def step(self, preds, idxs=None):
+        """
+        preds: torch tensor (K,N)
+            the outputs from the model. one row for each of the
+            environments in idxs
+        idxs: list of ints or None
+            the indices of the environments to step. if None, all
+            environments are stepped
+
+        Returns:
+            obsrs: torch float tensor (K,C,H,W)
+                the observations following the step. If an environment
+                is done, this is the first observation of its new
+                episode
+            targs: torch float tensor (K,5)
+            rews: torch float tensor (K,)
+            dones: torch long tensor (K,)
+            infos: list of dicts (K,)
+        """
+        if idxs is None: idxs = range(self.n_envs)
+        targs,rews,dones,infos = [],[],[],[]
+        for j,(pred,i) in enumerate(zip(preds, idxs)):
+            env = self.envs[i]
+            obs,rew,done,info = env.step_raw(pred)
+            frame,targ = env.split_obs(obs)
+            targ = np.array(targ)
+            targ[:2] = np.clip(targ[:2],-1,1)
+            info = dict() if not isinstance(info,dict) else {**info}
+            if done:
+                if self.timer is not None: t = self.timer.start()
+                info['terminal_obs'] = torch.from_numpy(
+                                             self.prep(frame[None])[0])
+                if self.timer is not None:
+                    self.timer.lap("prep_obs", t, sub_phase=True)
+                info['terminal_targ'] = torch.from_numpy(targ)
+                frame,targ = env.split_obs(env.reset_raw())
+            self.get_frames(frame)[j] = frame
+            targs.append(targ)
+            rews.append(rew)
+            dones.append(int(done))
+            infos.append(info)
+        if self.timer is not None: t = self.timer.start()
+        n = len(targs)
+        obsrs = self.prep(self.frames[:n], out=self.get_out()[:n])
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
+        rews = torch.FloatTensor(rews)
+        dones = torch.LongTensor(dones)
+        targs = torch.from_numpy(np.stack(targs))
+        return torch.from_numpy(obsrs),targs,rews,dones,infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+class UnityMultiEnv:
+    """
+    Drives the K arenas of a single multi-arena unity build through the
+    low level ML-Agents API so that the arenas share one unity process.
+    Follows the interface of VecEnv. Each arena is an agent of the
+    build's behavior. The number of arenas is passed to the build as
+    the "nArenas" environment parameter and the build must provide at
+    least n_envs agents. Agents beyond the first n_envs are sent zero
+    actions.
+
+    Unity resets each arena on its own when its episode ends. The
+    terminal observation and target of a done arena are returned in
+    the arena's info dict under the keys "terminal_obs" and
+    "terminal_targ", and the returned observation is the first
+    observation of the arena's new episode.
+
+    Every arena of the build is simulated on every step. Arenas that
+    are not in the argued idxs repeat their last action, and the end
+    of an episode in such an arena is reported at the arena's next
+    step. When an arena's new episode requests its first decision a
+    step late, unity is stepped again and every other arena advances
+    an extra step with its last action. The reward returned for an
+    arena is the sum of its rewards over all of the unity steps since
+    its last returned step, so no rewards are lost to held arenas or
+    extra steps. As with VecEnv, the observations returned by step are
+    only valid until the next-but-one call to step.
+    """
+    def __init__(self, n_envs, env_name, prep_fxn, seed=int(time.time()),
+                                    worker_id=None,
+                                    float_params=dict(),
+                                    uint8_obs=False,
+                                    engine_profile="default",
+                                    engine_params=None,
+                                    **kwargs):
+        """
+        n_envs: int
+            the number of arenas
+        env_name: str
+            the path to the multi-arena unity build
+        prep_fxn: str
+            the name of the preprocessing function to be used on each
+            of the observations
+        seed: int
+            the random seed for the environment
+        worker_id: int or None
+            the preferred unity worker id
+        float_params: dict or None
+            the environment parameters shared by all arenas
+        uint8_obs: bool
+            if true, the observations are returned as uint8 tensors
+            and the prep_fxn is not applied. Requires a prep_fxn found
+            in UINT8_PREPS
+        engine_profile: str
+            the name of the unity engine settings. See ENGINE_PROFILES
+        engine_params: dict or None
+            engine settings that override those of the profile
+        """
+        self.env_name = env_name
+        self.prep_fxn = prep_fxn
+        self.uint8_obs = uint8_obs
+        self.prep = PrepEngine(prep_fxn, uint8_obs=uint8_obs)
+        self.n_envs = n_envs
+        self.seed = seed
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+        self.outs = [None, None]
+        self.out_idx = 0
+
+        if float_params is None: float_params = dict()
+        float_params = {**float_params, "nArenas": n_envs}
+        self.float_params = float_params
+        engine_config = get_engine_config(engine_profile, engine_params)
+        self.env,self.channels,self.claimed_id = launch_unity(
+            env_name,
+            float_params=float_params,
+            seed=seed,
+            worker_id=worker_id,
+            engine_config=engine_config
+        )
+        try:
+            from mlagents_envs.base_env import ActionTuple
+            self.action_tuple = ActionTuple
+        except ImportError:
+            # Older versions of mlagents_envs take the raw arrays
+            self.action_tuple = None
+
+        self.env.reset()
+        self.behavior_name = list(self.env.behavior_specs.keys())[0]
+        spec = self.env.behavior_specs[self.behavior_name]
+        if hasattr(spec, "observation_specs"):
+            shapes = [x.shape for x in spec.observation_specs]
+        else:
+            shapes = spec.observation_shapes
+        # The image and the target vector of each agent
+        self.frame_idx = [len(x) for x in shapes].index(3)
+        self.targ_idx = [len(x) for x in shapes].index(1)
+        if hasattr(spec, "action_spec"):
+            self.action_size = spec.action_spec.continuous_size
+        else:
+            self.action_size = spec.action_size
+
+        dec,_ = self.env.get_steps(self.behavior_name)
+        s = "build has {} arenas but {} were requested"
+        assert len(dec) >= n_envs, s.format(len(dec), n_envs)
+        # The agent id of each arena
+        self.agent_ids = sorted(dec.agent_id)
+        self.slots = {aid:k for k,aid in enumerate(self.agent_ids)}
+        self.actions = np.zeros((len(self.agent_ids),self.action_size),
+                                dtype=np.float32)
+        # The rewards of each arena since its last returned step
+        self.rews = np.zeros(len(self.agent_ids), dtype=np.float32)
+        # True if unity has stepped since the rewards were last read.
+        # get_steps returns the same rewards until the next step
+        self.stepped = False
+        # The terminal steps of arenas that have not yet reported them
+        self.pending = dict()
+        self.dec = dec
+        obsrs,targs = self.reset()
+        self.shape = obsrs.shape[1:]
+        self.targ_shape = targs.shape[1:]
+        self.is_discrete = False
+
+    def __len__(self):
+        return self.n_envs
+
+    def get_out(self, frame_shape):
+        """
+        Alternates between two reused output buffers
+
+        frame_shape: tuple of ints (H,W,C)
+
+        Returns:
+            out: ndarray (K,C,H,W)
+        """
+        self.out_idx = (self.out_idx+1)%2
+        if self.outs[self.out_idx] is None:
+            self.outs[self.out_idx] = self.prep.alloc(self.n_envs,
+                                                      frame_shape)
+        return self.outs[self.out_idx]
+
+    def send_actions(self, dec):
+        """
+        Sets the actions of the agents that requested a decision
+
+        dec: DecisionSteps
+        """
+        rows = [self.slots.get(aid,-1) for aid in dec.agent_id]
+        actions = self.actions[rows]
+        # Agents that are not arenas are sent zero actions
+        actions[np.asarray(rows)<0] = 0
+        if self.action_tuple is not None:
+            actions = self.action_tuple(continuous=actions)
+        self.env.set_actions(self.behavior_name, actions)
+
+    def wait_decisions(self):
+        """
+        Steps unity until every arena has requested a decision. The
+        terminal steps that occur along the way are stored in pending
+        and the rewards of every unity step are summed into self.rews.
+
+        Returns:
+            dec: DecisionSteps
+        """
+        while True:
+            dec,term = self.env.get_steps(self.behavior_name)
+            for j,aid in enumerate(term.agent_id):
+                if aid not in self.slots: continue
+                self.pending[self.slots[aid]] = (
+                    term.obs[self.frame_idx][j],
+                    term.obs[self.targ_idx][j],
+                )
+            if self.stepped:
+                for steps in [term, dec]:
+                    for j,aid in enumerate(steps.agent_id):
+                        if aid not in self.slots: continue
+                        self.rews[self.slots[aid]] += steps.reward[j]
+                self.stepped = False
+            have = set(dec.agent_id)
+            if all(aid in have for aid in self.agent_ids): break
+            if len(dec) > 0: self.send_actions(dec)
+            self.env.step()
+            self.stepped = True
+        self.dec = dec
+        return dec
+
+    def get_rows(self, dec, idxs):
+        """
+        Returns the rows of the argued arenas in the decision steps
+
+        dec: DecisionSteps
+        idxs: list of ints
+        """
+        rows = {aid:j for j,aid in enumerate(dec.agent_id)}
+        return np.asarray([rows[self.agent_ids[k]] for k in idxs])
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings of all arenas through the environment
+        parameters channel. The settings take effect at each arena's
+        next reset.
+
+        float_params: dict
+            keys: varies by environment
+        """
+        if float_params is None: float_params = dict()
+        self.float_params = {**float_params, "nArenas": self.n_envs}
+        for k,v in self.float_params.items():
+            self.channels['env_params'].set_float_parameter(k, float(v))
+
+    def reset(self, idxs=None):
+        """
+        Unity cannot reset single arenas. Resetting a subset of the
+        arenas returns their current observations.
+
+        idxs: list of ints or None
+            the indices of the environments to reset. if None, all
+            arenas are reset
+
+        Returns:
+            obsrs: torch float tensor (K,C,H,W)
+            targs: torch float tensor (K,5)
+        """
+        if idxs is None:
+            idxs = range(self.n_envs)
+            self.env.reset()
+            self.actions[:] = 0
+            self.rews[:] = 0
+            self.stepped = False
+            self.pending = dict()
+        dec = self.wait_decisions()
+        rows = self.get_rows(dec, list(idxs))
+        # The reset observations are owned by the caller
+        obsrs = self.prep(dec.obs[self.frame_idx][rows])
+        targs = np.asarray(dec.obs[self.targ_idx][rows], dtype=np.float32)
+        return torch.from_numpy(obsrs), torch.from_numpy(targs)
+
+    def step(self, preds, idxs=None):
+        """
+        preds: torch tensor (K,2)
+            the outputs from the model. one row for each of the arenas
+            in idxs
+        idxs: list of ints or None
+            the indices of the arenas to step. if None, all arenas are
+            stepped
+
+        Returns:
+            obsrs: torch float tensor (K,C,H,W)
+                the observations following the step. If an arena is
+                done, this is the first observation of its new episode
+            targs: torch float tensor (K,5)
+            rews: torch float tensor (K,)
+            dones: torch long tensor (K,)
+            infos: list of dicts (K,)
+        """
+        if idxs is None: idxs = range(self.n_envs)
+        idxs = list(idxs)
+        preds = preds.reshape(len(idxs),-1).cpu().data.numpy()
+        self.actions[idxs] = preds
+        self.send_actions(self.dec)
+        self.env.step()
+        self.stepped = True
+        dec = self.wait_decisions()
+        rows = self.get_rows(dec, idxs)
+        frames = dec.obs[self.frame_idx][rows]
+        if self.timer is not None: t = self.timer.start()
+        out = self.get_out(frames.shape[1:])[:len(idxs)]
+        obsrs = self.prep(frames, out=out)
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
+        targs = np.array(dec.obs[self.targ_idx][rows], dtype=np.float32)
+        targs[:,:2] = np.clip(targs[:,:2],-1,1)
+        rews = self.rews[idxs].copy()
+        self.rews[idxs] = 0
+        dones = np.zeros(len(idxs), dtype=np.int64)
+        infos = [dict() for _ in idxs]
+        for j,k in enumerate(idxs):
+            if k not in self.pending: continue
+            frame,targ = self.pending.pop(k)
+            targ = np.array(targ, dtype=np.float32)
+            targ[:2] = np.clip(targ[:2],-1,1)
+            dones[j] = 1
+            infos[j]['terminal_obs'] = torch.from_numpy(
+                                            self.prep(frame[None])[0])
+            infos[j]['terminal_targ'] = torch.from_numpy(targ)
+        targs = torch.from_numpy(targs)
+        rews = torch.from_numpy(rews)
+        dones = torch.from_numpy(dones)
+        return torch.from_numpy(obsrs),targs,rews,dones,infos
+
+    def close(self):
+        self.env.close()
+        if self.claimed_id is not None:
+            get_registry().release(self.claimed_id)
+            self.claimed_id = None
+
+class SimEnv:
+    """
+    A single LocationGame arena simulated in numpy. Follows the
+    interface of UnityGymEnv so that it can be used wherever a Unity
+    environment is used.
+    """
+    def __init__(self, env_name, prep_fxn, seed=int(time.time()),
+                                           worker_id=None,
+                                           float_params=dict(),
+                                           uint8_obs=False,
+                                           **kwargs):
+        """
+        env_name: str
+            the name of the environment. only used for bookkeeping
+        prep_fxn: str
+            the name of the preprocessing function to be used on each
+            of the observations
+        seed: int
+            the random seed for the environment
+        worker_id: int
+            unused. Included for compatibility with UnityGymEnv
+        float_params: dict or None
+            the game settings. See LocationSim for the supported keys
+        uint8_obs: bool
+            if true, the observations are returned as uint8 tensors
+            and the prep_fxn is not applied. Requires a prep_fxn found
+            in UINT8_PREPS
+        """
+        self.env_name = env_name
+        self.prep_fxn = prep_fxn
+        self.uint8_obs = uint8_obs
+        self.prep = PrepEngine(prep_fxn, uint8_obs=uint8_obs)
+        self.seed = seed
+        self.worker_id = worker_id
+        self.float_params = float_params
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+
+        self.sim = LocationSim(n_envs=1, float_params=float_params,
+                                         seed=seed)
+        obs,action_targ = self.reset()
+        self.shape = obs.shape
+        self.targ_shape = action_targ.shape
+        self.is_discrete = False
+
+    def prep_obs(self, imgs):
+        """
+        imgs: ndarray (K,H,W,3)
+            the images rendered by the simulation
+        """
+        return torch.from_numpy(self.prep(imgs))
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings. See LocationSim.set_float_params
+
+        float_params: dict
+        """
+        self.float_params = float_params
+        self.sim.set_float_params(float_params)
+
+    def reset(self):
+        imgs,targs = self.sim.reset()
+        return self.prep_obs(imgs)[0], torch.from_numpy(targs[0])
+
+    def step(self,pred):
+        """
+        pred: torch tensor (..., 2)
+            the location prediction from the model
+        """
+        action = pred.squeeze().cpu().data.numpy()
+        imgs,targs,rews,dones = self.sim.step(action[None])
+        if self.timer is not None: t = self.timer.start()
+        obs = self.prep_obs(imgs)[0]
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
+        targ = torch.from_numpy(targs[0])
+        targ[:2] = torch.clamp(targ[:2],-1,1)
+        return obs, targ, float(rews[0]), bool(dones[0]), dict()
+
+    def close(self):
+        pass
+
+class SimVecEnv:
+    """
+    Simulates K LocationGame arenas in numpy with a single batched call
+    per step. Follows the interface of VecEnv. Environments that reach
+    a done are automatically reset. The terminal observation and target
+    of a done environment are returned in the environment's info dict
+    under the keys "terminal_obs" and "terminal_targ". As with VecEnv,
+    the observations returned by step are only valid until the
+    next-but-one call to step.
+    """
+    def __init__(self, n_envs, env_name, prep_fxn, seed=int(time.time()),
+                                                   float_params=dict(),
+                                                   uint8_obs=False,
+                                                   **kwargs):
+        """
+        n_envs: int
+            the number of arenas
+        env_name: str
+            the name of the environment. only used for bookkeeping
+        prep_fxn: str
+            the name of the preprocessing function to be used on each
+            of the observations
+        seed: int
+            the random seed for the simulation
+        float_params: dict or None
+            the game settings. See LocationSim for the supported keys
+        uint8_obs: bool
+            if true, the observations are returned as uint8 tensors
+            and the prep_fxn is not applied
+        """
+        self.env_name = env_name
+        self.prep_fxn = prep_fxn
+        self.prep = PrepEngine(prep_fxn, uint8_obs=uint8_obs)
+        self.n_envs = n_envs
+        self.float_params = float_params
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+        self.outs = [None, None]
+        self.out_idx = 0
+        self.sim = LocationSim(n_envs=n_envs, float_params=float_params,
+                                              seed=seed)
+        obsrs,targs = self.reset()
+        self.shape = obsrs.shape[1:]
+        self.targ_shape = targs.shape[1:]
+        self.is_discrete = False
+
+    def __len__(self):
+        return self.n_envs
+
+    def prep_obs(self, imgs, out=None):
+        """
+        imgs: ndarray (K,H,W,3)
+            the images rendered by the simulation
+        out: ndarray (K,C,H,W) or None
+            the buffer to write the observations to. if None, a new
+            buffer is allocated
+        """
+        return torch.from_numpy(self.prep(imgs, out=out))
+
+    def get_out(self, n):
+        """
+        Alternates between two reused output buffers
+
+        n: int
+            the number of observations
+
+        Returns:
+            out: ndarray (n,C,H,W)
+        """
+        self.out_idx = (self.out_idx+1)%2
+        if self.outs[self.out_idx] is None:
+            self.outs[self.out_idx] = self.prep.alloc(self.n_envs,
+                                                      self.sim.shape)
+        return self.outs[self.out_idx][:n]
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings. See LocationSim.set_float_params
+
+        float_params: dict
+        """
+        self.float_params = float_params
+        self.sim.set_float_params(float_params)
+
+    def reset(self, idxs=None):
+        """
+        idxs: list of ints or None
+            the indices of the environments to reset. if None, all
+            environments are reset
+
+        Returns:
+            obsrs: torch float tensor (K,C,H,W)
+            targs: torch float tensor (K,5)
+        """
+        imgs,targs = self.sim.reset(idxs)
+        return self.prep_obs(imgs), torch.from_numpy(targs)
+
+    def step(self, preds, idxs=None):
+        """
+        preds: torch tensor (K,2)
+            the location predictions from the model. one row for each
+            of the environments in idxs
+        idxs: list of ints or None
+            the indices of the environments to step. if None, all
+            environments are stepped
+
+        Returns:
+            obsrs: torch float tensor (K,C,H,W)
+                the observations following the step. If an environment
+                is done, this is the first observation of its new
+                episode
+            targs: torch float tensor (K,5)
+            rews: torch float tensor (K,)
+            dones: torch long tensor (K,)
+            infos: list of dicts (K,)
+        """
+        idxs = self.sim.get_idxs(idxs)
+        actions = preds.reshape(len(idxs),-1).cpu().data.numpy()
+        imgs,targs,rews,dones = self.sim.step(actions, idxs)
+        if self.timer is not None: t = self.timer.start()
+        obsrs = self.prep_obs(imgs, out=self.get_out(len(idxs)))
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
+        targs = torch.from_numpy(targs)
+        targs[:,:2] = torch.clamp(targs[:,:2],-1,1)
+        infos = [dict() for _ in range(len(idxs))]
+        done_idxs = np.nonzero(dones)[0]
+        if len(done_idxs) > 0:
+            new_obsrs,new_targs = self.reset(idxs[done_idxs])
+            for i in done_idxs:
+                infos[i]['terminal_obs'] = obsrs[i].clone()
+                infos[i]['terminal_targ'] = targs[i].clone()
+            obsrs[done_idxs] = new_obsrs
+            targs[done_idxs] = new_targs
+        rews = torch.from_numpy(rews)
+        dones = torch.from_numpy(dones.astype(np.int64))
+        return obsrs,targs,rews,dones,infos
+
+    def close(self):
+        pass
+
+class TraceEnv:
+    """
+    Replays a trace recorded by a TraceRecorder without the recorded
+    environment. Follows the interface of UnityGymEnv. The replay is
+    open loop. The argued actions are ignored and each step returns the
+    next recorded row. The recorded action of each step is returned in
+    the info dict under the key "action".
+
+    Episodes are replayed in their recorded order and wrap around at
+    the end of the trace. An env with the recorded seed starts from the
+    first episode and other seeds start from later episodes so that
+    the envs of a VecEnv replay different episodes. An episode that was
+    cut off by the end of the recording ends with a done and a zero
+    reward.
+    """
+    def __init__(self, env_name, prep_fxn, seed=int(time.time()),
+                                           worker_id=None,
+                                           float_params=dict(),
+                                           uint8_obs=False,
+                                           **kwargs):
+        """
+        env_name: str
+            "trace:" followed by the path to a trace file or to a
+            folder of traces recorded with record_trace. For a folder,
+            the trace with the env's seed is used
+        prep_fxn: str
+            the name of the preprocessing function to be used on each
+            of the observations
+        seed: int
+            selects the first replayed episode
+        worker_id: int
+            unused. Included for compatibility with UnityGymEnv
+        float_params: dict or None
+            only used to find the validation trace in a folder
+        uint8_obs: bool
+            if true, the observations are returned as uint8 tensors
+            and the prep_fxn is not applied. Requires a prep_fxn found
+            in UINT8_PREPS
+        """
+        self.env_name = env_name
+        self.prep_fxn = prep_fxn
+        self.uint8_obs = uint8_obs
+        self.prep = PrepEngine(prep_fxn, uint8_obs=uint8_obs)
+        self.seed = seed
+        self.worker_id = worker_id
+        self.float_params = float_params
+        # Optional PhaseTimer that records the prep_obs times
+        self.timer = None
+
+        if float_params is None: float_params = dict()
+        validation = try_key(float_params, 'validation', 0) >= 1
+        self.path = get_trace_file(env_name, seed, validation)
+        self.reader = TraceReader(self.path)
+        n_eps = len(self.reader.reset_idxs)
+        offset = seed - try_key(self.reader.info, 'seed', seed)
+        self.start_idx = self.reader.reset_idxs[offset%n_eps]
+        # The row of the current observation
+        self.idx = None
+        frame = self.reader.get("frames", 0)
+        self.shape = self.prep.out_shape(frame.shape)
+        self.targ_shape = self.reader.get("targs", 0).shape
+        self.is_discrete = False
+
+    def get_row(self, idx):
+        """
+        Returns the raw observation of a row
+
+        idx: int
+
+        Returns:
+            obs: list [ndarray (H,W,C), ndarray (T,)]
+        """
+        frame = self.reader.get("frames", idx)
+        targ = np.array(self.reader.get("targs", idx))
+        return [frame, targ]
+
+    def split_obs(self, obs):
+        """
+        obs: list [ndarray (H,W,C), ndarray (T,)]
+
+        Returns:
+            frame: ndarray (H,W,C)
+            targ: ndarray (T,)
+        """
+        return obs[0], obs[1]
+
+    def prep_obs(self, obs):
+        """
+        obs: list [ndarray (H,W,C), ndarray (T,)]
+        """
+        frame,targ = self.split_obs(obs)
+        frame = self.prep(frame[None])[0]
+        return [torch.from_numpy(frame), torch.from_numpy(targ)]
+
+    def reset_raw(self):
+        """
+        Moves to the start of the next recorded episode
+        """
+        if self.idx is None: self.idx = self.start_idx
+        else: self.idx = self.reader.next_reset(self.idx+1)
+        return self.get_row(self.idx)
+
+    def step_raw(self, pred):
+        """
+        Moves to the next recorded row. The pred is ignored
+
+        pred: torch tensor (..., N)
+
+        Returns:
+            obs: list [ndarray (H,W,C), ndarray (T,)]
+            rew: float
+            done: bool
+            info: dict
+        """
+        assert self.idx is not None, "reset must be called first"
+        idx = self.idx+1
+        if idx >= len(self.reader) or self.reader.resets[idx]:
+            # The recording ended before the episode's done
+            return self.get_row(self.idx), 0., True, dict()
+        self.idx = idx
+        rew = float(self.reader.get("rews", idx))
+        done = bool(self.reader.get("dones", idx))
+        info = {"action": np.array(self.reader.get("actions", idx))}
+        return self.get_row(idx), rew, done, info
+
+    def set_float_params(self, float_params):
+        """
+        The recorded settings cannot be changed. The float_params are
+        only recorded.
+
+        float_params: dict
+        """
+        self.float_params = float_params
+
+    def reset(self):
+        obs = self.reset_raw()
+        return self.prep_obs(obs)
+
+    def step(self,pred):
+        """
+        pred: torch tensor (..., N)
+            ignored
+        """
+        obs,rew,done,info = self.step_raw(pred)
+        if self.timer is not None: t = self.timer.start()
+        obs,targ = self.prep_obs(obs)
+        if self.timer is not None:
+            self.timer.lap("prep_obs", t, sub_phase=True)
+        targ[:2] = torch.clamp(targ[:2],-1,1)
+        return obs, targ, rew, done, info
+
+    def close(self):
+        self.reader.close()
+
+def get_trace_file(env_name, seed=0, validation=False):
+    """
+    Returns the path of the trace replayed by a TraceEnv
+
+    env_name: str
+        "trace:" followed by the path to a trace file or to a folder
+        of traces recorded with record_trace
+    seed: int
+    validation: bool
+    """
+    path = os.path.expanduser(env_name[len("trace:"):].strip())
+    if os.path.isdir(path):
+        path = get_trace_path(path, seed, validation)
+    return path
+
+def attach_recorder(env, hyps):
+    """
+    Records the raw rows of the env to a trace in the record_trace
+    folder. The trace is named by the env's seed, so only the envs
+    that collect training data record traces. The trainer's and the
+    evaluator's envs are made without record_trace.
+
+    env: GymEnv or UnityGymEnv
+    hyps: dict
+    """
+    float_params = try_key(hyps, 'float_params', None)
+    if float_params is None: float_params = dict()
+    validation = try_key(float_params, 'validation', 0) >= 1
+    path = get_trace_path(hyps['record_trace'], hyps['seed'], validation)
+    attrs = {
+        "env_name": hyps['env_name'],
+        "seed": hyps['seed'],
+        "float_params": float_params,
+        "game_variables": try_key(hyps, 'game_variables', None),
+    }
+    print("Recording trace to", path)
+    env.recorder = TraceRecorder(path, attrs=attrs)
+
+# Batched observation preprocessing. Each registered prep kernel reads
+# a batch of raw frames (K,H,W,C) and writes its CHW output directly
+# into a caller provided buffer (K,C',H',W'). The kernels loop over the
+# channels so that each write fills a contiguous plane of the output.
+# The per-frame prep functions are thin wrappers over the kernels.
+PREPS = dict()
+
+def register_prep(name, dtype=np.float32, shape_fxn=None):
+    """
+    Registers a batch prep kernel under name. Kernels have the
+    signature kernel(frames, out, scratch) where frames is an ndarray
+    (K,H,W,C), out is an ndarray (K,C',H',W') of the argued dtype and
+    scratch is a fxn(key, shape, dtype) that returns a reusable
+    temporary buffer.
+
+    name: str
+        the prep_fxn name used in the hyperparameters
+    dtype: numpy dtype
+        the dtype of the prepped observations
+    shape_fxn: fxn((H,W,C)) -> (C',H',W') or None
+        maps the frame shape to the prepped shape. defaults to the
+        transpose of the frame shape
+    """
+    if shape_fxn is None:
+        shape_fxn = lambda s: (s[2],s[0],s[1])
+    def decorator(kernel):
+        PREPS[name] = (kernel, dtype, shape_fxn)
+        return kernel
+    return decorator
+
+@register_prep("center_zero2one")
+def _center_zero2one_kernel(frames, out, scratch):
+    # 3*(obs-.5)/.5 == 6*obs-3
+    for c in range(frames.shape[-1]):
+        np.multiply(frames[...,c], 6, out=out[:,c], casting="unsafe")
+        np.subtract(out[:,c], 3, out=out[:,c])
+
+@register_prep("null_prep")
+def _null_prep_kernel(frames, out, scratch):
+    for c in range(frames.shape[-1]):
+        np.copyto(out[:,c], frames[...,c], casting="unsafe")
+
+@register_prep("uint8_prep", dtype=np.uint8)
+def _uint8_prep_kernel(frames, out, scratch):
+    if frames.dtype == np.uint8:
+        for c in range(frames.shape[-1]):
+            np.copyto(out[:,c], frames[...,c])
+        return
+    tmp = scratch("uint8_prep", frames.shape[:-1], np.float32)
+    for c in range(frames.shape[-1]):
+        np.multiply(frames[...,c], 255, out=tmp, casting="unsafe")
+        np.rint(tmp, out=tmp)
+        np.clip(tmp, 0, 255, out=tmp)
+        np.copyto(out[:,c], tmp, casting="unsafe")
+
+@register_prep("pong_prep", shape_fxn=lambda s: (1,80,(s[1]+1)//2))
+def _pong_prep_kernel(frames, out, scratch):
+    # crop, downsample by a factor of 2 and keep the red channel
+    pic = frames[:,35:195:2,::2,0]
+    # erase the two background types and set everything else
+    # (paddles, ball) to 1
+    mask = scratch("pong_prep", pic.shape, bool)
+    np.not_equal(pic, 0, out=mask)
+    mask &= pic != 144
+    mask &= pic != 109
+    np.copyto(out[:,0], mask, casting="unsafe")
+
+@register_prep("breakout_prep", shape_fxn=lambda s: (1,80,(s[1]-15)//2))
+def _breakout_prep_kernel(frames, out, scratch):
+    # crop and downsample by a factor of 2. greyscaling a single
+    # channel is the identity
+    np.copyto(out[:,0], frames[:,35:195:2,8:-8:2,0], casting="unsafe")
+
+@register_prep("snake_prep", shape_fxn=lambda s: (1,s[0],s[1]))
+def _snake_prep_kernel(frames, out, scratch):
+    dst = out[:,0]
+    dst.fill(0)
+    # later assignments take precedence over earlier ones
+    np.copyto(dst, 1, where=frames[...,0]==1)
+    np.copyto(dst, 1.5, where=frames[...,0]==255)
+    np.copyto(dst, 0, where=frames[...,1]==255)
+    np.copyto(dst, .33, where=frames[...,2]==255)
+
+class PrepEngine:
+    """
+    Applies a registered prep_fxn to batches of raw frames in a single
+    vectorized pass. Temporary buffers are allocated once per shape and
+    reused across calls.
+    """
+    def __init__(self, prep_fxn, uint8_obs=False):
+        """
+        prep_fxn: str
+            the name of a prep_fxn registered in PREPS
+        uint8_obs: bool
+            if true, the frames are quantized to uint8 and the prep_fxn
+            normalization is left to to_float_obs. Requires a prep_fxn
+            found in UINT8_PREPS
+        """
+        s = "unknown prep_fxn "+str(prep_fxn)
+        assert prep_fxn in PREPS, s
+        if uint8_obs:
+            s = "uint8_obs is not supported for "+prep_fxn
+            assert prep_fxn in UINT8_PREPS, s
+            prep_fxn = "uint8_prep"
+        self.prep_fxn = prep_fxn
+        self.kernel,self.dtype,self.shape_fxn = PREPS[prep_fxn]
+        self.scratches = dict()
+
+    def out_shape(self, frame_shape):
+        """
+        frame_shape: tuple of ints (H,W,C) or (H,W)
+
+        Returns:
+            shape: tuple of ints (C',H',W')
+        """
+        if len(frame_shape)==2: frame_shape = (*frame_shape,1)
+        return tuple(self.shape_fxn(tuple(frame_shape)))
+
+    def alloc(self, n_frames, frame_shape):
+        """
+        Allocates an output buffer for n_frames frames
+
+        n_frames: int
+        frame_shape: tuple of ints (H,W,C) or (H,W)
+
+        Returns:
+            out: ndarray (K,C',H',W')
+        """
+        shape = (n_frames,*self.out_shape(frame_shape))
+        return np.empty(shape, dtype=self.dtype)
+
+    def scratch(self, key, shape, dtype):
+        """
+        Returns a reusable temporary buffer. The contents of the buffer
+        are undefined.
+
+        key: str
+        shape: tuple of ints
+        dtype: numpy dtype
+        """
+        buf = self.scratches.get(key, None)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self.scratches[key] = buf
+        return buf
+
+    def __call__(self, frames, out=None):
+        """
+        frames: ndarray (K,H,W,C) or (K,H,W)
+            the raw frames
+        out: ndarray (K,C',H',W') or None
+            the buffer the prepped frames are written to. if None, a
+            new buffer is allocated
+
+        Returns:
+            out: ndarray (K,C',H',W')
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 3: frames = frames[...,None]
+        if out is None: out = self.alloc(len(frames), frames.shape[1:])
+        self.kernel(frames, out, self.scratch)
+        return out
+
+_ENGINES = dict()
+def _prep_frame(prep_fxn, pic):
+    """
+    Preps a single frame with a cached engine
+
+    prep_fxn: str
+    pic: ndarray (H,W,C) or (H,W)
+
+    Returns:
+        obs: ndarray (C',H',W')
+    """
+    engine = _ENGINES.get(prep_fxn, None)
+    if engine is None:
+        engine = PrepEngine(prep_fxn)
+        _ENGINES[prep_fxn] = engine
+    return engine(np.asarray(pic)[None])[0]
 
 def pong_prep(pic):
-    pic = pic[35:195] # crop
-    pic = pic[::2,::2,0] # downsample by factor of 2
-    pic[pic == 144] = 0 # erase background (background type 1)
-    pic[pic == 109] = 0 # erase background (background type 2)
-    pic[pic != 0] = 1 # everything else (paddles, ball) just set to 1
-    return pic[None]
+    """
+    pic: ndarray (H,W,C)
+        a raw atari frame
+    """
+    return _prep_frame("pong_prep", pic)
 
 def breakout_prep(pic):
-    pic = pic[35:195,8:-8] # crop
-    pic = pic[::2,::2,0] # downsample by factor of 2
-    pic = rgb2grey(pic)
-    return pic[None]
+    """
+    pic: ndarray (H,W,C)
+        a raw atari frame
+    """
+    return _prep_frame("breakout_prep", pic)
 
 def snake_prep(pic):
-    new_pic = np.zeros(pic.shape[:2],dtype=np.float32)
-    new_pic[:,:][pic[:,:,0]==1] = 1
-    new_pic[:,:][pic[:,:,0]==255] = 1.5
-    new_pic[:,:][pic[:,:,1]==255] = 0
-    new_pic[:,:][pic[:,:,2]==255] = .33
-    pic = new_pic
-    return new_pic[None]
+    """
+    pic: ndarray (H,W,C)
+    """
+    return _prep_frame("snake_prep", pic)
+
+def uint8_prep(obs):
+    """
+    Quantizes the observation to uint8 without normalizing it
+
+    obs: ndarray (H,W,C) or (H,W)
+        values must range from 0-1 if not already uint8
+
+    Returns:
+        obs: uint8 ndarray (C,H,W)
+    """
+    return _prep_frame("uint8_prep", obs)
 
 def center_zero2one(obs):
     """
-    obs: ndarray (C, H, W)
+    obs: ndarray (H,W,C) or (H,W)
         values must range from 0-1
+
+    Returns:
+        obs: float32 ndarray (C,H,W)
     """
-    obs = obs.astype(np.float32)
-    obs = 3*(obs-.5)/.5
-    if len(obs.shape)==2:
-        return obs[None]
-    return obs
+    return _prep_frame("center_zero2one", obs)
 
 def null_prep(obs):
-    obs = obs.astype(np.float32)
-    if len(obs.shape)==2:
-        return obs[None]
-    return obs
+    """
+    obs: ndarray (H,W,C) or (H,W)
+
+    Returns:
+        obs: float32 ndarray (C,H,W)
+    """
+    return _prep_frame("null_prep", obs)
+
+# The scale and shift that map uint8 pixels to the output of each
+# supported prep_fxn
+UINT8_PREPS = {
+    "center_zero2one": (6/255, -3),
+    "null_prep":       (1/255, 0),
+}
+
+def to_float_obs(obs, prep_fxn="center_zero2one"):
+    """
+    Applies the normalization of the prep_fxn to uint8 observations as
+    a single op on the observations' device. Observations that are not
+    uint8 are returned unchanged.
+
+    obs: torch tensor (..., C, H, W)
+    prep_fxn: str
+        the name of the prep_fxn that the observations would have been
+        processed with
+    """
+    if obs.dtype != torch.uint8: return obs
+    scale,shift = UINT8_PREPS[prep_fxn]
+    return obs.float().mul_(scale).add_(shift)
 
 def get_env(hyps):
+    if hyps['env_name'][:4] == "sim:":
+        return SimEnv(**hyps)
+    if hyps['env_name'][:6] == "trace:":
+        return TraceEnv(**hyps)
     if hyps['env_name'][:4] == "gym:":
         og_name = hyps['env_name']
         del hyps['env_name']
         env_name = og_name.split(":")[-1].strip()
         env = GymEnv(env_name=env_name,**hyps)
         hyps['env_name'] = og_name
-        return env
-    return UnityGymEnv(**hyps)
+    else:
+        env = UnityGymEnv(**hyps)
+    if try_key(hyps, 'record_trace', None) is not None:
+        attach_recorder(env, hyps)
+    return env
+
+def get_vec_env(hyps, n_envs):
+    """
+    Makes a VecEnv of n_envs environments. Each environment is seeded
+    with a unique offset from hyps['seed']. Simulated environments are
+    made as a single SimVecEnv and multi-arena unity builds as a single
+    UnityMultiEnv.
+
+    hyps: dict
+        the hyperparameters used to make each environment
+    n_envs: int
+        the number of environments
+    """
+    if hyps['env_name'][:4] == "sim:":
+        return SimVecEnv(n_envs=n_envs, **hyps)
+    if try_key(hyps, 'multi_arena', False):
+        return UnityMultiEnv(n_envs=n_envs, **hyps)
+    seed = hyps['seed']
+    worker_id = try_key(hyps,'worker_id',None)
+    envs = []
+    for i in range(n_envs):
+        hyps['seed'] = seed + i
+        if worker_id is not None:
+            hyps['worker_id'] = worker_id + i
+        envs.append(get_env(hyps))
+    hyps['seed'] = seed
+    hyps['worker_id'] = worker_id
+    return VecEnv(envs)
@@ -3,26 +3,75 @@ Description:
     - System for storing game experience
     - Can read and write experience blocks
     - Can randomly sample experience blocks
+    - Can back its storage with memory mapped files on disk
 """
 
+import os
+import json
 import numpy as np
 import torch
 import pickle
 from collections import deque
 
+# Keys whose values are stored as long tensors
+LONG_KEYS = {"count_idxs", "longs", "seg_ids"}
+# The name of the file that indexes a disk backed replay's fields
+INDEX_FILE = "index.json"
+
 class ExperienceReplay:
     """
     Stores data collected from rollouts. It is important to update the
     h values after each update. Otherwise stale hs can infect the
     training.
+
+    The data is held in a circular buffer that is allocated once at
+    max_size rows. New data overwrites the oldest rows, so each append
+    only copies the new data. Indexes argued to get_data and update_hs
+    are logical indexes, where 0 is the oldest stored row.
+
+    Batches are sampled with a single (B,S) index matrix that gathers
+    every field into reusable output buffers. The replay can optionally
+    be kept on the training device so that sampling never leaves it.
+
+    If a folder is argued, each field is stored in a preallocated
+    memory mapped .npy file in the folder, so the replay is limited by
+    disk rather than RAM. The write head and the number of stored rows
+    are kept in an index file that is rewritten by save. A replay made
+    on a folder that already holds a saved replay reopens it.
+
+    Each row is stored with the id of its rollout segment. A new
+    segment begins at every start or reset row, so a sequence is valid
+    if its first and last rows share a segment id. For each sampled
+    horizon, the replay keeps an index of the valid sequence starts
+    that is extended as rows are appended and trimmed as rows are
+    evicted, so that valid sequences are sampled without rejection and
+    never need to have their h vectors fixed up at segment boundaries.
     """
-    def __init__(self, intl_data=None, max_size=20000):
+    def __init__(self, intl_data=None, max_size=20000, device=None,
+                                                       folder=None):
         """
         max_size: int or None
             the maximum number of time steps to store. if None, no max
-            is imposed
+            is imposed and the buffer doubles in size whenever it fills
+        device: torch device or None
+            the device that the data is stored on. if None, the data is
+            stored on the cpu
+        folder: str or None
+            if argued, the data is stored in memory mapped files in
+            this folder. max_size must be argued and device must be
+            None
         """
         self.max_size = max_size if max_size is not None else np.inf
+        self.device = torch.device("cpu") if device is None else\
+                      torch.device(device)
+        self.folder = folder
+        if folder is not None:
+            s = "disk backed replays must have a max_size"
+            assert max_size is not None, s
+            s = "disk backed replays are stored on the cpu"
+            assert self.device.type == "cpu", s
+            self.folder = os.path.expanduser(folder)
+            os.makedirs(self.folder, exist_ok=True)
         self.data = {
             "obsrs":     None,
             "rews":      None,
@@ -34,12 +83,103 @@ class ExperienceReplay:
             #"starts":     idx 2
             #"dones":      idx 3
             #"resets":     idx 4
+            "seg_ids":   None,
         }
-        self.data_lists = {k:[] for k in self.data.keys()}
+        # The allocated number of rows
+        self.capacity = 0
+        # The physical index of the next row to be written
+        self.head = 0
+        # The number of rows holding data
+        self.n_rows = 0
+        # The number of rows ever appended. The global index of a row
+        # is the value of n_added when it was appended
+        self.n_added = 0
+        # The segment id of the newest row
+        self.last_seg = 0
+        # The valid sequence starts of each horizon. See update_valids
+        self.valids = dict()
+        # The reusable output buffers of get_data
+        self.out_bufs = dict()
+        # The memory maps of a disk backed replay's fields
+        self.memmaps = dict()
+        if self.folder is not None and\
+                os.path.exists(os.path.join(self.folder, INDEX_FILE)):
+            self.open_folder()
         # Fill main dict with with intl_data
         if intl_data is not None:
             self.add_data(intl_data)
 
+    def allocate(self, new_data, capacity):
+        """
+        Allocates the storage using the shapes and dtypes of the argued
+        data. Existing rows are copied over in logical order.
+
+        new_data: dict
+            see add_data
+        capacity: int
+            the number of rows to allocate
+        """
+        old = None
+        if self.n_rows > 0:
+            old = {k:self.get_ordered(k) for k in self.data.keys()}
+        for k in self.data.keys():
+            x = new_data[k]
+            # The indexes are stored as longs so that sampled batches
+            # need no conversion
+            dtype = torch.long if k in LONG_KEYS else x.dtype
+            shape = (capacity, *x.shape[1:])
+            if self.folder is not None:
+                self.memmaps[k] = open_field(self.folder, k, shape=shape,
+                                                             dtype=dtype)
+                self.data[k] = torch.from_numpy(self.memmaps[k])
+            else:
+                self.data[k] = torch.empty(shape, dtype=dtype,
+                                                  device=self.device)
+            if old is not None:
+                self.data[k][:self.n_rows] = old[k]
+        self.capacity = capacity
+        self.head = self.n_rows % capacity
+        if self.folder is not None: self.save_index()
+
+    def open_folder(self):
+        """
+        Reopens the memory mapped fields of a saved disk backed replay
+        """
+        path = os.path.join(self.folder, INDEX_FILE)
+        with open(path, 'r') as f:
+            index = json.load(f)
+        s = "saved replay has a different max_size"
+        assert index['capacity'] == self.max_size, s
+        for k in self.data.keys():
+            self.memmaps[k] = open_field(self.folder, k)
+            self.data[k] = torch.from_numpy(self.memmaps[k])
+        self.capacity = index['capacity']
+        self.head = index['head']
+        self.n_rows = index['n_rows']
+        self.n_added = index['n_added']
+        self.last_seg = index['last_seg']
+
+    def save_index(self):
+        """
+        Writes the write head and the number of stored rows of a disk
+        backed replay to its index file
+        """
+        index = {
+            "capacity": self.capacity,
+            "head": self.head,
+            "n_rows": self.n_rows,
+            "n_added": self.n_added,
+            "last_seg": self.last_seg,
+            "fields": {k:os.path.basename(get_field_path(self.folder,k))
+                       for k in self.data.keys()},
+        }
+        path = os.path.join(self.folder, INDEX_FILE)
+        # Written to a temporary file first so that a crash never
+        # leaves a partial index
+        with open(path+".tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(path+".tmp", path)
+
     def add_data(self, new_data):
         """
                     R = self.n_runs
@@ -47,7 +187,7 @@ class ExperienceReplay:
 
             new_data: dict
                 keys:
-                    "obsrs":      torch float tensor (B,C,H,W)
+                    "obsrs":      torch float or uint8 tensor (B,C,H,W)
                     "rews":       torch float tensor (B,)
                     "fwd_hs":         torch float tensor (B,E)
                     "count_idxs": torch long tensor  (B,)
@@ -58,37 +198,198 @@ class ExperienceReplay:
                         #"dones":      idx 3
                         #"resets":     idx 4
         """
-        # Append new data
+        new_data['seg_ids'] = self.get_seg_ids(new_data['longs'])
+        for k in self.data.keys():
+            # Squeezes all but the batch dimension
+            x = new_data[k].detach().data.to(self.device)
+            new_data[k] = x.reshape(len(x),*[d for d in x.shape[1:]\
+                                                       if d != 1])
+        n = len(new_data['obsrs'])
+        if n == 0: return
+        if self.capacity == 0 and self.max_size < np.inf:
+            self.allocate(new_data, int(self.max_size))
+        elif self.max_size == np.inf and self.n_rows+n > self.capacity:
+            capacity = max(2*self.capacity, self.n_rows+n)
+            self.allocate(new_data, capacity)
+        # Only the most recent rows survive an oversized append
+        skip = max(n-self.capacity, 0)
+        n = n-skip
+        # The rows are written in at most two contiguous pieces
+        n_end = min(n, self.capacity-self.head)
         for k in self.data.keys():
-            new_data[k] = new_data[k].cpu().detach().data.squeeze()
-            self.data_lists[k].append(new_data[k].clone())
+            x = new_data[k][skip:]
+            self.data[k][self.head:self.head+n_end] = x[:n_end]
+            if n_end < n:
+                self.data[k][:n-n_end] = x[n_end:]
+        self.head = (self.head+n) % self.capacity
+        self.n_rows = min(self.n_rows+n, self.capacity)
+        self.n_added += n+skip
 
-    def cat_new_data(self):
+    def get_seg_ids(self, longs):
         """
-        This function must be called before using the data dict. It
-        performs the concatenation of all new data with the old data
-        and imposes the max size limit
+        Returns the segment ids of the argued rows. The ids continue
+        from the newest stored row, which is updated to the last of the
+        argued rows.
+
+        longs: torch long tensor (B,5)
+            see add_data
+
+        Returns:
+            seg_ids: torch long tensor (B,)
         """
-        for k in self.data.keys():
-            if len(self.data_lists[k]) > 0:
-                if self.data[k] is None:
-                    self.data[k] = torch.cat(self.data_lists[k],dim=0)
-                else:
-                    arr = [self.data[k],*self.data_lists[k]]
-                    self.data[k] = torch.cat(arr, dim=0)
-                if len(self.data[k])>self.max_size:
-                    self.data[k] = self.data[k][-self.max_size:]
-                self.data_lists[k] = []
+        longs = longs.detach().reshape(len(longs), -1).cpu()
+        flags = (longs[:,2]!=0) | (longs[:,4]!=0)
+        seg_ids = torch.cumsum(flags.long(), dim=0) + self.last_seg
+        if len(seg_ids) > 0: self.last_seg = int(seg_ids[-1])
+        return seg_ids
+
+    def update_valids(self, horizon):
+        """
+        Brings the index of valid sequence starts of the argued horizon
+        up to date. The starts are stored as global indexes in sorted
+        order, so evicted starts are trimmed from the front and the
+        starts of newly appended rows are added to the back. Each row
+        is only checked once.
+
+        horizon: int
+
+        Returns:
+            valids: dict
+                "starts": ndarray of the global indexes of the valid
+                    starts in positions [lo,hi)
+                "lo": int
+                "hi": int
+                "checked": int
+                    the global index of the first unchecked start
+        """
+        if horizon not in self.valids:
+            self.valids[horizon] = {"starts": np.zeros(0,dtype=np.int64),
+                                    "lo": 0, "hi": 0, "checked": 0}
+        v = self.valids[horizon]
+        oldest = self.n_added - self.n_rows
+        # Trim the evicted starts
+        v['lo'] += np.searchsorted(v['starts'][v['lo']:v['hi']], oldest)
+        # Check the starts whose sequences have been completed
+        first = max(v['checked'], oldest)
+        last = self.n_added - horizon
+        if last >= first:
+            cands = torch.arange(first, last+1)
+            logical = cands - oldest
+            seg_firsts = self.get_phys_idxs(logical, 1).reshape(-1)
+            seg_lasts = self.get_phys_idxs(logical+horizon-1, 1)
+            seg_ids = self.data['seg_ids']
+            same = seg_ids[seg_firsts] == seg_ids[seg_lasts.reshape(-1)]
+            new = cands[same.cpu()].numpy()
+            n_new = len(new)
+            if v['hi']+n_new > len(v['starts']):
+                # Moves the live starts to the front of a buffer with
+                # room for the new starts
+                n_live = v['hi']-v['lo']
+                size = max(len(v['starts']), 2*(n_live+n_new))
+                starts = np.empty(size, dtype=np.int64)
+                starts[:n_live] = v['starts'][v['lo']:v['hi']]
+                v['starts'],v['lo'],v['hi'] = starts, 0, n_live
+            v['starts'][v['hi']:v['hi']+n_new] = new
+            v['hi'] += n_new
+            v['checked'] = last+1
+        return v
+
+    def n_valid(self, horizon):
+        """
+        Returns the number of valid sequence starts of the argued
+        horizon. A sequence is valid if it does not cross a segment
+        boundary after its first row.
+
+        horizon: int
+        """
+        v = self.update_valids(horizon)
+        return v['hi']-v['lo']
+
+    def get_valid_idxs(self, positions, horizon):
+        """
+        Returns the logical indexes of the valid sequence starts at the
+        argued positions of the valid start index. Use positions drawn
+        from [0,n_valid(horizon)) to sample valid sequences.
+
+        positions: torch long tensor or ndarray (B,)
+        horizon: int
+
+        Returns:
+            idxs: torch long tensor (B,)
+                logical indexes that can be argued to get_data
+        """
+        v = self.update_valids(horizon)
+        positions = np.asarray(positions, dtype=np.int64)
+        s = "positions must be less than n_valid(horizon)"
+        assert len(positions)==0 or positions.max()<v['hi']-v['lo'], s
+        starts = v['starts'][v['lo']+positions]
+        oldest = self.n_added - self.n_rows
+        return torch.from_numpy(starts-oldest)
+
+    def get_ordered(self, key):
+        """
+        Returns a copy of the stored rows of the argued key ordered
+        from oldest to newest
+
+        key: str
+        """
+        if self.n_rows < self.capacity:
+            return self.data[key][:self.n_rows].clone()
+        arr = [self.data[key][self.head:], self.data[key][:self.head]]
+        return torch.cat(arr, dim=0)
+
+    def get_phys_idxs(self, idxs, horizon):
+        """
+        Converts logical sequence starting indexes into the physical
+        indexes of every row of each sequence. Sequences may wrap past
+        the end of the storage but never past the write head.
+
+        idxs: sequence of ints (B,)
+        horizon: int
+
+        Returns:
+            phys_idxs: torch long tensor (B,S)
+        """
+        if not isinstance(idxs, torch.Tensor):
+            idxs = torch.as_tensor(np.asarray(idxs))
+        idxs = idxs.long().reshape(-1)
+        # Checked before the indexes are moved to avoid a device sync
+        if not idxs.is_cuda:
+            s = "sequences must end before the newest row"
+            assert len(idxs)==0 or idxs.max()+horizon<=self.n_rows, s
+        idxs = idxs.to(self.device)
+        oldest = self.head if self.n_rows == self.capacity else 0
+        arange = torch.arange(horizon, device=self.device)
+        phys_idxs = idxs[:,None] + arange[None] + oldest
+        return phys_idxs % self.capacity
+
+    def get_out_buf(self, key, shape, dtype):
+        """
+        Returns a reusable output buffer, allocating it if the argued
+        shape or dtype has changed.
+
+        key: str
+        shape: tuple of ints
+        dtype: torch dtype
+        """
+        buf = self.out_bufs.get(key, None)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = torch.empty(shape, dtype=dtype, device=self.device)
+            self.out_bufs[key] = buf
+        return buf
 
     def get_data(self, idxs, horizon=9):
         """
         Returns a batch of data sequences of length horizon. The argued
         idxs indicate a batch of sequences starting with the data point
-        of the argued indexes
+        of the argued indexes. The returned tensors are reused by the
+        next call to get_data, so they must be copied or consumed
+        before then.
 
-        idxs: ndarray (B,)
+        idxs: ndarray or torch long tensor (B,)
             each index corresponds to a data sequence starting with
-            the datapoint at that index in the data arrays 
+            the datapoint at that index in the data arrays. idx+horizon
+            must not exceed len(self)
         horizon: int
             the length of the data sequences
 
@@ -96,7 +397,7 @@ class ExperienceReplay:
         B = len(idxs)
         Returns:
             dict
-                "obs_seq": float tensor (B,S,C,H,W)
+                "obs_seq": float or uint8 tensor (B,S,C,H,W)
                 "rew_seq": float tensor (B,S)
                 "h_seq": float tensor   (B,S,E)
                 "done_seq":  long tensor (B,S)
@@ -105,30 +406,37 @@ class ExperienceReplay:
                 "color_seq": long tensor (B,S)
                 "shape_seq": long tensor (B,S)
                 "count_seq": long tensor (B,S)
+                "seg_seq": long tensor (B,S)
         """
-        self.cat_new_data()
-        sample = dict()
-        sample['obs_seq'] = rolling_window(self.data['obsrs'],
-                                           horizon)[idxs].clone()
-        sample['rew_seq'] = rolling_window(self.data['rews'],
-                                           horizon)[idxs].clone()
-        sample['h_seq'] = rolling_window(self.data['fwd_hs'],
-                                           horizon)[idxs].clone()
-        sample['count_seq'] = rolling_window(self.data['count_idxs'],
-                                            horizon)[idxs].long().clone()
+        phys_idxs = self.get_phys_idxs(idxs, horizon)
+        B,S = phys_idxs.shape
+        rows = phys_idxs.reshape(-1)
+        seqs = dict()
+        for k,arr in self.data.items():
+            shape = (B,S,*arr.shape[1:])
+            buf = self.get_out_buf(k, shape, arr.dtype)
+            out = buf.view(B*S, *arr.shape[1:])
+            torch.index_select(arr, 0, rows, out=out)
+            seqs[k] = buf
         #"color_idxs": idx 0
         #"shape_idxs": idx 1
         #"starts":     idx 2
         #"dones":      idx 3
         #"resets":     idx 4
-        long_seq = rolling_window(self.data['longs'],
-                                  horizon)[idxs].long().clone()
-        sample['color_seq'] = long_seq[:,:,0]
-        sample['shape_seq'] = long_seq[:,:,1]
-        sample['start_seq'] = long_seq[:,:,2]
-        sample['done_seq'] =  long_seq[:,:,3]
-        sample['reset_seq'] = long_seq[:,:,4]
-        sample = {k:v.contiguous() for k,v in sample.items()}
+        # The long columns are laid out as contiguous (B,S) planes
+        long_seq = self.get_out_buf("long_seq", (5,B,S), torch.long)
+        long_seq.copy_(seqs['longs'].permute(2,0,1))
+        sample = dict()
+        sample['obs_seq'] = seqs['obsrs']
+        sample['rew_seq'] = seqs['rews']
+        sample['h_seq'] = seqs['fwd_hs']
+        sample['count_seq'] = seqs['count_idxs']
+        sample['color_seq'] = long_seq[0]
+        sample['shape_seq'] = long_seq[1]
+        sample['start_seq'] = long_seq[2]
+        sample['done_seq'] =  long_seq[3]
+        sample['reset_seq'] = long_seq[4]
+        sample['seg_seq'] = seqs['seg_ids']
         return sample # shapes (B,S,...)
 
     def update_hs(self, idxs, new_hs):
@@ -140,31 +448,105 @@ class ExperienceReplay:
         idxs: torch Long Tensor (N,)
         new_hs: torch Float Tensor (N,S,H)
             the new h vectors. there should be a sequence of h values
-            for each idx
+            for each idx. where sequences overlap, the h of the later
+            sequence in idxs is kept, as if the sequences were written
+            one after the other
         """
+        hs = self.data["fwd_hs"]
         horizon = new_hs.shape[1]
-        new_hs = new_hs.cpu().data
-        for i in range(len(new_hs)):
-            self.data["fwd_hs"][idxs[i]:idxs[i]+horizon] = new_hs[i]
+        rows = self.get_phys_idxs(idxs, horizon).reshape(-1)
+        new_hs = new_hs.data.to(self.device).reshape(len(rows),
+                                                     *hs.shape[1:])
+        # The last write to each row in sequence order wins. A stable
+        # sort keeps the writes to each row in that order
+        rows,perm = torch.sort(rows, stable=True)
+        last = torch.ones_like(rows, dtype=torch.bool)
+        last[:-1] = rows[1:] != rows[:-1]
+        hs.index_copy_(0, rows[last], new_hs[perm[last]].to(hs.dtype))
 
     def __len__(self):
-        list_len = 0
-        if self.data_lists['obsrs'] is not None:
-            list_len=np.sum([len(l) for l in self.data_lists['obsrs']])
-            list_len = int(list_len)
-        data_len = 0
-        if self.data['obsrs'] is not None:
-            data_len = len(self.data['obsrs'])
-        return min(list_len + data_len, self.max_size)
+        return self.n_rows
 
     def load(self, save_name):
+        """
+        Adds the data of a saved replay to this replay
+
+        save_name: str
+            the path of a pickled replay or the folder of a disk backed
+            replay
+        """
+        if os.path.isdir(save_name):
+            with open(os.path.join(save_name, INDEX_FILE), 'r') as f:
+                capacity = json.load(f)['capacity']
+            saved = ExperienceReplay(max_size=capacity, folder=save_name)
+            # Copied in blocks so that the saved data is never fully
+            # loaded into memory
+            step = 4096
+            for i in range(0, len(saved), step):
+                idxs = torch.arange(i, min(i+step, len(saved)))
+                rows = saved.get_phys_idxs(idxs, 1).reshape(-1)
+                self.add_data({k:v[rows] for k,v in saved.data.items()})
+            return
         with open(save_name, 'rb') as f:
             data = pickle.load(f)
         self.add_data(data)
 
-    def save(self, save_name):
+    def save(self, save_name=None):
+        """
+        Saves the replay. A disk backed replay flushes its memory
+        mapped fields to disk and writes its index. Rows reach the
+        memory maps as they are appended, but the index is only written
+        here. If training stops between saves, the rows appended since
+        the last save are not described by the index, and a reopened
+        replay can treat rows that were overwritten after the save as
+        its oldest rows. Save together with the training checkpoint to
+        keep the two consistent
+
+        save_name: str or None
+            the path of the pickle file. ignored by disk backed replays
+        """
+        if self.folder is not None:
+            for v in self.memmaps.values(): v.flush()
+            if self.capacity > 0: self.save_index()
+            return
+        data = {k:None for k in self.data.keys()}
+        if self.n_rows > 0:
+            data = {k:self.get_ordered(k).cpu() for k in self.data}
         with open(save_name, 'wb') as f:
-            pickle.dump(self.data, f)
+            pickle.dump(data, f)
+
+def get_field_path(folder, key):
+    """
+    Returns the path of the memory mapped file of a replay field
+
+    folder: str
+    key: str
+    """
+    return os.path.join(folder, key+".npy")
+
+def open_field(folder, key, shape=None, dtype=None):
+    """
+    Opens the memory mapped file of a replay field. The file is
+    created if a shape is argued.
+
+    folder: str
+    key: str
+    shape: tuple of ints or None
+        the shape of the field. if None, the existing file is opened
+    dtype: torch dtype or None
+        the dtype of the field. required if shape is argued
+
+    Returns:
+        field: np memmap
+    """
+    path = get_field_path(folder, key)
+    if shape is None:
+        arr = np.lib.format.open_memmap(path, mode='r+')
+    else:
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        arr = np.lib.format.open_memmap(path, mode='w+', dtype=np_dtype,
+                                              shape=tuple(shape))
+    return arr
 
 def rolling_window(array, window, axis=0, stride=1):
     """
@@ -0,0 +1,424 @@
+"""
+Description:
+    - A vectorized numpy simulation of the LocationGame
+    - Steps many arenas at once without a Unity build
+    - Follows the image and target protocol of the Unity game so that
+      the training pipeline can be run and benchmarked without Unity
+
+The simulation is a simplified version of the game. Each arena holds
+between minObjCount and maxObjCount objects of random colors and
+shapes placed between minObjLoc and maxObjLoc. The goal objects are
+touched in the order of their index. The agent touches an object by
+predicting a location within touch_radius of the object. The targets
+are
+
+    [x, z, color_idx, shape_idx, count_idx]
+
+where x and z are the location of the current goal, and count_idx is
+the number of goal objects that remain after the current goal. The
+reward is 1 when the goal is touched and the negative distance from the
+agent to the goal otherwise.
+"""
+
+import numpy as np
+
+N_COLORS = 6
+N_SHAPES = 6
+# The game variables that are otherwise read from the variables.json of
+# a Unity build
+GAME_VARIABLES = {
+    "n_colors": N_COLORS,
+    "n_shapes": N_SHAPES,
+}
+
+# RGB values of the object colors followed by the colors of the origin
+# marker and the agent
+COLORS = np.asarray([
+    [1.0, 0.1, 0.1],
+    [0.1, 0.9, 0.1],
+    [0.2, 0.3, 1.0],
+    [1.0, 0.9, 0.1],
+    [0.9, 0.1, 0.9],
+    [0.1, 0.9, 0.9],
+    [0.8, 0.8, 0.8],
+    [1.0, 1.0, 1.0],
+], dtype=np.float32)
+ORIGIN_COLOR = N_COLORS
+AGENT_COLOR = N_COLORS+1
+FLOOR_COLOR = 0.3
+
+def make_sprites(radius):
+    """
+    Makes a boolean stamp for each object shape followed by the stamps
+    of the origin marker and the agent.
+
+    radius: int
+        the half width of the stamps in pixels
+
+    Returns:
+        sprites: bool ndarray (N_SHAPES+2, 2*radius+1, 2*radius+1)
+    """
+    r = max(radius, 1)
+    offs = np.arange(-r, r+1)
+    dz = np.abs(offs)[:,None]
+    dx = np.abs(offs)[None,:]
+    sprites = [
+        np.maximum(dx,dz) <= r,                      # square
+        dx**2+dz**2 <= r**2,                         # circle
+        dx+dz <= r,                                  # diamond
+        ((dx<=r/3)&(dz<=r))|((dz<=r/3)&(dx<=r)),     # plus
+        (dz<=r/2)&(dx<=r),                           # horizontal bar
+        (dx<=r/2)&(dz<=r),                           # vertical bar
+        np.maximum(dx,dz) == r,                      # origin outline
+        dx**2+dz**2 <= (r/2)**2,                     # agent
+    ]
+    return np.stack(sprites).astype(bool)
+
+def get_combos(validation):
+    """
+    Returns the color and shape combinations of the argued split. A
+    quarter of the combinations are held out for validation.
+
+    validation: bool
+
+    Returns:
+        combos: long ndarray (N,2)
+            the color and shape index of each combination
+    """
+    colors,shapes = np.meshgrid(np.arange(N_COLORS), np.arange(N_SHAPES),
+                                                     indexing="ij")
+    combos = np.stack([colors.reshape(-1),shapes.reshape(-1)],axis=-1)
+    heldout = (combos.sum(-1)%4) == 0
+    if validation:
+        return combos[heldout]
+    return combos[~heldout]
+
+class LocationSim:
+    """
+    Simulates n_envs arenas of the LocationGame in parallel. All state
+    is held in arrays with a leading arena dimension so that each call
+    steps or renders every argued arena at once.
+
+    Coordinates range from -1 to 1 along both axes of the arena with the
+    origin at the center. Image rows run from +z at the top to -z at the
+    bottom.
+    """
+    def __init__(self, n_envs=1, float_params=dict(), seed=0,
+                                                   img_size=84,
+                                                   obj_size=0.08,
+                                                   touch_radius=0.15,
+                                                   move_size=0.2,
+                                                   max_steps=None,
+                                                   **kwargs):
+        """
+        n_envs: int
+            the number of arenas
+        float_params: dict
+            the game settings. supported keys are validation,
+            minObjCount, maxObjCount, minObjLoc, maxObjLoc,
+            egoCentered, absoluteCoords, visibleTargs, visibleOrigin,
+            endAtOrigin, countOut, and smoothMovement. other keys are
+            ignored
+            validation: bool
+                if true, the objects use the held out color and shape
+                combinations
+            egoCentered: bool
+                if true, the images are centered on the agent and the
+                targets and actions are relative to the agent unless
+                absoluteCoords is true
+            visibleTargs: bool
+                if false, the objects are only visible in the first
+                image of each episode
+            endAtOrigin: bool
+                if true, the origin is the last goal of each episode
+            countOut: bool
+                if true, touched objects are removed from the arena
+            smoothMovement: bool
+                if true, the agent moves at most move_size towards the
+                predicted location each step
+        seed: int
+            the seed of the simulation's random state
+        img_size: int
+            the height and width of the images in pixels
+        obj_size: float
+            the half width of the objects in arena units
+        touch_radius: float
+            the distance in arena units within which a goal is touched
+        move_size: float
+            the maximum distance moved per step when smoothMovement is
+            true
+        max_steps: int or None
+            the maximum number of steps in an episode. if None,
+            defaults to three times the maximum number of goals
+        """
+        self.n_envs = n_envs
+        self.img_size = img_size
+        self.obj_size = obj_size
+        self.touch_radius = touch_radius
+        self.move_size = move_size
+        self.max_steps_arg = max_steps
+        self.rand = np.random.RandomState(int(seed))
+        radius = int(round(obj_size/2*(img_size-1)))
+        self.sprites = make_sprites(radius)
+        self.radius = self.sprites.shape[-1]//2
+        self.offs = np.arange(-self.radius, self.radius+1)
+        self.shape = (img_size, img_size, 3)
+        self.targ_shape = (5,)
+        self.max_count = None
+        self.set_float_params(float_params)
+
+        N,M = n_envs, self.max_count
+        self.obj_locs = np.zeros((N,M,2), dtype=np.float32)
+        self.obj_colors = np.zeros((N,M), dtype=np.int64)
+        self.obj_shapes = np.zeros((N,M), dtype=np.int64)
+        self.n_objs = np.zeros(N, dtype=np.int64)
+        self.present = np.zeros((N,M), dtype=bool)
+        self.goal_idxs = np.zeros(N, dtype=np.int64)
+        self.agent_locs = np.zeros((N,2), dtype=np.float32)
+        self.tsteps = np.zeros(N, dtype=np.int64)
+
+    def set_float_params(self, float_params):
+        """
+        Changes the game settings. The object settings, including
+        validation, apply from each arena's next reset and the others
+        apply immediately. Switch settings between episodes to keep
+        episodes consistent. The maxObjCount cannot change once the
+        simulation is made.
+
+        float_params: dict
+            See __init__ for the supported keys
+        """
+        if float_params is None: float_params = dict()
+        p = {k:float(v) for k,v in float_params.items()}
+        self.validation = p.get("validation",0) >= 1
+        self.min_count = int(p.get("minObjCount",1))
+        max_count = int(p.get("maxObjCount",self.min_count))
+        if self.max_count is not None:
+            s = "maxObjCount cannot change after the simulation is made"
+            assert max_count == self.max_count, s
+        self.max_count = max_count
+        assert 1 <= self.min_count <= self.max_count
+        # Object locations are argued as proportions of the arena
+        self.min_loc = 2*p.get("minObjLoc",0.27)-1
+        self.max_loc = 2*p.get("maxObjLoc",0.73)-1
+        self.ego = p.get("egoCentered",0) >= 1
+        self.absolute = p.get("absoluteCoords",float(not self.ego))>=1
+        self.visible_targs = p.get("visibleTargs",1) >= 1
+        self.visible_origin = p.get("visibleOrigin",1) >= 1
+        self.end_at_origin = p.get("endAtOrigin",0) >= 1
+        self.count_out = p.get("countOut",0) >= 1
+        self.smooth = p.get("smoothMovement",0) >= 1
+        max_steps = self.max_steps_arg
+        if max_steps is None:
+            max_steps = 3*(self.max_count+int(self.end_at_origin))
+        self.max_steps = max_steps
+        self.combos = get_combos(self.validation)
+
+    def get_idxs(self, idxs):
+        if idxs is None: return np.arange(self.n_envs)
+        return np.asarray(idxs, dtype=np.int64).reshape(-1)
+
+    def reset(self, idxs=None):
+        """
+        Begins a new episode in each of the argued arenas.
+
+        idxs: sequence of ints or None
+            the arenas to reset. if None, all arenas are reset
+
+        Returns:
+            imgs: float32 ndarray (K,H,W,3)
+                values range from 0-1
+            targs: float32 ndarray (K,5)
+        """
+        idxs = self.get_idxs(idxs)
+        K,M = len(idxs), self.max_count
+        n_objs = self.rand.randint(self.min_count, self.max_count+1, K)
+        locs = self.rand.uniform(self.min_loc,self.max_loc,(K,M,2))
+        combos = self.combos[self.rand.randint(len(self.combos),
+                                               size=(K,M))]
+        self.obj_locs[idxs] = locs
+        self.obj_colors[idxs] = combos[...,0]
+        self.obj_shapes[idxs] = combos[...,1]
+        self.n_objs[idxs] = n_objs
+        self.present[idxs] = np.arange(M)[None] < n_objs[:,None]
+        self.goal_idxs[idxs] = 0
+        self.agent_locs[idxs] = 0
+        self.tsteps[idxs] = 0
+        return self.render(idxs), self.get_targs(idxs)
+
+    def get_goals(self, idxs):
+        """
+        Returns the location, color, and shape of the current goal of
+        each argued arena. The goal following the last object is the
+        origin.
+
+        idxs: long ndarray (K,)
+
+        Returns:
+            locs: float32 ndarray (K,2)
+            colors: long ndarray (K,)
+            shapes: long ndarray (K,)
+        """
+        goal_idxs = self.goal_idxs[idxs]
+        is_obj = goal_idxs < self.n_objs[idxs]
+        g = np.minimum(goal_idxs, self.max_count-1)
+        locs = self.obj_locs[idxs,g]
+        locs = np.where(is_obj[:,None], locs, 0).astype(np.float32)
+        colors = np.where(is_obj, self.obj_colors[idxs,g], N_COLORS)
+        shapes = np.where(is_obj, self.obj_shapes[idxs,g], N_SHAPES)
+        return locs, colors, shapes
+
+    def get_targs(self, idxs):
+        """
+        idxs: long ndarray (K,)
+
+        Returns:
+            targs: float32 ndarray (K,5)
+                the location, color_idx, shape_idx, and count_idx of
+                each arena's current goal
+        """
+        locs,colors,shapes = self.get_goals(idxs)
+        if not self.absolute:
+            locs = locs - self.agent_locs[idxs]
+        counts = self.n_objs[idxs]-self.goal_idxs[idxs]-1
+        targs = np.zeros((len(idxs),5), dtype=np.float32)
+        targs[:,:2] = locs
+        targs[:,2] = colors
+        targs[:,3] = shapes
+        targs[:,4] = np.maximum(counts, 0)
+        return targs
+
+    def step(self, actions, idxs=None):
+        """
+        Moves the agent of each argued arena to its predicted location
+        and touches the goal if it is within the touch radius.
+
+        actions: float ndarray (K,2)
+            the predicted locations. relative to the agent when the
+            targets are relative
+        idxs: sequence of ints or None
+            the arenas to step. if None, all arenas are stepped
+
+        Returns:
+            imgs: float32 ndarray (K,H,W,3)
+            targs: float32 ndarray (K,5)
+            rews: float32 ndarray (K,)
+            dones: bool ndarray (K,)
+        """
+        idxs = self.get_idxs(idxs)
+        actions = np.clip(np.asarray(actions,dtype=np.float32),-1,1)
+        actions = actions.reshape(len(idxs),2)
+        agent_locs = self.agent_locs[idxs]
+        if not self.absolute:
+            actions = actions + agent_locs
+        if self.smooth:
+            diffs = actions-agent_locs
+            dists = np.linalg.norm(diffs, axis=-1, keepdims=True)
+            scale = np.minimum(1, self.move_size/np.maximum(dists,1e-8))
+            actions = agent_locs + diffs*scale
+        agent_locs = np.clip(actions, -1, 1)
+        self.agent_locs[idxs] = agent_locs
+
+        goal_locs,_,_ = self.get_goals(idxs)
+        dists = np.linalg.norm(agent_locs-goal_locs, axis=-1)
+        touched = dists < self.touch_radius
+        rews = np.where(touched, 1, -dists).astype(np.float32)
+        if self.count_out:
+            goal_idxs = self.goal_idxs[idxs]
+            removes = touched & (goal_idxs < self.n_objs[idxs])
+            g = np.minimum(goal_idxs, self.max_count-1)
+            self.present[idxs[removes],g[removes]] = False
+        self.goal_idxs[idxs] += touched
+        self.tsteps[idxs] += 1
+
+        n_goals = self.n_objs[idxs] + int(self.end_at_origin)
+        dones = (self.goal_idxs[idxs] >= n_goals)
+        dones = dones | (self.tsteps[idxs] >= self.max_steps)
+        # The final goal is kept in the targets of finished episodes
+        self.goal_idxs[idxs] = np.minimum(self.goal_idxs[idxs],
+                                          np.maximum(n_goals-1,0))
+        return self.render(idxs), self.get_targs(idxs), rews, dones
+
+    def to_pixels(self, locs, centers):
+        """
+        Converts arena locations to pixel rows and columns.
+
+        locs: float ndarray (K,N,2)
+        centers: float ndarray (K,2)
+            the arena location at the center of each image
+
+        Returns:
+            rows: long ndarray (K,N)
+            cols: long ndarray (K,N)
+        """
+        scale = (self.img_size-1)/2
+        rel = locs - centers[:,None]
+        cols = np.rint((rel[...,0]+1)*scale).astype(np.int64)
+        rows = np.rint((1-rel[...,1])*scale).astype(np.int64)
+        return rows, cols
+
+    def render(self, idxs):
+        """
+        Draws the current image of each argued arena. The floor, the
+        objects, the origin marker, and the agent are drawn in that
+        order. Each object is stamped into the images with a single
+        scatter over all of the arenas.
+
+        idxs: long ndarray (K,)
+
+        Returns:
+            imgs: float32 ndarray (K,H,W,3)
+                values range from 0-1
+        """
+        K,S,P = len(idxs), self.img_size, self.radius
+        centers = self.agent_locs[idxs] if self.ego else\
+                  np.zeros((K,2), dtype=np.float32)
+
+        # The padding allows stamps to hang over the image edges
+        canvas = np.zeros((K,S+2*P,S+2*P,3), dtype=np.float32)
+        coords = np.linspace(-1, 1, S, dtype=np.float32)
+        in_x = np.abs(centers[:,0:1]+coords[None]) <= 1
+        in_z = np.abs(centers[:,1:2]-coords[None]) <= 1
+        floor = in_z[:,:,None] & in_x[:,None,:]
+        canvas[:,P:P+S,P:P+S] = floor[...,None]*FLOOR_COLOR
+
+        # Each stamp is an (arena, location, sprite, color) entry
+        present = self.present[idxs]
+        if not self.visible_targs:
+            present = present & (self.tsteps[idxs]==0)[:,None]
+        arenas = [np.repeat(np.arange(K)[:,None],self.max_count,1)]
+        locs = [self.obj_locs[idxs]]
+        sprites = [self.obj_shapes[idxs]]
+        colors = [self.obj_colors[idxs]]
+        masks = [present]
+        markers = [(self.visible_origin, np.zeros((K,1,2)),
+                                         N_SHAPES, ORIGIN_COLOR),
+                   (True, self.agent_locs[idxs][:,None],
+                          N_SHAPES+1, AGENT_COLOR)]
+        for draw,loc,sprite,color in markers:
+            arenas.append(np.arange(K)[:,None])
+            locs.append(loc)
+            sprites.append(np.full((K,1), sprite))
+            colors.append(np.full((K,1), color))
+            masks.append(np.full((K,1), draw))
+        arenas = np.concatenate(arenas,axis=1)
+        locs = np.concatenate(locs,axis=1)
+        sprites = np.concatenate(sprites,axis=1)
+        colors = np.concatenate(colors,axis=1)
+        masks = np.concatenate(masks,axis=1)
+
+        rows,cols = self.to_pixels(locs, centers)
+        masks = masks&(rows>=0)&(rows<S)&(cols>=0)&(cols<S)
+        # Later stamps are drawn over earlier ones in the same arena
+        for j in range(masks.shape[1]):
+            m = masks[:,j]
+            if not m.any(): continue
+            a = arenas[m,j]
+            r = rows[m,j][:,None] + P + self.offs[None]
+            c = cols[m,j][:,None] + P + self.offs[None]
+            a,r,c = a[:,None,None], r[:,:,None], c[:,None,:]
+            patch = canvas[a,r,c]
+            stamp = self.sprites[sprites[m,j]][...,None]
+            color = COLORS[colors[m,j]][:,None,None]
+            canvas[a,r,c] = np.where(stamp, color, patch)
+        return canvas[:,P:P+S,P:P+S]
@@ -0,0 +1,177 @@
+"""
+Description:
+    - Lightweight timing of the phases of a process's loop
+    - Aggregates the durations of each phase into histograms
+    - Periodically flushes the histograms to a json file
+"""
+
+import os
+import time
+import json
+import numpy as np
+
+class PhaseTimer:
+    """
+    Records the duration of named phases into log spaced histograms.
+    Phases are timed by laps so that a single clock read both ends one
+    phase and begins the next.
+
+        t = timer.start()
+        obs = env.step(pred)
+        t = timer.lap("env_step", t)
+
+    Phases that are timed within another phase, like the prep of
+    observations within an env step, are recorded as sub phases. Their
+    time is excluded from the enclosing phase so that the phase totals
+    can be summed.
+
+        t = timer.start()
+        obs = env.step(pred) # laps "prep_obs" with sub_phase=True
+        t = timer.lap("env_step", t) # excludes the prep_obs time
+
+    A disabled timer returns immediately from each call so that the
+    calls can be left in place.
+    """
+    def __init__(self, path=None, enabled=True, flush_interval=60,
+                                                sync_fxn=None,
+                                                min_time=1e-6,
+                                                max_time=100,
+                                                n_bins=64):
+        """
+        path: str or None
+            the json file that the histograms are flushed to. if None,
+            the histograms are never flushed
+        enabled: bool
+            if false, no timing is performed
+        flush_interval: float
+            the minimum number of seconds between flushes
+        sync_fxn: callable or None
+            called before reading the clock for laps that request a
+            sync. Use torch.cuda.synchronize to include the time of
+            asynchronous gpu work in a phase
+        min_time: float
+            the lower edge of the first histogram bin in seconds
+        max_time: float
+            the upper edge of the last histogram bin in seconds
+        n_bins: int
+            the number of histogram bins
+        """
+        self.path = path
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.sync_fxn = sync_fxn
+        self.edges = np.logspace(np.log10(min_time), np.log10(max_time),
+                                                     n_bins+1)
+        self.counts = dict()
+        self.totals = dict()
+        self.sub_phases = set()
+        # The (start,end) clock times of the sub phases recorded since
+        # the last lap
+        self.sub_spans = []
+        self.last_flush = time.time()
+
+    def start(self):
+        """
+        Returns the current clock time
+        """
+        if not self.enabled: return 0
+        return time.perf_counter()
+
+    def lap(self, phase, t, sync=False, sub_phase=False):
+        """
+        Records the time since t under the argued phase and returns
+        the current clock time.
+
+        phase: str
+            the name of the phase
+        t: float
+            the clock time at the start of the phase
+        sync: bool
+            if true, the sync_fxn is called before reading the clock
+        sub_phase: bool
+            if true, the phase is nested within the phase of the next
+            lap, which excludes this phase's time
+        """
+        if not self.enabled: return 0
+        if sync and self.sync_fxn is not None: self.sync_fxn()
+        now = time.perf_counter()
+        if sub_phase:
+            self.sub_phases.add(phase)
+            self.sub_spans.append((t,now))
+            self.record(phase, now-t)
+        else:
+            # Only the sub phases that began within this phase
+            sub_time = sum([e-s for s,e in self.sub_spans if s >= t])
+            self.sub_spans = []
+            self.record(phase, now-t-sub_time)
+        return now
+
+    def record(self, phase, duration):
+        """
+        Adds a duration to the argued phase's histogram.
+
+        phase: str
+        duration: float
+            seconds
+        """
+        if not self.enabled: return
+        if phase not in self.counts:
+            self.counts[phase] = np.zeros(len(self.edges)+1,
+                                          dtype=np.int64)
+            self.totals[phase] = 0
+        # Bin 0 holds durations below min_time and the last bin holds
+        # durations above max_time
+        idx = np.searchsorted(self.edges, duration)
+        self.counts[phase][idx] += 1
+        self.totals[phase] += duration
+
+    def summary(self):
+        """
+        Returns:
+            dict
+                keys: str
+                    the phase names
+                vals: dict
+                    "count": the number of recorded durations
+                    "total": the summed duration in seconds
+                    "mean": the mean duration in seconds
+                    "hist": the histogram counts. The first and last
+                        bins count the durations outside of the edges
+                    "sub_phase": true if the phase's time is nested
+                        within, and excluded from, other phases
+        """
+        summary = dict()
+        for phase,counts in self.counts.items():
+            n = int(counts.sum())
+            summary[phase] = {
+                "count": n,
+                "total": self.totals[phase],
+                "mean": self.totals[phase]/max(n,1),
+                "hist": counts.tolist(),
+                "sub_phase": phase in self.sub_phases,
+            }
+        return summary
+
+    def maybe_flush(self):
+        """
+        Flushes the histograms if flush_interval seconds have passed
+        since the last flush.
+        """
+        if not self.enabled or self.path is None: return
+        if time.time()-self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the cumulative histograms to the json at self.path
+        """
+        if not self.enabled or self.path is None: return
+        data = {
+            "edges": self.edges.tolist(),
+            "phases": self.summary(),
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+        self.last_flush = time.time()
@@ -0,0 +1,252 @@
+"""
+Description:
+    - Records the raw observations, targets, rewards, dones, and actions
+      of an environment to a chunked h5 trace
+    - Reads traces back at memory mapped speed so that the exact env
+      sequences can be replayed without Unity (see
+      locgame.environments.TraceEnv)
+
+A trace is a flat sequence of rows. Each episode begins with a reset
+row that holds the first observation of the episode and is followed by
+one row per step. A step row holds the action that was taken and the
+observation, target, reward, and done that it produced.
+
+    frames:  (N,H,W,C) the raw frames in the env's dtype
+    targs:   float32 (N,T)
+    rews:    float32 (N,)
+    dones:   bool (N,)
+    resets:  bool (N,) true for the reset rows
+    actions: float32 (N,A) zeros for the reset rows
+"""
+
+import os
+import json
+import numpy as np
+
+TRACE_KEYS = ["frames", "targs", "rews", "dones", "resets", "actions"]
+
+def get_trace_path(folder, seed, validation=False):
+    """
+    Returns the path of the trace recorded by the env with the argued
+    seed.
+
+    folder: str
+    seed: int
+    validation: bool
+        validation envs share their seed with a training env
+    """
+    name = "trace_seed{}".format(seed)
+    if validation: name += "_val"
+    return os.path.join(os.path.expanduser(folder), name+".h5")
+
+class TraceRecorder:
+    """
+    Streams the raw rows of an environment to an h5 trace. Rows are
+    buffered in memory and appended to the resizable datasets one chunk
+    at a time. At close, the trace is rewritten with a contiguous
+    layout so that it can be memory mapped by TraceReader.
+
+    Attach a recorder to an env by setting its recorder attribute.
+    """
+    def __init__(self, path, chunk_size=1024, attrs=dict(),
+                                              contiguous=True):
+        """
+        path: str
+            the path of the h5 file. an existing file is overwritten
+        chunk_size: int
+            the number of rows in each chunk of the datasets
+        attrs: dict
+            json serializable information about the env that is saved
+            with the trace
+        contiguous: bool
+            if true, the trace is rewritten with a contiguous layout at
+            close
+        """
+        import h5py
+        self.path = os.path.expanduser(path)
+        folder = os.path.dirname(self.path)
+        if folder != "": os.makedirs(folder, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.contiguous = contiguous
+        self.file = h5py.File(self.path, 'w')
+        self.file.attrs['info'] = json.dumps(attrs)
+        self.buf = {k:[] for k in TRACE_KEYS}
+        self.n_rows = 0
+
+    def make_datasets(self):
+        """
+        Creates the resizable datasets from the shapes and dtypes of
+        the first buffered row
+        """
+        for k in TRACE_KEYS:
+            x = np.asarray(self.buf[k][0])
+            chunks = (self.chunk_size,*x.shape)
+            self.file.create_dataset(k, shape=(0,*x.shape),
+                                        maxshape=(None,*x.shape),
+                                        chunks=chunks,
+                                        dtype=x.dtype)
+
+    def record(self, frame, targ, rew=0, done=False, reset=False,
+                                                    action=None):
+        """
+        Buffers a single row
+
+        frame: ndarray (H,W,C)
+            the raw frame
+        targ: ndarray (T,)
+        rew: float
+        done: bool
+        reset: bool
+            true if the frame is the first frame of an episode
+        action: ndarray, int, or None
+            the action that produced the frame. None for reset rows
+        """
+        if action is None:
+            assert reset, "step rows must argue their action"
+        else:
+            action = np.atleast_1d(np.asarray(action,dtype=np.float32))
+        self.buf['frames'].append(np.array(frame))
+        self.buf['targs'].append(np.asarray(targ, dtype=np.float32))
+        self.buf['rews'].append(np.float32(rew))
+        self.buf['dones'].append(bool(done))
+        self.buf['resets'].append(bool(reset))
+        self.buf['actions'].append(action)
+        if len(self.buf['frames']) >= self.chunk_size: self.flush()
+
+    def flush(self, final=False):
+        """
+        Appends the buffered rows to the datasets. The reset rows hold
+        zero actions of the size of the step actions, so the first
+        flush waits for a step row.
+
+        final: bool
+            if true, the rows are flushed even if no step has been
+            recorded
+        """
+        n = len(self.buf['frames'])
+        if n == 0: return
+        actions = self.buf['actions']
+        if "actions" in self.file:
+            size = self.file['actions'].shape[1:]
+        else:
+            sizes = [x.shape for x in actions if x is not None]
+            if len(sizes) == 0 and not final: return
+            size = sizes[0] if len(sizes)>0 else (1,)
+        for i,x in enumerate(actions):
+            if x is None: actions[i] = np.zeros(size,np.float32)
+        if "actions" not in self.file: self.make_datasets()
+        for k in TRACE_KEYS:
+            dset = self.file[k]
+            dset.resize(self.n_rows+n, axis=0)
+            dset[self.n_rows:] = np.stack(self.buf[k])
+            self.buf[k] = []
+        self.n_rows += n
+
+    def close(self):
+        if self.file is None: return
+        self.flush(final=True)
+        self.file.close()
+        self.file = None
+        if self.contiguous and self.n_rows > 0:
+            make_contiguous(self.path)
+
+def make_contiguous(path, block_size=4096):
+    """
+    Rewrites an h5 trace with contiguous datasets so that the datasets
+    can be memory mapped.
+
+    path: str
+    block_size: int
+        the number of rows copied at a time
+    """
+    import h5py
+    tmp_path = path+".tmp"
+    with h5py.File(path, 'r') as src, h5py.File(tmp_path, 'w') as dst:
+        for k,v in src.attrs.items():
+            dst.attrs[k] = v
+        for k in TRACE_KEYS:
+            dset = dst.create_dataset(k, shape=src[k].shape,
+                                         dtype=src[k].dtype)
+            for i in range(0, len(src[k]), block_size):
+                dset[i:i+block_size] = src[k][i:i+block_size]
+    os.replace(tmp_path, path)
+
+class TraceReader:
+    """
+    Random access to the rows of an h5 trace. Contiguous datasets are
+    memory mapped. Chunked datasets, like those of a trace that was
+    not closed, are read one block of rows at a time.
+    """
+    def __init__(self, path, block_size=1024):
+        """
+        path: str
+        block_size: int
+            the number of rows read at a time from chunked datasets
+        """
+        import h5py
+        self.path = os.path.expanduser(path)
+        self.block_size = block_size
+        self.file = h5py.File(self.path, 'r')
+        self.info = json.loads(self.file.attrs['info'])
+        self.n_rows = len(self.file['frames'])
+        assert self.n_rows > 0, "empty trace "+self.path
+        self.data = dict()
+        self.blocks = dict()
+        for k in TRACE_KEYS:
+            dset = self.file[k]
+            offset = dset.id.get_offset()
+            if dset.chunks is None and offset is not None:
+                self.data[k] = np.memmap(self.path, mode='r',
+                                                    dtype=dset.dtype,
+                                                    shape=dset.shape,
+                                                    offset=offset)
+        # Resets are read once so that episodes can be found quickly
+        self.resets = np.asarray(self.file['resets'][:])
+        self.reset_idxs = np.nonzero(self.resets)[0]
+        assert len(self.reset_idxs) > 0, "trace has no reset rows"
+
+    def __len__(self):
+        return self.n_rows
+
+    def get(self, key, idx):
+        """
+        Returns a single row of the argued dataset
+
+        key: str
+            one of TRACE_KEYS
+        idx: int
+        """
+        if key in self.data: return self.data[key][idx]
+        start = idx - idx%self.block_size
+        block = self.blocks.get(key, (None, None))
+        if block[0] != start:
+            block = (start, self.file[key][start:start+self.block_size])
+            self.blocks[key] = block
+        return block[1][idx-start]
+
+    def next_reset(self, idx):
+        """
+        Returns the index of the first reset row at or after idx,
+        wrapping around to the start of the trace
+
+        idx: int
+        """
+        i = np.searchsorted(self.reset_idxs, idx)
+        if i >= len(self.reset_idxs): return self.reset_idxs[0]
+        return self.reset_idxs[i]
+
+    def close(self):
+        self.data = dict()
+        self.blocks = dict()
+        self.file.close()
+
+def load_trace_info(path):
+    """
+    Returns the information about the recorded env that was saved with
+    a trace
+
+    path: str
+    """
+    import h5py
+    with h5py.File(os.path.expanduser(path), 'r') as f:
+        return json.loads(f.attrs['info'])
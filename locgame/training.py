@@ -6,9 +6,10 @@ from torch.nn import PoissonNLLLoss, MSELoss
 import torch.nn.functional as F
 from torch.optim.lr_scheduler import ReduceLROnPlateau,StepLR,MultiStepLR
 import time
+import copy
 from tqdm import tqdm
 import math
-from queue import Queue
+from queue import Queue, Empty
 from collections import deque
 import psutil
 import json
@@ -18,8 +19,11 @@ from ml_utils.training import get_exp_num, record_session, get_save_folder,get_r
 from ml_utils.utils import try_key, load_json
 import locgame.models as models
 import locgame.environments as environments
+import locgame.simulator as simulator
 from locgame.experience import ExperienceReplay
-import matplotlib.pyplot as plt
+from locgame.environments import to_float_obs
+from locgame.timing import PhaseTimer
+from locgame.traces import load_trace_info
 from datetime import datetime
 from torch.distributions import kl_divergence, Normal
 
@@ -28,19 +32,92 @@ if torch.cuda.is_available():
 else:
     DEVICE = torch.device("cpu")
 
+def imsave(path, img):
+    """
+    Saves an image with matplotlib. matplotlib is imported on first use
+    so that the runner processes never import it.
+
+    path: str
+    img: ndarray (H,W,C)
+    """
+    import matplotlib.pyplot as plt
+    plt.imsave(path, img)
+
 def get_game_variables(hyps):
     """
     Uses the env_name to find the n_number, n_color, and n_shape counts
     for the argued version of the game.
     """
-    env_path = "/".join(hyps['env_name'].split("/")[:-1])
-    variables = load_json(env_path+"/variables.json")
+    if hyps['env_name'][:4] == "sim:":
+        variables = simulator.GAME_VARIABLES
+    elif hyps['env_name'][:6] == "trace:":
+        path = environments.get_trace_file(hyps['env_name'],
+                                           try_key(hyps,'seed',0))
+        variables = load_trace_info(path)['game_variables']
+        s = "trace was recorded without its game variables"
+        assert variables is not None, s
+    else:
+        env_path = "/".join(hyps['env_name'].split("/")[:-1])
+        variables = load_json(env_path+"/variables.json")
+    # Saved with recorded traces
+    hyps['game_variables'] = {**variables}
     hyps['endAtOrigin'] = try_key(hyps,'endAtOrigin',0)
     for k in variables.keys():
         hyps[k] = variables[k] + hyps['endAtOrigin']
     hyps['n_numbers'] = try_key(hyps,'maxObjCount',5)
     return hyps
 
+def get_val_params(hyps):
+    """
+    Returns the float_params of the validation envs. The held out
+    objects are used for validation when n_runs > 1.
+
+    hyps: dict
+    """
+    float_params = {**hyps['float_params']}
+    if hyps['n_runs'] > 1: float_params['validation'] = 1
+    return float_params
+
+def get_trainer_env(hyps):
+    """
+    Makes the trainer's env. The env is used for validation unless
+    shared_val_env is true, in which case it is a training env whose
+    float_params are switched for validation.
+
+    hyps: dict
+        the n_runners, envs_per_runner, and runner_pool settings must
+        be final
+
+    Returns:
+        env: environment
+        shared_val: bool
+            true if validation switches the float_params of a training
+            env at runtime rather than using an env of its own
+    """
+    shared_val = try_key(hyps,'shared_val_env',False) and\
+                 not try_key(hyps,'async_validation',False)
+    use_vec = try_key(hyps,'envs_per_runner',1) > 1 or\
+              try_key(hyps,'prealloc_rollout',False)
+    if shared_val and use_vec:
+        s = "shared_val_env does not support sim: or multi_arena envs"
+        s += " with envs_per_runner > 1 or prealloc_rollout"
+        assert hyps['env_name'][:4] != "sim:" and\
+               not try_key(hyps,'multi_arena',False), s
+    # Traces are only recorded by collection envs so that no two envs
+    # record to the same trace. The trainer's env only collects when
+    # a single runner collects in the trainer's process
+    env_hyps = {**hyps}
+    trainer_collects = hyps['n_runners'] == 1 and\
+                       not try_key(hyps,'runner_pool',False) and\
+                       try_key(hyps,'envs_per_runner',1) == 1
+    if not trainer_collects: env_hyps['record_trace'] = None
+    if shared_val:
+        env = environments.get_env(env_hyps)
+    else:
+        env = environments.get_env({**env_hyps,
+                                    "float_params":get_val_params(hyps)})
+    return env, shared_val
+
 def train(rank, hyps, verbose=True):
     """
     hyps: dict
@@ -84,10 +161,14 @@ def train(rank, hyps, verbose=True):
     if verbose:
         print("Making Env(s)")
     hyps['n_runners'] = try_key(hyps,'n_runners',1)
-    validation = hyps['float_params']['validation']
-    if hyps['n_runs'] > 1: hyps['float_params']['validation']=1
-    env = environments.get_env(hyps)
-    hyps['float_params']['validation'] = validation
+    # Autotuning changes the runner settings that the trainer's env
+    # depends on, so the env is remade after tuning. Until then it is
+    # only used for its shapes and never records
+    tune = try_key(hyps,'autotune',False) and try_key(hyps,'n_runs',1)>1
+    if tune:
+        env,shared_val = get_trainer_env({**hyps, "record_trace":None})
+    else:
+        env,shared_val = get_trainer_env(hyps)
 
     hyps["img_shape"] = env.shape
     hyps["targ_shape"] = env.targ_shape
@@ -103,6 +184,8 @@ def train(rank, hyps, verbose=True):
                                                     patience=6,
                                                     verbose=True)
     fwd_dynamics = try_key(hyps,'use_fwd_dynamics',True) and countOut
+    # Compute the fwd_hs on the trainer rather than during collection
+    defer_fwd = fwd_dynamics and try_key(hyps,'defer_fwd_hs',False)
     fwd_model = None
     if fwd_dynamics:
         fwd_model = getattr(models, hyps['fwd_class'])(**hyps)
@@ -114,7 +197,18 @@ def train(rank, hyps, verbose=True):
         fwd_scheduler = ReduceLROnPlateau(fwd_optim, 'min', factor=0.5,
                                                      patience=6,
                                                      verbose=True)
-        exp_replay = ExperienceReplay(max_size=hyps['exp_size'])
+        # Optionally keep the replay on the training device so that
+        # sampling never leaves it
+        replay_device = None
+        if try_key(hyps,'device_replay',False): replay_device = DEVICE
+        # Optionally store the replay in memory mapped files. A resumed
+        # training reopens the saved replay
+        replay_folder = None
+        if try_key(hyps,'disk_replay',False):
+            replay_folder = os.path.join(hyps['save_folder'], "replay")
+        exp_replay = ExperienceReplay(max_size=hyps['exp_size'],
+                                      device=replay_device,
+                                      folder=replay_folder)
 
     if checkpt is not None:
         if verbose:
@@ -124,6 +218,23 @@ def train(rank, hyps, verbose=True):
         if fwd_dynamics:
             fwd_model.load_state_dict(checkpt['fwd_state_dict'])
             fwd_optim.load_state_dict(checkpt['fwd_optim_dict'])
+    if tune:
+        path = os.path.join(hyps['save_folder'], "autotune.json")
+        if checkpt is not None:
+            # A resumed training keeps the settings of its first
+            # autotune rather than tuning again
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    set_autotune_config(hyps, json.load(f))
+        else:
+            if verbose:
+                print("Autotuning rollout settings")
+            results = autotune(hyps, model, env.shape, verbose=verbose)
+            with open(path, 'w') as f:
+                json.dump(results, f)
+        # The model only needed the env's shapes, which are kept
+        env.close()
+        env,shared_val = get_trainer_env(hyps)
     batch_size = hyps['batch_size']
 
     ## Multi Processing
@@ -135,59 +246,97 @@ def train(rank, hyps, verbose=True):
     hyps['n_tsteps'] = hyps['batch_size']//hyps['n_runs']
     # The total number of steps included in the update
     hyps['batch_size'] = hyps['n_tsteps']*hyps['n_runs']
-    shared_data = {
-            'obsrs':     torch.zeros(hyps['batch_size'],*env.shape),
-            'rews':      torch.zeros(hyps['batch_size']),
-            "hs":   torch.zeros(hyps['batch_size'],model.h_shape[-1]),
-            "fwd_hs":   torch.zeros(hyps['batch_size']),
-            "loc_targs": torch.zeros(hyps['batch_size'],2),
-            "count_idxs":torch.zeros(hyps['batch_size']).long(),
-            "longs":     torch.zeros(hyps['batch_size'],5).long(),
-            #"color_idxs": idx 0
-            #"shape_idxs": idx 1
-            #"starts":     idx 2
-            #"dones":      idx 3
-            #"resets":     idx 4
-            }
     if fwd_dynamics:
-        shared_data['fwd_hs'] = torch.zeros(hyps['batch_size'],
-                                              fwd_model.h_shape[-1])
-    shared_data = {k:v.share_memory_() for k,v in shared_data.items()}
-    shared_data = {k:v.cuda() for k,v in shared_data.items()}
-    shared_data['obsrs'] = shared_data['obsrs'].cpu()
+        # fwd sequences never cross rollouts, so a rollout must fit at
+        # least one sequence
+        s = "n_tsteps ({}) must be at least fwd_horizon ({})"
+        s = s.format(hyps['n_tsteps'], hyps['fwd_horizon'])
+        assert hyps['n_tsteps'] >= hyps['fwd_horizon'], s
+    # The number of environments driven by each runner. Each gate
+    # signal opens the run slots of a single runner's environments
+    n_envs = try_key(hyps,'envs_per_runner',1)
+    s = "n_runs must be divisible by envs_per_runner"
+    assert hyps['n_runs'] % n_envs == 0, s
+    n_gates = hyps['n_runs']//n_envs
+    hyps['n_runners'] = try_key(hyps,'n_runners',None)
+    if hyps['n_runners'] is None: hyps['n_runners'] = hyps['n_runs']
 
-    gate_q = mp.Queue(hyps['n_runs'])
-    stop_q = mp.Queue(hyps['n_runs'])
-    end_q = mp.Queue(1)
+    # Runners fill one data buffer while the trainer trains on another
+    n_bufs = try_key(hyps,'n_data_bufs',1)
+    if hyps['n_runners'] <= 1: n_bufs = 1
+    # The maximum number of updates a rollout's weights can lag behind
+    max_lag = try_key(hyps,'max_policy_lag',None)
+    fwd_h_size = None
+    if fwd_dynamics and not defer_fwd:
+        fwd_h_size = fwd_model.h_shape[-1]
+    shared_datas = []
+    for b in range(n_bufs):
+        shared_data = make_shared_data(hyps, img_shape=env.shape,
+                                             h_size=model.h_shape[-1],
+                                             fwd_h_size=fwd_h_size)
+        shared_datas.append(shared_data)
+    # Counts the number of updates applied to the model
+    model_version = mp.Value('i', 0)
 
     # Make Runners
-    hyps['n_runners'] = try_key(hyps,'n_runners',None)
-    if hyps['n_runners'] is None: hyps['n_runners'] = hyps['n_runs']
+    # Optionally batch the runners' forward passes in a single process
+    server = None
+    use_server = try_key(hyps,'inference_server',False)
+    if use_server and hyps['n_runners'] > 1:
+        n_server_envs = hyps['n_runners']*n_envs
+        server = InferenceServer(hyps=hyps, n_envs=n_server_envs,
+                                            obs_shape=env.shape,
+                                            h_size=model.h_shape[-1],
+                                            n_clients=hyps['n_runners'])
+        server_proc = mp.Process(target=server.run, args=(model,))
+        server_proc.start()
+        if verbose:
+            print("Started inference server")
     runners = []
     for i in range(hyps['n_runners']):
-        runner = Runner(rank=i, hyps=hyps, shared_data=shared_data,
-                                           gate_q=gate_q,
-                                           stop_q=stop_q,
-                                           end_q=end_q)
+        runner = Runner(rank=i, hyps=hyps, shared_data=shared_datas,
+                                           server=server,
+                                           version=model_version)
         runners.append(runner)
-    val_runner = Runner(rank=0,hyps=hyps, shared_data=None,
-                                          gate_q=None,
-                                          stop_q=None,
-                                          end_q=None)
+    val_runner = Runner(rank=0,hyps=hyps, shared_data=None)
     val_runner.env = env
-    if len(runners) > 1:
-        procs = []
-        for i in range(len(runners)):
-            args = (model,True,fwd_model)
-            proc = mp.Process(target=runners[i].run, args=args)
-            procs.append(proc)
-            proc.start()
+    # Optionally validate in a separate process during training
+    evaluator = None
+    pending = dict()
+    if try_key(hyps,'async_validation',False):
+        evaluator = Evaluator(hyps)
+        evaluator.start()
+        if verbose:
+            print("Started evaluator")
+    use_pool = len(runners) > 1 or try_key(hyps,'runner_pool',False)
+    if (shared_val or evaluator is not None) and\
+                            (use_pool or n_envs > 1):
+        # The trainer's env was only needed for the shapes. Validation
+        # runs on the runners' envs or in the evaluator. The env is
+        # closed before the runners launch theirs
+        env.close()
+        env = None
+        val_runner.env = None
+    pool = None
+    if use_pool:
+        pool = RunnerPool(runners, n_bufs=n_bufs, n_gates=n_gates,
+                  timeout=try_key(hyps,'runner_timeout',None),
+                  step_timeout=try_key(hyps,'step_timeout',None),
+                  rollout_timeout=try_key(hyps,'rollout_timeout',None),
+                  refill_failed=try_key(hyps,'refill_failed_slots',False))
         if verbose:
             print("Waiting for environments to load")
-        for i in range(len(runners)):
-            stop_q.get()
-    else:
+        pool.start(model, None if defer_fwd else fwd_model)
+    elif n_envs == 1:
         runner.env = env
+        if runner.use_vec:
+            runner.env = environments.VecEnv([env])
+    stager = BatchStager()
+    if defer_fwd:
+        # The last fwd h vector of each environment's most recent run
+        n_fwd_envs = hyps['n_runners']*n_envs
+        fwd_h_carry = fwd_model.reset_h(batch_size=n_fwd_envs).data
+        fwd_h_carry = fwd_h_carry.clone()
 
     if verbose:
         print("Beginning training for {}".format(hyps['save_folder']))
@@ -208,9 +357,8 @@ def train(rank, hyps, verbose=True):
     best_val_rew = -np.inf
     fwd_hs = None
     print()
-    # Start the runners
-    for i in range(hyps['n_runs']):
-        gate_q.put(i)
+    # The runners begin collecting as soon as they are started
+    buf = 0
     while epoch < hyps['n_epochs']:
         epoch += 1
         print("Epoch:{} | Model:{}".format(epoch, hyps['save_folder']))
@@ -250,29 +398,73 @@ def train(rank, hyps, verbose=True):
         optimizer.zero_grad()
         # Collect new rollouts
         done = False
+        avg_lag = 0
+        n_stale = 0
+        # The number of rollouts that were trained on. Buffers without
+        # valid slots are skipped
+        n_trained = 0
         for rollout in range(hyps['n_rollouts']):
             iter_start = time.time()
-            if len(runners) > 1:
-                # Wait for all runners to stop
-                for i in range(hyps['n_runs']):
-                    stop_q.get()
-
-            # Collect data from runners
-            rews = shared_data['rews']
-            hs = shared_data['hs']
-            obsrs = shared_data['obsrs']
-            loc_targs = shared_data['loc_targs']
-            count_idxs = shared_data['count_idxs']
+            shared_data = shared_datas[buf]
+            if pool is not None:
+                while True:
+                    # Wait for the runners to fill the current buffer
+                    while not pool.collect(buf):
+                        print("Waiting on runners for buffer", buf)
+                    lags = model_version.value-shared_data['versions']
+                    lags = lags.reshape(n_gates,-1).max(-1)[0]
+                    if max_lag is None: break
+                    # Recollect the gates that exceed the max lag
+                    stale = torch.nonzero(lags>max_lag).reshape(-1)
+                    if len(stale) == 0: break
+                    # Slots of killed runners hold data from an
+                    # earlier fill
+                    valid_stale = stale[pool.valids(buf)[stale]]
+                    if defer_fwd and len(valid_stale) > 0:
+                        # The discarded runs still advance the fwd h of
+                        # their envs so that the recollected runs
+                        # continue from it
+                        runs = valid_stale[:,None]*n_envs
+                        runs = runs+torch.arange(n_envs)
+                        calc_deferred_fwd_hs(hyps, fwd_model,
+                                             shared_data, fwd_h_carry,
+                                             runs=runs.reshape(-1))
+                    pool.release(buf, gates=stale.tolist())
+                    n_stale += len(stale)
+                valids = pool.valids(buf)
+                if not valids.any():
+                    print("No valid slots in buffer", buf)
+                    pool.release(buf)
+                    buf = (buf+1)%n_bufs
+                    continue
+                avg_lag += lags.float().mean().item()
+            n_trained += 1
+
+            # Collect data from runners. The host tensors are moved to
+            # the device in a single bulk transfer
+            keys = ["obsrs","rews","hs","loc_targs","count_idxs","longs"]
+            batch = stager.stage({k:shared_data[k] for k in keys})
+            rews = batch['rews']
+            hs = batch['hs']
+            obsrs = batch['obsrs']
+            loc_targs = batch['loc_targs']
+            count_idxs = batch['count_idxs']
             #"color_idxs": idx 0
             #"shape_idxs": idx 1
             #"starts":     idx 2
             #"dones":      idx 3
             #"resets":     idx 4
-            color_idxs = shared_data['longs'][:,0]
-            shape_idxs = shared_data['longs'][:,1]
-            starts =     shared_data['longs'][:,2]
-            dones =      shared_data['longs'][:,3]
-            resets =     shared_data['longs'][:,4]
+            color_idxs = batch['longs'][:,0]
+            shape_idxs = batch['longs'][:,1]
+            starts =     batch['longs'][:,2]
+            dones =      batch['longs'][:,3]
+            resets =     batch['longs'][:,4]
+
+            # Steps from slots of killed runners are excluded
+            step_valids = None
+            if pool is not None and not valids.all():
+                n_steps = hyps['batch_size']//n_gates
+                step_valids = valids.repeat_interleave(n_steps).cuda()
 
             # Make predictions
             if try_key(hyps,"use_bptt",False):
@@ -283,7 +475,8 @@ def train(rank, hyps, verbose=True):
                                           shape_idxs=shape_idxs,
                                           count_idxs=count_idxs)
             else:
-                pred_tup = model(obsrs.cuda(), h=hs.cuda(),
+                pred_tup = model(to_float_obs(obsrs, hyps['prep_fxn']),
+                                               h=hs,
                                                color_idx=color_idxs,
                                                shape_idx=shape_idxs,
                                                count_idx=count_idxs)
@@ -303,7 +496,8 @@ def train(rank, hyps, verbose=True):
                                    starts=starts,dones=dones,
                                    post_obj_preds=post_obj_preds,
                                    post_rew_preds=post_rew_preds,
-                                   hyps=hyps, firsts=resets)
+                                   hyps=hyps, firsts=resets,
+                                   valids=step_valids)
             loc_loss,color_loss,shape_loss,rew_loss = loss_tup[:4]
             color_acc,shape_acc = loss_tup[4:6]
             first_loc_loss,first_color_loss=loss_tup[6:8]
@@ -326,12 +520,37 @@ def train(rank, hyps, verbose=True):
             back_loss.backward()
 
             if fwd_dynamics:
-                exp_replay.add_data(shared_data)
+                new_data = {**shared_data}
+                if defer_fwd:
+                    # The slots of killed runners hold data from an
+                    # earlier fill and must not advance the h carry
+                    runs = None
+                    if step_valids is not None:
+                        runs = valids.repeat_interleave(n_envs)
+                        runs = torch.nonzero(runs).reshape(-1)
+                    fwd_hs = calc_deferred_fwd_hs(hyps, fwd_model,
+                                                 {**shared_data,**batch},
+                                                 fwd_h_carry,
+                                                 runs=runs)
+                    if runs is not None:
+                        n_tsteps = hyps['n_tsteps']
+                        full = torch.zeros(hyps['n_runs'], n_tsteps,
+                                           fwd_hs.shape[-1],
+                                           device=fwd_hs.device)
+                        fwd_hs = fwd_hs.reshape(len(runs),n_tsteps,-1)
+                        full[runs.to(full.device)] = fwd_hs
+                        fwd_hs = full.reshape(hyps['batch_size'],-1)
+                    new_data['fwd_hs'] = fwd_hs
+                if step_valids is not None:
+                    new_data = {k:v[step_valids.to(v.device)]\
+                                for k,v in new_data.items()\
+                                if len(v)==hyps['batch_size']}
+                exp_replay.add_data(new_data)
 
             # Start the runners again so they collect in the background
-            if len(runners) > 1:
-                for i in range(hyps['n_runs']):
-                    gate_q.put(i)
+            if pool is not None:
+                pool.release(buf)
+                buf = (buf+1)%n_bufs
             else:
                 runner.run(model, multi_proc=False)
 
@@ -365,6 +584,8 @@ def train(rank, hyps, verbose=True):
             if rollout % hyps['n_loss_loops'] == 0:
                 optimizer.step()
                 optimizer.zero_grad()
+                with model_version.get_lock():
+                    model_version.value += 1
 
             s = "LocL:{:.5f} | Obj:{:.5f} | {:.0f}% | t:{:.2f}"
             s = s.format(loc_loss.item(), obj_loss.item(),
@@ -373,34 +594,37 @@ def train(rank, hyps, verbose=True):
             print(s, end=len(s)//4*" " + "\r")
             if hyps['exp_name'] == "test" and rollout>=2: break
         print()
-        train_avg_loss = avg_loss / hyps['n_rollouts']
-        train_loc_loss = avg_loc_loss / hyps['n_rollouts']
-        train_color_loss = avg_color_loss / hyps['n_rollouts']
-        train_shape_loss = avg_shape_loss / hyps['n_rollouts']
-        train_rew_loss = avg_rew_loss / hyps['n_rollouts']
-        train_obj_loss = avg_obj_loss / hyps['n_rollouts']
-        train_color_acc = avg_color_acc / hyps['n_rollouts']
-        train_shape_acc = avg_shape_acc / hyps['n_rollouts']
-        train_obj_acc = avg_obj_acc / hyps['n_rollouts']
-        train_avg_rew = avg_rew / hyps['n_rollouts']
-
-        first_train_loc_loss = first_avg_loc_loss / hyps['n_rollouts']
-        first_train_color_loss=first_avg_color_loss / hyps['n_rollouts']
-        first_train_shape_loss=first_avg_shape_loss / hyps['n_rollouts']
-        first_train_rew_loss = first_avg_rew_loss / hyps['n_rollouts']
-        first_train_obj_loss = first_avg_obj_loss / hyps['n_rollouts']
-        first_train_color_acc =first_avg_color_acc / hyps['n_rollouts']
-        first_train_shape_acc =first_avg_shape_acc / hyps['n_rollouts']
-        first_train_obj_acc =  first_avg_obj_acc / hyps['n_rollouts']
-
-        last_train_loc_loss = last_avg_loc_loss / hyps['n_rollouts']
-        last_train_color_loss=last_avg_color_loss / hyps['n_rollouts']
-        last_train_shape_loss=last_avg_shape_loss / hyps['n_rollouts']
-        last_train_rew_loss = last_avg_rew_loss / hyps['n_rollouts']
-        last_train_obj_loss = last_avg_obj_loss / hyps['n_rollouts']
-        last_train_color_acc =last_avg_color_acc / hyps['n_rollouts']
-        last_train_shape_acc =last_avg_shape_acc / hyps['n_rollouts']
-        last_train_obj_acc =  last_avg_obj_acc / hyps['n_rollouts']
+        # Every buffer of the epoch may have been skipped
+        any_trained = n_trained > 0
+        n_trained = max(n_trained, 1)
+        train_avg_loss = avg_loss / n_trained
+        train_loc_loss = avg_loc_loss / n_trained
+        train_color_loss = avg_color_loss / n_trained
+        train_shape_loss = avg_shape_loss / n_trained
+        train_rew_loss = avg_rew_loss / n_trained
+        train_obj_loss = avg_obj_loss / n_trained
+        train_color_acc = avg_color_acc / n_trained
+        train_shape_acc = avg_shape_acc / n_trained
+        train_obj_acc = avg_obj_acc / n_trained
+        train_avg_rew = avg_rew / n_trained
+
+        first_train_loc_loss = first_avg_loc_loss / n_trained
+        first_train_color_loss=first_avg_color_loss / n_trained
+        first_train_shape_loss=first_avg_shape_loss / n_trained
+        first_train_rew_loss = first_avg_rew_loss / n_trained
+        first_train_obj_loss = first_avg_obj_loss / n_trained
+        first_train_color_acc =first_avg_color_acc / n_trained
+        first_train_shape_acc =first_avg_shape_acc / n_trained
+        first_train_obj_acc =  first_avg_obj_acc / n_trained
+
+        last_train_loc_loss = last_avg_loc_loss / n_trained
+        last_train_color_loss=last_avg_color_loss / n_trained
+        last_train_shape_loss=last_avg_shape_loss / n_trained
+        last_train_rew_loss = last_avg_rew_loss / n_trained
+        last_train_obj_loss = last_avg_obj_loss / n_trained
+        last_train_color_acc =last_avg_color_acc / n_trained
+        last_train_shape_acc =last_avg_shape_acc / n_trained
+        last_train_obj_acc =  last_avg_obj_acc / n_trained
 
         s = "Train- Loss:{:.5f} | Loc:{:.5f} | Rew:{:.5f}\n"
         s +="Train- Obj Loss:{:.5f} | Obj Acc:{:.5f}\n"
@@ -408,10 +632,25 @@ def train(rank, hyps, verbose=True):
                                                 train_avg_rew,
                                                 train_obj_loss,
                                                 train_obj_acc)
+        if n_bufs > 1 or max_lag is not None:
+            s = "Train- Policy Lag:{:.3f} | Stale Slots:{}\n"
+            stats_string += s.format(avg_lag/n_trained, n_stale)
+        if pool is not None:
+            stats = pool.stats()
+            s = "Slots- Fill:{:.3f}s | Max Fill:{:.3f}s | Queued:{:.3f}s"
+            s += " | Trainer Wait:{:.3f}s\n"
+            stats_string += s.format(stats['fill'], stats['max_fill'],
+                                                    stats['queued'],
+                                                    stats['collect_wait'])
+            s = "Runners- Restarts:{} | Lost Slots:{} | Lost Time:{:.3f}s\n"
+            stats_string += s.format(stats['restarts'], stats['lost'],
+                                                        stats['lost_time'])
         # Sample images
-        rand = int(np.random.randint(0,len(obsrs)))
-        obs = obsrs[rand].permute(1,2,0).cpu().data.numpy()/6+0.5
-        plt.imsave("imgs/sample"+str(epoch)+".png", obs)
+        if any_trained:
+            rand = int(np.random.randint(0,len(obsrs)))
+            obs = to_float_obs(obsrs[rand], hyps['prep_fxn'])
+            obs = obs.permute(1,2,0).cpu().data.numpy()/6+0.5
+            imsave("imgs/sample"+str(epoch)+".png", obs)
 
         # Fwd dynamics loss
         train_fwd_loss,train_obs_loss,train_state_loss = 0,0,0
@@ -437,56 +676,39 @@ def train(rank, hyps, verbose=True):
                                      train_over_loss)
 
             # Sample images
-            obs_preds = obs_preds.reshape(-1,*obs_preds.shape[-3:])
-            rand = int(np.random.randint(0,len(obs_preds)))
-            #obs = preds[rand].permute(1,2,0).cpu().data.numpy()/6+0.5
-            obs = obs_preds[rand].permute(1,2,0).cpu().data.numpy()
-            if not try_key(hyps,'end_sigmoid', False): obs = obs/6+0.5
-            obs = np.clip(obs, 0, 1)
-            path = os.path.join(hyps['save_folder'],
-                               "pred_sample"+str(epoch)+".png")
-            plt.imsave(path, obs)
-        print("Evaluating")
-        done = True
-        model.eval()
-        val_runner.model = model
-        val_runner.fwd_model = DummyFwdModel() if fwd_model is None\
+            if obs_preds is not None:
+                obs_preds = obs_preds.reshape(-1,*obs_preds.shape[-3:])
+                rand = int(np.random.randint(0,len(obs_preds)))
+                obs = obs_preds[rand].permute(1,2,0).cpu().data.numpy()
+                if not try_key(hyps,'end_sigmoid', False):
+                    obs = obs/6+0.5
+                obs = np.clip(obs, 0, 1)
+                path = os.path.join(hyps['save_folder'],
+                                   "pred_sample"+str(epoch)+".png")
+                imsave(path, obs)
+        if evaluator is None and shared_val and pool is not None:
+            print("Evaluating")
+            model.eval()
+            loss_tup = pool.validate(n_tsteps=200)
+        elif evaluator is None and shared_val:
+            print("Evaluating")
+            model.eval()
+            runner.model = model
+            runner.fwd_model = DummyFwdModel() if fwd_model is None\
                                                else fwd_model
-        with torch.no_grad():
-            loss_tup = val_runner.rollout(0,validation=True,n_tsteps=200)
-            loss_tup = [x.item() for x in loss_tup]
-            val_loc_loss,val_color_loss,val_shape_loss = loss_tup[:3]
-            val_rew_loss,val_color_acc,val_shape_acc = loss_tup[3:6]
-            val_rew,val_fwd_loss = loss_tup[6:8]
-
-            first_val_loc_loss,first_val_color_loss = loss_tup[8:10]
-            first_val_shape_loss,first_val_rew_loss = loss_tup[10:12]
-            first_val_color_acc,first_val_shape_acc = loss_tup[12:14]
-            val_obs_loss,val_state_loss = loss_tup[14:16]
-            val_state_pred_loss,val_over_loss = loss_tup[16:18]
-            last_val_loc_loss,last_val_color_loss = loss_tup[18:20]
-            last_val_shape_loss,last_val_rew_loss = loss_tup[20:22]
-            last_val_color_acc,last_val_shape_acc = loss_tup[22:24]
-
-            val_obj_loss = ((val_color_loss + val_shape_loss)/2)
-            val_obj_acc = ((val_color_acc + val_shape_acc)/2)
-            first_val_obj_loss = ((first_val_color_loss+\
-                                   first_val_shape_loss)/2)
-            first_val_obj_acc = ( (first_val_color_acc +\
-                                   first_val_shape_acc)/2)
-            last_val_obj_loss = ((last_val_color_loss+\
-                                   last_val_shape_loss)/2)
-            last_val_obj_acc = ( (last_val_color_acc +\
-                                   last_val_shape_acc)/2)
-            temp = rew_alpha*val_loc_loss + (1-rew_alpha)*val_rew_loss
-            val_loss = alpha*temp + (1-alpha)*val_obj_loss
-
-        s = "Val- Loss:{:.5f} | Loc:{:.5f} | Rew:{:.5f}\n"
-        s +="Val- Obj Loss:{:.5f} | Obj Acc:{:.5f} | Fwd:{:.5f}\n"
-        stats_string += s.format(val_loss, val_loc_loss, val_rew,
-                                                        val_obj_loss,
-                                                        val_obj_acc,
-                                                        val_fwd_loss)
+            with torch.no_grad():
+                loss_tup = runner.validate(n_tsteps=200)
+                loss_tup = [x.item() for x in loss_tup]
+        elif evaluator is None:
+            print("Evaluating")
+            model.eval()
+            val_runner.model = model
+            val_runner.fwd_model = DummyFwdModel() if fwd_model is None\
+                                                   else fwd_model
+            with torch.no_grad():
+                loss_tup = val_runner.rollout(0,validation=True,
+                                                n_tsteps=200)
+                loss_tup = [x.item() for x in loss_tup]
 
         scheduler.step(train_avg_loss)
         optimizer.zero_grad()
@@ -530,72 +752,47 @@ def train(rank, hyps, verbose=True):
             "last_train_shape_acc":  last_train_shape_acc,
             "last_train_obj_acc":    last_train_obj_acc,
 
-            "val_loss":val_loss,
-            "val_loc_loss":val_loc_loss,
-            "val_color_loss": val_color_loss,
-            "val_shape_loss": val_shape_loss,
-            "val_rew_loss": val_rew_loss,
-            "val_obj_loss":val_obj_loss,
-            "val_color_acc": val_color_acc,
-            "val_shape_acc": val_shape_acc,
-            "val_obj_acc":val_obj_acc,
-            "val_fwd_loss":val_fwd_loss,
-            "val_obs_loss":val_obs_loss,
-            "val_state_loss":val_state_loss,
-            "val_state_pred_loss":val_state_pred_loss,
-            "val_over_loss":val_over_loss,
-
-            "first_val_loc_loss":   first_val_loc_loss,
-            "first_val_color_loss": first_val_color_loss,
-            "first_val_shape_loss": first_val_shape_loss,
-            "first_val_rew_loss":   first_val_rew_loss,
-            "first_val_obj_loss":   first_val_obj_loss,
-            "first_val_color_acc":  first_val_color_acc,
-            "first_val_shape_acc":  first_val_shape_acc,
-            "first_val_obj_acc":    first_val_obj_acc,
-
-            "last_val_loc_loss":   last_val_loc_loss,
-            "last_val_color_loss": last_val_color_loss,
-            "last_val_shape_loss": last_val_shape_loss,
-            "last_val_rew_loss":   last_val_rew_loss,
-            "last_val_obj_loss":   last_val_obj_loss,
-            "last_val_color_acc":  last_val_color_acc,
-            "last_val_shape_acc":  last_val_shape_acc,
-            "last_val_obj_acc":    last_val_obj_acc,
-
-            "train_rew":train_avg_rew,
-            "val_rew":val_rew,
             "state_dict":model.state_dict(),
             "optim_dict":optimizer.state_dict(),
         }
         if fwd_dynamics:
             save_dict['fwd_state_dict'] = fwd_model.state_dict()
             save_dict['fwd_optim_dict'] = fwd_optim.state_dict()
-        if epoch == int(hyps['n_epochs']//2):
-            save_name = "halfway"
-            save_name = os.path.join(hyps['save_folder'],save_name)
-            io.save_checkpt(save_dict, save_name, epoch, ext=".pt",
-                                       del_prev_sd=False, best=False)
-        save_name = "checkpt"
-        save_name = os.path.join(hyps['save_folder'],save_name)
-        io.save_checkpt(save_dict, save_name, epoch, ext=".pt",
-                                   del_prev_sd=hyps['del_prev_sd'],
-                                   best=(val_rew>best_val_rew))
-        best_val_rew = max(val_rew, best_val_rew)
         stats_string += "Exec time: {}\n".format(time.time()-starttime)
-        print(stats_string)
-        s = "Epoch:{} | Model:{}\n".format(epoch, hyps['save_folder'])
-        stats_string = s + stats_string
-        log_file = os.path.join(hyps['save_folder'],"training_log.txt")
-        with open(log_file,'a') as f:
-            if epoch==0:
-                dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                f.write(dt_string+"\n\n")
-            f.write(str(stats_string)+'\n')
-    if len(runners) > 1:
-        # Wait for all runners to stop
-        for i in range(hyps['n_runs']):
-            stop_q.get()
+        if evaluator is None:
+            val_stats = get_val_stats(loss_tup,alpha=alpha,
+                                               rew_alpha=rew_alpha)
+            save_dict = {**save_dict, **val_stats}
+            stats_string += get_val_string(val_stats)
+            # A disk backed replay is saved with the checkpoint so that
+            # a resumed training reopens a matching replay index
+            if fwd_dynamics and exp_replay.folder is not None:
+                exp_replay.save()
+            best_val_rew = save_epoch(hyps, save_dict, stats_string,
+                                            best_val_rew)
+        else:
+            # The checkpoint is saved once the evaluator reports the
+            # validation results for this epoch's weights
+            save_dict = snapshot_save_dict(save_dict)
+            fwd_sd = None
+            if fwd_dynamics: fwd_sd = save_dict['fwd_state_dict']
+            evaluator.submit(epoch, save_dict['state_dict'], fwd_sd)
+            pending[epoch] = (save_dict, stats_string)
+            print("Submitted epoch {} for validation".format(epoch))
+            # Saves the checkpoints of each completed validation
+            block = epoch >= hyps['n_epochs']
+            for val_epoch,loss_tup in evaluator.results(block=block):
+                val_stats = get_val_stats(loss_tup,alpha=alpha,
+                                                   rew_alpha=rew_alpha)
+                save_dict,stats_string = pending.pop(val_epoch)
+                save_dict = {**save_dict, **val_stats}
+                stats_string += get_val_string(val_stats)
+                if fwd_dynamics and exp_replay.folder is not None:
+                    exp_replay.save()
+                best_val_rew = save_epoch(hyps, save_dict, stats_string,
+                                                best_val_rew)
+    if evaluator is not None:
+        evaluator.close()
     del save_dict['state_dict']
     del save_dict['optim_dict']
     del save_dict['hyps']
@@ -603,18 +800,159 @@ def train(rank, hyps, verbose=True):
         del save_dict['fwd_state_dict']
         del save_dict['fwd_optim_dict']
     save_dict['save_folder'] = hyps['save_folder']
-    env.close()
+    if env is not None: env.close()
     del env
-    end_q.put(1)
-    if len(runners) > 1:
+    if pool is not None:
         # Stop the runners
-        for i in range(hyps['n_runs']):
-            gate_q.put(i)
-        for proc in procs:
-            proc.join()
+        pool.close()
+    if server is not None:
+        server.end_q.put(1)
+        server_proc.join()
     time.sleep(5) # Sleeping performed to let envs power down
     return save_dict
 
+def get_val_stats(loss_tup, alpha=.5, rew_alpha=.9):
+    """
+    Converts the output of a validation rollout into the val entries
+    of the save_dict.
+
+    loss_tup: list of floats
+        the values returned by Runner.rollout with validation=True
+    alpha: float
+        the weighting of the loc and rew losses against the obj loss
+    rew_alpha: float
+        the weighting of the loc loss against the rew loss
+    """
+    val_loc_loss,val_color_loss,val_shape_loss = loss_tup[:3]
+    val_rew_loss,val_color_acc,val_shape_acc = loss_tup[3:6]
+    val_rew,val_fwd_loss = loss_tup[6:8]
+
+    first_val_loc_loss,first_val_color_loss = loss_tup[8:10]
+    first_val_shape_loss,first_val_rew_loss = loss_tup[10:12]
+    first_val_color_acc,first_val_shape_acc = loss_tup[12:14]
+    val_obs_loss,val_state_loss = loss_tup[14:16]
+    val_state_pred_loss,val_over_loss = loss_tup[16:18]
+    last_val_loc_loss,last_val_color_loss = loss_tup[18:20]
+    last_val_shape_loss,last_val_rew_loss = loss_tup[20:22]
+    last_val_color_acc,last_val_shape_acc = loss_tup[22:24]
+
+    val_obj_loss = ((val_color_loss + val_shape_loss)/2)
+    val_obj_acc = ((val_color_acc + val_shape_acc)/2)
+    first_val_obj_loss = ((first_val_color_loss+\
+                           first_val_shape_loss)/2)
+    first_val_obj_acc = ( (first_val_color_acc +\
+                           first_val_shape_acc)/2)
+    last_val_obj_loss = ((last_val_color_loss+\
+                           last_val_shape_loss)/2)
+    last_val_obj_acc = ( (last_val_color_acc +\
+                           last_val_shape_acc)/2)
+    temp = rew_alpha*val_loc_loss + (1-rew_alpha)*val_rew_loss
+    val_loss = alpha*temp + (1-alpha)*val_obj_loss
+    return {
+        "val_loss":val_loss,
+        "val_loc_loss":val_loc_loss,
+        "val_color_loss": val_color_loss,
+        "val_shape_loss": val_shape_loss,
+        "val_rew_loss": val_rew_loss,
+        "val_obj_loss":val_obj_loss,
+        "val_color_acc": val_color_acc,
+        "val_shape_acc": val_shape_acc,
+        "val_obj_acc":val_obj_acc,
+        "val_fwd_loss":val_fwd_loss,
+        "val_obs_loss":val_obs_loss,
+        "val_state_loss":val_state_loss,
+        "val_state_pred_loss":val_state_pred_loss,
+        "val_over_loss":val_over_loss,
+
+        "first_val_loc_loss":   first_val_loc_loss,
+        "first_val_color_loss": first_val_color_loss,
+        "first_val_shape_loss": first_val_shape_loss,
+        "first_val_rew_loss":   first_val_rew_loss,
+        "first_val_obj_loss":   first_val_obj_loss,
+        "first_val_color_acc":  first_val_color_acc,
+        "first_val_shape_acc":  first_val_shape_acc,
+        "first_val_obj_acc":    first_val_obj_acc,
+
+        "last_val_loc_loss":   last_val_loc_loss,
+        "last_val_color_loss": last_val_color_loss,
+        "last_val_shape_loss": last_val_shape_loss,
+        "last_val_rew_loss":   last_val_rew_loss,
+        "last_val_obj_loss":   last_val_obj_loss,
+        "last_val_color_acc":  last_val_color_acc,
+        "last_val_shape_acc":  last_val_shape_acc,
+        "last_val_obj_acc":    last_val_obj_acc,
+
+        "val_rew":val_rew,
+    }
+
+def get_val_string(val_stats):
+    """
+    Returns the training log lines for the argued val stats
+    """
+    s = "Val- Loss:{:.5f} | Loc:{:.5f} | Rew:{:.5f}\n"
+    s +="Val- Obj Loss:{:.5f} | Obj Acc:{:.5f} | Fwd:{:.5f}\n"
+    return s.format(val_stats['val_loss'], val_stats['val_loc_loss'],
+                                           val_stats['val_rew'],
+                                           val_stats['val_obj_loss'],
+                                           val_stats['val_obj_acc'],
+                                           val_stats['val_fwd_loss'])
+
+def snapshot_save_dict(save_dict):
+    """
+    Returns a copy of the save_dict in which the state dicts are copied
+    to the cpu so that they are unaffected by further training.
+    """
+    save_dict = {**save_dict}
+    for k in ["state_dict", "fwd_state_dict"]:
+        if k in save_dict:
+            save_dict[k] = {name:v.detach().cpu().clone()\
+                            for name,v in save_dict[k].items()}
+    for k in ["optim_dict", "fwd_optim_dict"]:
+        if k in save_dict:
+            save_dict[k] = copy.deepcopy(save_dict[k])
+    return save_dict
+
+def save_epoch(hyps, save_dict, stats_string, best_val_rew):
+    """
+    Saves the checkpoint of a completed epoch and writes its stats to
+    the training log.
+
+    hyps: dict
+    save_dict: dict
+        must contain the val entries
+    stats_string: str
+        the epoch's log lines
+    best_val_rew: float
+        the best val_rew of the previously saved epochs
+
+    Returns:
+        best_val_rew: float
+            the best val_rew including this epoch
+    """
+    epoch = save_dict['epoch']
+    val_rew = save_dict['val_rew']
+    if epoch == int(hyps['n_epochs']//2):
+        save_name = "halfway"
+        save_name = os.path.join(hyps['save_folder'],save_name)
+        io.save_checkpt(save_dict, save_name, epoch, ext=".pt",
+                                   del_prev_sd=False, best=False)
+    save_name = "checkpt"
+    save_name = os.path.join(hyps['save_folder'],save_name)
+    io.save_checkpt(save_dict, save_name, epoch, ext=".pt",
+                               del_prev_sd=hyps['del_prev_sd'],
+                               best=(val_rew>best_val_rew))
+    best_val_rew = max(val_rew, best_val_rew)
+    print(stats_string)
+    s = "Epoch:{} | Model:{}\n".format(epoch, hyps['save_folder'])
+    stats_string = s + stats_string
+    log_file = os.path.join(hyps['save_folder'],"training_log.txt")
+    with open(log_file,'a') as f:
+        if epoch==0:
+            dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+            f.write(dt_string+"\n\n")
+        f.write(str(stats_string)+'\n')
+    return best_val_rew
+
 class DummyFwdModel(torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -631,14 +969,779 @@ class DummyFwdModel(torch.nn.Module):
         return self.h.data,self.h.data,self.h.data,self.h.data,\
                                                    self.h.data
 
+class Evaluator:
+    """
+    Runs the validation rollouts in a separate process so that
+    validation does not block training. The evaluator makes its own
+    validation env and receives versioned snapshots of the model
+    weights. Snapshots are validated in the order they are submitted
+    and the results are sent back to the trainer.
+    """
+    def __init__(self, hyps, n_tsteps=200):
+        """
+        hyps: dict
+            dict of hyperparams
+        n_tsteps: int
+            the number of steps in each validation rollout
+        """
+        self.hyps = hyps
+        self.n_tsteps = n_tsteps
+        self.snap_q = mp.Queue()
+        self.result_q = mp.Queue()
+        self.n_pending = 0
+        self.proc = None
+
+    def start(self):
+        self.proc = mp.Process(target=self.run)
+        self.proc.start()
+
+    def run(self):
+        """
+        Called within the evaluator process. Validates each snapshot
+        until a None is received.
+        """
+        hyps = {**self.hyps}
+        hyps['float_params'] = get_val_params(hyps)
+        # Only collection envs record traces
+        hyps['record_trace'] = None
+        env = environments.get_env(hyps)
+        model = getattr(models,hyps['model_class'])(**hyps)
+        model.cuda()
+        fwd_model = None
+        runner = Runner(rank=0, hyps=hyps, shared_data=None)
+        runner.env = env
+        runner.model = model
+        while True:
+            snapshot = self.snap_q.get()
+            if snapshot is None: break
+            epoch,state_dict,fwd_state_dict = snapshot
+            model.load_state_dict(state_dict)
+            model.eval()
+            runner.fwd_model = DummyFwdModel()
+            if fwd_state_dict is not None:
+                if fwd_model is None:
+                    fwd_model = getattr(models,hyps['fwd_class'])(**hyps)
+                fwd_model.load_state_dict(fwd_state_dict)
+                runner.fwd_model = fwd_model
+            # rollout moves the fwd model to the cpu after validating
+            runner.fwd_model.cuda()
+            with torch.no_grad():
+                loss_tup = runner.rollout(0,validation=True,
+                                            n_tsteps=self.n_tsteps)
+                loss_tup = [x.item() for x in loss_tup]
+            self.result_q.put((epoch, loss_tup))
+        env.close()
+
+    def submit(self, epoch, state_dict, fwd_state_dict=None):
+        """
+        Sends a snapshot of the weights to the evaluator.
+
+        epoch: int
+            the version of the weights
+        state_dict: dict
+            the model's state dict. must be a copy on the cpu
+        fwd_state_dict: dict or None
+            the fwd model's state dict. must be a copy on the cpu
+        """
+        self.snap_q.put((epoch, state_dict, fwd_state_dict))
+        self.n_pending += 1
+
+    def results(self, block=False, check_interval=1):
+        """
+        Returns the validation results that have been completed.
+
+        block: bool
+            if true, waits for all submitted snapshots to be validated.
+            raises a RuntimeError if the evaluator process dies first
+        check_interval: float
+            the number of seconds between checks that the evaluator
+            process is alive while blocking
+
+        Returns:
+            results: list of tuples (epoch, loss_tup)
+                in the order that the snapshots were submitted
+        """
+        results = []
+        while self.n_pending > 0:
+            try:
+                if block:
+                    result = self.result_q.get(timeout=check_interval)
+                else:
+                    result = self.result_q.get(block=False)
+                results.append(result)
+                self.n_pending -= 1
+            except Empty:
+                if not block: break
+                if self.proc is None or not self.proc.is_alive():
+                    s = "evaluator died with {} snapshots pending"
+                    raise RuntimeError(s.format(self.n_pending))
+        return results
+
+    def close(self):
+        self.snap_q.put(None)
+        if self.proc is not None:
+            self.proc.join()
+
+class InferenceServer:
+    """
+    Batches the forward passes of all of the runners into a single
+    model call. Runners write their observations into shared request
+    buffers, number the request in a shared sequence, and signal the
+    server through the request semaphore. The server gathers requests
+    until every runner is waiting or until the max wait deadline
+    expires, performs a single forward pass over all of the gathered
+    environments, and writes the predictions into shared response
+    buffers. The hidden state of each environment is kept on the
+    server.
+
+    Signalling is done through semaphores and shared tensors rather
+    than queues so that a runner killed by the RunnerPool cannot leave
+    a lock held. The sequences continue across respawns, so a
+    respawned runner skips the response to its predecessor's request.
+    """
+    def __init__(self, hyps, n_envs, obs_shape, h_size, n_clients):
+        """
+        hyps: dict
+            dict of hyperparams
+        n_envs: int
+            the total number of environments that will be served. Each
+            environment is identified by an env_id in [0,n_envs)
+        obs_shape: tuple of ints (C,H,W)
+            the shape of the observations
+        h_size: int
+            the size of the model's hidden state
+        n_clients: int
+            the number of runners making requests. Each runner is
+            identified by its rank
+        """
+        self.hyps = hyps
+        self.n_envs = n_envs
+        self.n_clients = n_clients
+        # Maximum number of seconds to wait for a full batch
+        self.max_wait = try_key(hyps,'server_max_wait',0.005)
+        self.prep_fxn = try_key(hyps,'prep_fxn','center_zero2one')
+        dtype = torch.float
+        if try_key(hyps,'uint8_obs',False): dtype = torch.uint8
+        self.obsrs = torch.zeros(n_envs,*obs_shape,dtype=dtype)
+        self.obsrs.share_memory_()
+        #"color_idxs": idx 0
+        #"shape_idxs": idx 1
+        #"count_idxs": idx 2
+        self.idxs = torch.zeros(n_envs,3).long().share_memory_()
+        self.resets = torch.zeros(n_envs).long().share_memory_()
+        self.preds = torch.zeros(n_envs,2).share_memory_()
+        self.hs = torch.zeros(n_envs,h_size).share_memory_()
+        # 1 for each environment awaiting a forward pass
+        self.requests = torch.zeros(n_envs).long().share_memory_()
+        # The sequence numbers of each runner's latest request and of
+        # the latest request that was answered
+        self.req_seqs = torch.zeros(n_clients).long().share_memory_()
+        self.resp_seqs = torch.zeros(n_clients).long().share_memory_()
+        self.req_sem = mp.Semaphore(0)
+        self.resp_sems = [mp.Semaphore(0) for i in range(n_clients)]
+        self.end_q = mp.Queue(1)
+
+    def run(self, model):
+        """
+        Call this function for starting the server process.
+
+        model: torch Module
+            the shared model used for the forward passes
+        """
+        model.eval()
+        # The hidden states never leave the server's device
+        hs = model.reset_h(batch_size=self.n_envs).data.to(DEVICE)
+        with torch.no_grad():
+            while self.end_q.empty():
+                if not self.req_sem.acquire(timeout=1): continue
+                deadline = time.time() + self.max_wait
+                while not (self.req_seqs>self.resp_seqs).all():
+                    remaining = deadline - time.time()
+                    if remaining <= 0: break
+                    if not self.req_sem.acquire(timeout=remaining):
+                        break
+                # The sequences are read before the requested envs.
+                # Runners flag their envs before numbering the request
+                seqs = self.req_seqs.clone()
+                ranks = torch.nonzero(seqs>self.resp_seqs).reshape(-1)
+                if len(ranks) == 0: continue
+                env_ids = torch.nonzero(self.requests).reshape(-1)
+                self.requests[env_ids] = 0
+                if len(env_ids) > 0:
+                    self.forward(model, hs, env_ids)
+                for rank in ranks.tolist():
+                    self.resp_seqs[rank] = seqs[rank]
+                    self.resp_sems[rank].release()
+
+    def forward(self, model, hs, env_ids):
+        """
+        Performs a single forward pass over the argued environments
+        and writes the results into the shared response buffers.
+
+        model: torch Module
+        hs: torch float tensor (N_ENVS,E)
+            the hidden states of all environments on the server's
+            device. updated in place
+        env_ids: torch long tensor (K,)
+        """
+        dev_ids = env_ids.to(DEVICE)
+
+        resets = self.resets[env_ids].bool().to(DEVICE)
+        h_inits = model.reset_h(batch_size=len(env_ids)).data
+        h = torch.where(resets[:,None],h_inits.to(DEVICE),
+                                       hs[dev_ids])
+        obs = self.obsrs[env_ids].to(DEVICE)
+        obs = to_float_obs(obs, self.prep_fxn)
+        idxs = self.idxs[env_ids].to(DEVICE)
+        tup = model(obs, h, color_idx=idxs[:,0:1],
+                            shape_idx=idxs[:,1:2],
+                            count_idx=idxs[:,2:3])
+        hs[dev_ids] = model.h.data
+
+        self.preds[env_ids] = tup[0].cpu()
+        self.hs[env_ids] = model.h.cpu()
+
+    def infer(self, rank, env_ids, obsrs, targs, resets):
+        """
+        Called from within the runner processes. Sends the observations
+        to the server and blocks until the predictions are returned.
+
+        K = len(env_ids)
+
+        rank: int
+            the rank of the requesting runner
+        env_ids: list of ints (K,)
+            the ids of the environments making the request
+        obsrs: torch float tensor (K,C,H,W)
+            the observations
+        targs: torch float tensor (K,4) or (K,5)
+            the most recent targets. the color, shape, and count indices
+            are read from these
+        resets: list of ints (K,)
+            a 1 indicates that the hidden state of the corresponding
+            environment should be reset before the forward pass
+
+        Returns:
+            preds: torch float tensor (K,2)
+                the location predictions
+            hs: torch float tensor (K,E)
+                the hidden states following the forward pass
+        """
+        ids = torch.LongTensor(env_ids)
+        self.obsrs[ids] = obsrs.cpu()
+        targs = targs.cpu().long()
+        self.idxs[ids,:2] = targs[:,2:4]
+        if targs.shape[1] >= 5:
+            self.idxs[ids,2] = targs[:,4]
+        self.resets[ids] = torch.LongTensor(resets)
+        self.requests[ids] = 1
+        seq = self.req_seqs[rank].item()+1
+        self.req_seqs[rank] = seq
+        self.req_sem.release()
+        while True:
+            self.resp_sems[rank].acquire()
+            # Responses to the requests of a killed predecessor are
+            # skipped
+            if self.resp_seqs[rank].item() >= seq: break
+        return self.preds[ids].clone(), self.hs[ids].clone()
+
+def kill_proc_tree(pid, children=[]):
+    """
+    Kills the process with the argued pid along with all of its child
+    processes, which includes any Unity processes started by a runner.
+
+    pid: int
+    children: list of psutil Processes
+        previously recorded child processes. These are killed as well
+        in case they were orphaned by the death of their parent
+    """
+    procs = [*children]
+    try:
+        parent = psutil.Process(pid)
+        procs = parent.children(recursive=True) + [parent] + procs
+    except psutil.NoSuchProcess:
+        pass
+    for proc in procs:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+class SlotRing:
+    """
+    A ring of run slots held in shared memory. Each data buffer is
+    split into n_gates slots, where each slot holds the runs of a single
+    runner's environments. Slots cycle through the states FREE, FILLING,
+    and READY. Runners claim FREE slots in the order in which they were
+    released and mark them READY once filled. The trainer waits for all
+    slots of a buffer to be READY and then releases them. All waiting
+    is performed on a single shared condition.
+
+    Slots that are marked READY without having been filled are flagged
+    as invalid in the valids array.
+    """
+    FREE = 0
+    FILLING = 1
+    READY = 2
+    # Returned by claim to the rank 0 runner when a validation rollout
+    # has been requested
+    VALIDATE = -1
+
+    def __init__(self, n_bufs, n_gates, n_runners=1):
+        """
+        n_bufs: int
+            the number of shared data buffers
+        n_gates: int
+            the number of slots in each buffer
+        n_runners: int
+            the number of runners that claim slots from the ring
+        """
+        self.n_bufs = n_bufs
+        self.n_gates = n_gates
+        n_slots = n_bufs*n_gates
+        self.n_slots = n_slots
+        self.states = torch.zeros(n_slots).long().share_memory_()
+        # The release order of the slots. Lowest is claimed first
+        self.seqs = torch.arange(n_slots).long().share_memory_()
+        self.owners = torch.full((n_slots,), -1).long().share_memory_()
+        # release, claim, and ready timestamps for each slot
+        self.times = torch.zeros(n_slots,3).double().share_memory_()
+        self.times[:,0] = time.time()
+        self.valids = torch.ones(n_slots).long().share_memory_()
+        # The time of each runner's most recent step
+        self.heartbeats = torch.zeros(n_runners).double().share_memory_()
+        # The number of rollouts collected by each rank. Kept in the
+        # ring so that the rollout ids of a respawned runner continue
+        # from those of the runner it replaced
+        self.n_rollouts = torch.zeros(n_runners).long().share_memory_()
+        self.n_loaded = mp.Value('i', 0)
+        # The n_tsteps of a requested validation rollout. 0 if none
+        self.val_request = mp.Value('i', 0)
+        self.val_q = mp.Queue()
+        self.cond = mp.Condition()
+        self.stop_event = mp.Event()
+
+    def buf_slots(self, buf):
+        """
+        Returns the slot indices belonging to the argued buffer
+        """
+        return torch.arange(buf*self.n_gates, (buf+1)*self.n_gates)
+
+    def claim(self, rank, timeout=1):
+        """
+        Called from the runners. Blocks until a FREE slot is available
+        and marks it as FILLING.
+
+        rank: int
+            the rank of the claiming runner
+        timeout: float
+            the number of seconds between checks of the stop event
+
+        Returns:
+            slot: int or None
+                the claimed slot. None is returned if the ring has been
+                stopped. VALIDATE is returned to the rank 0 runner if
+                a validation rollout has been requested
+        """
+        with self.cond:
+            while not self.stop_event.is_set():
+                if rank == 0 and self.val_request.value > 0:
+                    return self.VALIDATE
+                free = torch.nonzero(self.states==self.FREE).reshape(-1)
+                if len(free) > 0:
+                    slot = int(free[torch.argmin(self.seqs[free])])
+                    self.states[slot] = self.FILLING
+                    self.owners[slot] = rank
+                    self.times[slot,1] = time.time()
+                    self.heartbeats[rank] = self.times[slot,1]
+                    return slot
+                self.cond.wait(timeout)
+        return None
+
+    def ready(self, slot):
+        """
+        Called from the runners once a slot has been filled.
+
+        slot: int
+        """
+        with self.cond:
+            self.states[slot] = self.READY
+            self.owners[slot] = -1
+            self.times[slot,2] = time.time()
+            self.valids[slot] = 1
+            self.cond.notify_all()
+
+    def beat(self, rank):
+        """
+        Called from the runners after each environment step.
+
+        rank: int
+            the rank of the runner
+        """
+        self.heartbeats[rank] = time.time()
+
+    def loaded(self):
+        """
+        Called from the runners once their environments are made.
+        """
+        with self.cond:
+            self.n_loaded.value += 1
+            self.cond.notify_all()
+
+    def request_validation(self, n_tsteps):
+        """
+        Called from the trainer. Requests a validation rollout from the
+        rank 0 runner.
+
+        n_tsteps: int
+        """
+        with self.cond:
+            self.val_request.value = n_tsteps
+            self.cond.notify_all()
+
+    def validated(self, loss_tup):
+        """
+        Called from the rank 0 runner with the results of a requested
+        validation rollout.
+
+        loss_tup: list of floats
+        """
+        with self.cond:
+            self.val_request.value = 0
+            self.val_q.put(loss_tup)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stop_event.set()
+            self.cond.notify_all()
+
+class RunnerPool:
+    """
+    Manages the runner processes. Collection is coordinated through a
+    SlotRing so that the trainer only ever waits on a single condition
+    per buffer rather than signalling each run slot through queues.
+
+    Use `collect(buf)` to wait for a buffer to be filled and
+    `release(buf)` to hand the buffer back to the runners.
+
+    While waiting in collect, the pool acts as a watchdog over the
+    runners. A runner that has crashed, or that holds a slot past the
+    step or rollout deadlines, is killed along with its Unity process
+    and a fresh runner is spawned in its place. The slots held by the
+    killed runner are either marked READY and invalid or handed back
+    to the ring to be refilled.
+    """
+    def __init__(self, runners, n_bufs, n_gates, timeout=None,
+                                                 step_timeout=None,
+                                                 rollout_timeout=None,
+                                                 refill_failed=False,
+                                                 check_interval=1):
+        """
+        runners: list of Runners
+            the runners to be managed. each runner is started in its own
+            process
+        n_bufs: int
+            the number of shared data buffers
+        n_gates: int
+            the number of slots in each buffer
+        timeout: float or None
+            the number of seconds that collect waits before returning
+            false. Also used as the join timeout when closing the pool.
+            If None, waits indefinitely
+        step_timeout: float or None
+            the maximum number of seconds a runner may go without
+            completing an environment step while it holds a slot. If
+            None, no step deadline is enforced
+        rollout_timeout: float or None
+            the maximum number of seconds a runner may hold a slot. If
+            None, no rollout deadline is enforced
+        refill_failed: bool
+            if true, the slots of killed runners are handed back to the
+            ring ahead of all other slots to be refilled. Otherwise
+            they are marked READY and invalid so that the trainer does
+            not wait on them
+        check_interval: float
+            the number of seconds between watchdog checks while waiting
+            in collect. crashed runners are always detected, hung
+            runners only if step_timeout or rollout_timeout is set
+        """
+        self.runners = runners
+        self.n_bufs = n_bufs
+        self.n_gates = n_gates
+        self.timeout = timeout
+        self.step_timeout = step_timeout
+        self.rollout_timeout = rollout_timeout
+        self.refill_failed = refill_failed
+        self.check_interval = check_interval
+        self.ring = SlotRing(n_bufs=n_bufs, n_gates=n_gates,
+                                            n_runners=len(runners))
+        for runner in self.runners:
+            runner.ring = self.ring
+        self.procs = []
+        # The most recently recorded child processes of each runner
+        self.children = [[] for r in runners]
+        self.model = None
+        self.fwd_model = None
+        self.n_restarts = 0
+        self.reset_stats()
+
+    def start(self, model, fwd_model=None):
+        """
+        Starts the runner processes and waits for their environments
+        to load.
+
+        model: torch Module
+        fwd_model: torch Module or None
+        """
+        self.model = model
+        self.fwd_model = fwd_model
+        for runner in self.runners:
+            self.procs.append(self.spawn(runner))
+        with self.ring.cond:
+            while self.ring.n_loaded.value < len(self.runners):
+                self.ring.cond.wait(1)
+        for rank in range(len(self.runners)):
+            self.track_children(rank)
+
+    def collect(self, buf, timeout=None):
+        """
+        Blocks until each slot in the argued buffer is READY.
+
+        buf: int
+            the index of the buffer
+        timeout: float or None
+            overrides the pool's timeout if not None
+
+        Returns:
+            ready: bool
+                false if the timeout expired before the buffer was
+                filled
+        """
+        timeout = self.timeout if timeout is None else timeout
+        slots = self.ring.buf_slots(buf)
+        start = time.time()
+        is_ready = lambda: bool((self.ring.states[slots]==\
+                                 SlotRing.READY).all())
+        # The runners are always checked for crashes. Hangs are only
+        # detected if a step or rollout timeout is set
+        while True:
+            wait = self.check_interval
+            if timeout is not None:
+                remaining = timeout-(time.time()-start)
+                wait = max(0, min(wait, remaining))
+            with self.ring.cond:
+                ready = self.ring.cond.wait_for(is_ready, timeout=wait)
+            if ready: break
+            self.check()
+            if timeout is not None and time.time()-start >= timeout:
+                break
+        self.collect_wait += time.time()-start
+        if ready:
+            times = self.ring.times[slots]
+            fills = times[:,2]-times[:,1]
+            self.fill_time += fills.sum().item()
+            self.max_fill = max(self.max_fill, fills.max().item())
+            self.queued_time += (times[:,1]-times[:,0]).sum().item()
+            self.n_collected += len(slots)
+        return ready
+
+    def release(self, buf, gates=None):
+        """
+        Hands the slots of the argued buffer back to the runners.
+
+        buf: int
+            the index of the buffer
+        gates: list of ints or None
+            the gate indices within the buffer to release. if None, all
+            slots in the buffer are released
+        """
+        slots = self.ring.buf_slots(buf)
+        if gates is not None:
+            slots = slots[gates]
+        with self.ring.cond:
+            seq = self.ring.seqs.max().item()+1
+            self.ring.seqs[slots] = torch.arange(seq, seq+len(slots))
+            self.ring.times[slots,0] = time.time()
+            self.ring.states[slots] = SlotRing.FREE
+            self.ring.cond.notify_all()
+
+    def valids(self, buf):
+        """
+        Returns a bool tensor (n_gates,) indicating which slots of the
+        argued buffer hold valid data
+        """
+        return self.ring.valids[self.ring.buf_slots(buf)].bool()
+
+    def spawn(self, runner):
+        """
+        Starts the argued runner in a new process.
+
+        runner: Runner
+        """
+        args = (self.model,True,self.fwd_model)
+        proc = mp.Process(target=runner.run, args=args)
+        proc.start()
+        return proc
+
+    def track_children(self, rank):
+        """
+        Records the child processes of the argued runner so that they
+        can be killed even if the runner dies.
+
+        rank: int
+        """
+        try:
+            proc = psutil.Process(self.procs[rank].pid)
+            self.children[rank] = proc.children(recursive=True)
+        except psutil.NoSuchProcess:
+            pass
+
+    def check(self):
+        """
+        Respawns each runner that has crashed or that has exceeded the
+        step or rollout deadline on a slot that it holds.
+        """
+        for rank in range(len(self.runners)):
+            now = time.time()
+            with self.ring.cond:
+                # The lock ensures the runner is not within the ring
+                # when it is killed
+                owned = (self.ring.owners==rank)&\
+                        (self.ring.states==SlotRing.FILLING)
+                owned = torch.nonzero(owned).reshape(-1)
+                hung = False
+                if len(owned) > 0:
+                    if self.step_timeout is not None:
+                        beat = self.ring.heartbeats[rank].item()
+                        hung = now-beat > self.step_timeout
+                    if self.rollout_timeout is not None:
+                        claim = self.ring.times[owned,1].min().item()
+                        hung = hung or now-claim > self.rollout_timeout
+                crashed = not self.procs[rank].is_alive()
+                if not hung and not crashed:
+                    self.track_children(rank)
+                    continue
+                kill_proc_tree(self.procs[rank].pid, self.children[rank])
+                self.children[rank] = []
+                self.fail_slots(owned, now)
+            self.procs[rank].join(timeout=self.timeout)
+            s = "Runner {} {}, respawning".format(rank,
+                                       "crashed" if crashed else "hung")
+            print(s)
+            self.n_restarts += 1
+            self.procs[rank] = self.spawn(self.runners[rank])
+
+    def validate(self, n_tsteps=200):
+        """
+        Has the rank 0 runner perform a validation rollout on its own
+        environment with the current weights of the shared model. The
+        runner serves the request between collection rollouts. Blocks
+        until the results arrive.
+
+        n_tsteps: int
+            the number of steps in the validation rollout
+
+        Returns:
+            loss_tup: list of floats
+                See Runner.rollout
+        """
+        self.ring.request_validation(n_tsteps)
+        while True:
+            try:
+                return self.ring.val_q.get(timeout=self.check_interval)
+            except Empty:
+                self.check()
+
+    def fail_slots(self, slots, now):
+        """
+        Handles the slots of a killed runner. Must be called while
+        holding the ring's condition.
+
+        slots: long tensor
+            the slots that were held by the killed runner
+        now: float
+            the time of the failure
+        """
+        ring = self.ring
+        for slot in slots.tolist():
+            self.lost_time += now-ring.times[slot,1].item()
+            self.n_lost += 1
+            ring.owners[slot] = -1
+            if self.refill_failed:
+                ring.seqs[slot] = ring.seqs.min().item()-1
+                ring.times[slot,0] = now
+                ring.states[slot] = SlotRing.FREE
+            else:
+                ring.times[slot,2] = now
+                ring.valids[slot] = 0
+                ring.states[slot] = SlotRing.READY
+        ring.cond.notify_all()
+
+    def reset_stats(self):
+        self.fill_time = 0
+        self.max_fill = 0
+        self.queued_time = 0
+        self.collect_wait = 0
+        self.n_collected = 0
+        self.lost_time = 0
+        self.n_lost = 0
+
+    def stats(self, reset=True):
+        """
+        Returns the slot latency statistics accumulated since the last
+        reset.
+
+        Returns:
+            dict
+                "fill": mean seconds from claim to ready for a slot
+                "max_fill": max seconds from claim to ready for a slot
+                "queued": mean seconds from release to claim for a slot
+                "collect_wait": total seconds the trainer spent
+                    waiting in collect
+                "restarts": total number of runner respawns since the
+                    pool was started
+                "lost": number of slots held by killed runners
+                "lost_time": total seconds from claim to failure for
+                    the slots held by killed runners
+        """
+        n = max(self.n_collected, 1)
+        stats = {
+            "fill": self.fill_time/n,
+            "max_fill": self.max_fill,
+            "queued": self.queued_time/n,
+            "collect_wait": self.collect_wait,
+            "restarts": self.n_restarts,
+            "lost": self.n_lost,
+            "lost_time": self.lost_time,
+        }
+        if reset: self.reset_stats()
+        return stats
+
+    def close(self):
+        """
+        Stops the runners after their current rollouts and joins the
+        processes.
+        """
+        self.ring.stop()
+        for proc in self.procs:
+            proc.join(timeout=self.timeout)
+            if proc.is_alive():
+                proc.terminate()
+        self.procs = []
+
 class Runner:
-    def __init__(self, rank, hyps, shared_data, gate_q, stop_q, end_q):
+    def __init__(self, rank, hyps, shared_data, ring=None,
+                                                server=None,
+                                                version=None):
         """
         rank: int
             the id of the runner
         hyps: dict
             dict of hyperparams
-        shared_data: dict of shared tensors
+        shared_data: dict of shared tensors or list of dicts
+            if a list is argued, each dict is a separate data buffer
+            and the buffer to fill is specified by the claimed slot
             keys: str
                 'rews':      shared tensor
                 "hs":        shared tensor
@@ -650,22 +1753,52 @@ class Runner:
                     #"starts":     idx 2
                     #"dones":      idx 3
                     #"resets":     idx 4
-        gate_q: multi processing Queue
-            a signalling q for collection
-        stop_q: multi processing Queue
-            a signalling q to indicate the data has been collected
-        end_q: multi processing Queue
-            a signalling q to indicate that the training is complete
+        ring: SlotRing or None
+            the shared ring of slot states through which the runner
+            claims the runs it should collect. Usually set by the
+            RunnerPool. Only required if multi_proc is true
+        server: InferenceServer or None
+            if not None, the forward passes for collection rollouts
+            are performed by the server rather than within the runner
+        version: multi processing Value or None
+            the number of updates that have been applied to the model.
+            the version at the start of each rollout is recorded in
+            the 'versions' entry of the shared data
         """
         self.rank = rank
         self.hyps = hyps
-        self.shared_data = shared_data
-        self.gate_q = gate_q
-        self.stop_q = stop_q
-        self.end_q = end_q
+        if isinstance(shared_data, dict): shared_data = [shared_data]
+        self.shared_datas = shared_data
+        self.shared_data = None
+        if shared_data is not None:
+            self.shared_data = shared_data[0]
+        self.version = version
+        self.ring = ring
+        self.server = server
+        # The number of environments driven by this runner
+        self.n_envs = try_key(hyps,'envs_per_runner',1)
+        # Collection rollouts write directly into the shared arrays
+        # when using vec_rollout
+        prealloc = try_key(hyps,'prealloc_rollout',False)
+        self.use_vec = self.n_envs > 1 or prealloc
         self.env = None
         self.prev_h = None
         self.fwd_h = None
+        self.n_rollouts = 0
+        # Optional timing of each phase of collection. The histograms
+        # are periodically flushed to the save folder
+        timing = try_key(hyps,'runner_timing',False)
+        path = None
+        if timing and 'save_folder' in hyps:
+            path = "timing_runner{}.json".format(rank)
+            path = os.path.join(hyps['save_folder'], path)
+        sync_fxn = None
+        if torch.cuda.is_available(): sync_fxn = torch.cuda.synchronize
+        self.timer = PhaseTimer(path=path, enabled=timing,
+                      flush_interval=try_key(hyps,'timing_interval',60),
+                      sync_fxn=sync_fxn)
+        # Tracks if the server's copy of the h vector needs a reset
+        self.server_reset = 1
 
     def run(self, model, multi_proc=True, fwd_model=None):
         """
@@ -684,19 +1817,116 @@ class Runner:
         self.fwd_model = DummyFwdModel() if fwd_model is None\
                                          else fwd_model
         if self.env is None:
-            self.hyps['seed'] = self.hyps['seed'] + self.rank
-            self.env = environments.get_env(self.hyps)
+            self.hyps['seed'] = self.hyps['seed']+self.rank*self.n_envs
+            if self.use_vec:
+                self.env = environments.get_vec_env(self.hyps,
+                                                    self.n_envs)
+            else:
+                self.env = environments.get_env(self.hyps)
             print("env made rank:", self.rank)
-            self.stop_q.put(self.rank)
+            if self.ring is not None:
+                self.ring.loaded()
+        envs = [self.env]
+        if isinstance(self.env, environments.VecEnv):
+            envs = [self.env, *self.env.envs]
+        for env in envs: env.timer = self.timer
         if multi_proc:
-            while self.end_q.empty():
-                idx = self.gate_q.get() # Opened from main process
-                _ = self.rollout(idx)
+            while True:
+                # Returns None once the pool is closed
+                t = self.timer.start()
+                slot = self.ring.claim(self.rank)
+                self.timer.lap("claim_wait", t)
+                if slot is None: break
+                if slot == SlotRing.VALIDATE:
+                    n_tsteps = self.ring.val_request.value
+                    with torch.no_grad():
+                        loss_tup = self.validate(n_tsteps=n_tsteps)
+                    self.ring.validated([x.item() for x in loss_tup])
+                    continue
+                buf,gate_idx = divmod(slot, self.ring.n_gates)
+                self.shared_data = self.shared_datas[buf]
+                self.collect(gate_idx)
                 # Signals to main process that data has been collected
-                self.stop_q.put(idx)
+                self.ring.ready(slot)
+                self.timer.maybe_flush()
+            self.timer.flush()
             self.env.close()
         else:
-            self.rollout(0)
+            self.collect(0)
+            self.timer.maybe_flush()
+
+    def collect(self, gate_idx):
+        """
+        Performs the collection rollout for the argued gate index and
+        records the model version that was used for the rollout.
+
+        gate_idx: int
+            the gate index of the claimed slot
+        """
+        version = 0
+        if self.version is not None:
+            version = self.version.value
+        slots = self.get_slots(gate_idx)
+        if self.use_vec:
+            self.vec_rollout(slots)
+        else:
+            _ = self.rollout(slots[0])
+        self.shared_data['versions'][slots] = version
+        env_ids = [self.rank*self.n_envs+k for k in range(len(slots))]
+        self.shared_data['env_ids'][slots] = torch.LongTensor(env_ids)
+        n_rollouts = self.n_rollouts
+        if self.ring is not None:
+            n_rollouts = self.ring.n_rollouts[self.rank].item()
+            self.ring.n_rollouts[self.rank] = n_rollouts+1
+        self.shared_data['rollout_ids'][slots] = n_rollouts
+        self.n_rollouts = n_rollouts+1
+
+    def get_slots(self, gate_idx):
+        """
+        Converts a gate index into the run slots of each of the runner's
+        environments.
+
+        gate_idx: int
+            the gate index of a claimed slot
+        """
+        return [gate_idx*self.n_envs+k for k in range(self.n_envs)]
+
+    def validate(self, n_tsteps=200):
+        """
+        Performs a validation rollout on the runner's own environment.
+        The environment is switched to the validation float_params for
+        the rollout and back to the training float_params afterwards.
+        The switches take effect at resets, so the validation rollout
+        begins with a reset and the runner's environments are all reset
+        at the start of the next collection rollout. A VecEnv validates
+        on its first environment.
+
+        n_tsteps: int
+            the number of steps in the validation rollout
+
+        Returns:
+            loss_tup: tuple of tensors
+                See rollout
+        """
+        env = self.env
+        if self.use_vec:
+            s = "runner validation requires a VecEnv of separate envs"
+            assert isinstance(env, environments.VecEnv), s
+            env = env.envs[0]
+        train_params = env.float_params
+        env.set_float_params(get_val_params(self.hyps))
+        runner_env = self.env
+        self.env = env
+        self.prev_h = None
+        try:
+            loss_tup = self.rollout(0, validation=True,
+                                       n_tsteps=n_tsteps)
+        finally:
+            self.env = runner_env
+            env.set_float_params(train_params)
+            # The next collection rollout begins with a reset
+            self.prev_h = None
+        return loss_tup
 
     def rollout(self, idx, validation=False, n_tsteps=None):
         """
@@ -725,6 +1955,7 @@ class Runner:
 
         self.model.reset_h(batch_size=1)
         self.fwd_model.reset_h(batch_size=1)
+        use_server = self.server is not None and not validation
         # Prev h will only be None if this is the first rollout of the
         # training. If we ended on a done in the last session, the env
         # hasn't been restarted yet. So, we can reset here.
@@ -733,12 +1964,14 @@ class Runner:
             self.prev_rew = 0
             self.prev_done = 0
             self.prev_start = 1
+            self.server_reset = 1
             resets = [1]
         else:
             self.model.h = self.prev_h
             self.fwd_model.h = self.fwd_h
             resets = [0]
         obs = self.prev_obs.cuda()
+        prep_fxn = hyps['prep_fxn']
 
         obsrs = [obs]
         hs = [self.model.h]
@@ -756,8 +1989,10 @@ class Runner:
         shape_preds = []
         rew_preds = []
 
+        timer = self.timer
         with torch.no_grad():
             while len(rews) < n_tsteps:
+                t = timer.start()
                 temp = targs[-1].squeeze()[None].long()
                 color_idx=torch.LongTensor(temp[:,2:3])
                 shape_idx=torch.LongTensor(temp[:,3:4])
@@ -765,16 +2000,32 @@ class Runner:
                     count_idx = torch.LongTensor(temp[:,4:5]).cuda()
                 else:
                     count_idx = None
-                tup = self.model(obs[None], None, color_idx.cuda(),
-                                                  shape_idx.cuda(),
-                                                  count_idx)
-                pred,color_pred,shape_pred,rew_pred = tup
-                _ = self.fwd_model(obs[None],h=None,
+                if use_server:
+                    pred,h = self.server.infer(self.rank, [self.rank],
+                                               obs[None],
+                                               temp,
+                                               [self.server_reset])
+                    self.server_reset = 0
+                    self.model.h = h.cuda()
+                    color_pred,shape_pred,rew_pred = [],[],[]
+                else:
+                    tup = self.model(to_float_obs(obs[None], prep_fxn),
+                                                      None,
+                                                      color_idx.cuda(),
+                                                      shape_idx.cuda(),
+                                                      count_idx)
+                    pred,color_pred,shape_pred,rew_pred = tup
+                t = timer.lap("model_fwd", t, sync=True)
+                _ = self.fwd_model(to_float_obs(obs[None], prep_fxn),
+                                             h=None,
                                              color_idx=color_idx.cuda(),
                                              shape_idx=shape_idx.cuda(),
                                              count_idx=count_idx)
+                t = timer.lap("fwd_model_fwd", t, sync=True)
 
                 obs,targ,rew,done,_ = self.env.step(pred)
+                if self.ring is not None: self.ring.beat(self.rank)
+                t = timer.lap("env_step", t)
                 start = 0
                 done = int(done)
                 obs = obs.cuda()
@@ -794,6 +2045,7 @@ class Runner:
                 rews.append(rew)
                 starts.append(start)
                 dones.append(done)
+                t = timer.lap("stack", t)
 
                 if done>0 and len(rews)<n_tsteps:
                     # Finish out last step
@@ -804,26 +2056,37 @@ class Runner:
                         count_idx = torch.LongTensor(temp[:,4:5]).cuda()
                     else:
                         count_idx = None
-                    tup = self.model(obs[None], None, color_idx.cuda(),
-                                                      shape_idx.cuda(),
-                                                      count_idx)
-                    pred,color_pred,shape_pred,rew_pred = tup
-                    loc_preds.append(pred)
-                    if len(color_pred)>0:
-                        color_preds.append(color_pred)
-                        shape_preds.append(shape_pred)
-                    if rew_recog:
-                        rew_preds.append(rew_pred)
-
-                    _ = self.fwd_model(obs[None], h=None,
+                    # The predictions on the terminal observation are
+                    # only used for validation, so the server skips them
+                    if not use_server:
+                        tup = self.model(to_float_obs(obs[None],
+                                                      prep_fxn),
+                                                    None,
+                                                    color_idx.cuda(),
+                                                    shape_idx.cuda(),
+                                                    count_idx)
+                        pred,color_pred,shape_pred,rew_pred = tup
+                        loc_preds.append(pred)
+                        if len(color_pred)>0:
+                            color_preds.append(color_pred)
+                            shape_preds.append(shape_pred)
+                        if rew_recog:
+                            rew_preds.append(rew_pred)
+                    t = timer.lap("model_fwd", t, sync=True)
+
+                    _ = self.fwd_model(to_float_obs(obs[None], prep_fxn),
+                                       h=None,
                                        color_idx=color_idx.cuda(),
                                        shape_idx=shape_idx.cuda(),
                                        count_idx=count_idx)
+                    t = timer.lap("fwd_model_fwd", t, sync=True)
 
                     obs,targ = self.env.reset()
+                    t = timer.lap("env_reset", t)
                     rew = 0
                     done = 0
                     start = 1
+                    self.server_reset = 1
                     self.model.reset_h()
                     self.fwd_model.reset_h()
                     obs = obs.cuda()
@@ -837,6 +2100,7 @@ class Runner:
                     starts.append(start)
                     dones.append(done)
         dones[-1] = 1
+        t = timer.start()
 
         self.prev_h = self.model.h
         self.fwd_h = self.fwd_model.h
@@ -859,6 +2123,7 @@ class Runner:
         count_idxs = None
         if targs.shape[1] > 4:
             count_idxs = targs[:,4].long()
+        t = timer.lap("stack", t, sync=True)
 
         if not validation:
             #"color_idxs": idx 0
@@ -883,6 +2148,7 @@ class Runner:
             self.shared_data['longs'][startx:endx] = longs
             if count_idxs is not None:
                 self.shared_data['count_idxs'][startx:endx] = count_idxs
+            t = timer.lap("shared_copy", t, sync=True)
 
         if validation:
             color_idx = color_idxs[-1:]
@@ -890,7 +2156,8 @@ class Runner:
             count_idx = None
             if count_idxs is not None:
                 count_idx = count_idxs[-1:].cuda()
-            tup = self.model(obs[None], None, color_idx.cuda(),
+            tup = self.model(to_float_obs(obs[None], prep_fxn), None,
+                                              color_idx.cuda(),
                                               shape_idx.cuda(),
                                               count_idx)
             pred,color_pred,shape_pred,rew_pred = tup
@@ -934,16 +2201,20 @@ class Runner:
             over_loss = torch.zeros(1)
             if not isinstance(self.fwd_model,DummyFwdModel):
                 # Nones are required to make batch size of 1
-                data = {"obs_seq":   obsrs[None].clone(),
+                obs_seq = to_float_obs(obsrs[None].cuda(), prep_fxn)
+                data = {"obs_seq":   obs_seq.clone(),
                         "h_seq":     fwd_hs[None].clone(),
                         "start_seq": starts[None].clone(),
                         "reset_seq": resets[None].clone(),
                         "color_seq": color_idxs[None].clone(),
                         "shape_seq": shape_idxs[None].clone(),
                         "count_seq": count_idxs[None].clone()}
+                # The fwd model may be the trainer's shared cuda model, so
+                # it is returned to its own device rather than the cpu
+                fwd_device = next(self.fwd_model.parameters()).device
                 self.fwd_model.cuda()
                 tup = fwd_preds(hyps, self.fwd_model, data=data)
-                self.fwd_model.cpu()
+                self.fwd_model.to(fwd_device)
                 obs_preds,hs,mus,sigmas,mu_preds,sigma_preds = tup
                 if try_key(hyps,'end_sigmoid',False):
                     data['obs_seq'] = data['obs_seq']/6+0.5
@@ -961,7 +2232,7 @@ class Runner:
                     tup = fwd_preds(hyps,self.fwd_model,
                                     data=data,overshoot=True)
                     _,_,_,_,mu_preds,sigma_preds = tup
-                    self.fwd_model.cpu()
+                    self.fwd_model.to(fwd_device)
                     over_loss = calc_overshoot_loss(mu_truths=mus,
                                              sigma_truths=sigmas,
                                              mu_preds=mu_preds,
@@ -975,11 +2246,633 @@ class Runner:
                     last_loc_loss,last_color_loss,last_shape_loss,\
                     last_rew_loss,last_color_acc,last_shape_acc
 
+    def vec_rollout(self, idxs, n_tsteps=None):
+        """
+        Performs a collection rollout for each of the environments in
+        the runner's VecEnv using a single batched model call per step.
+        The data from the kth environment is written directly into the
+        portion of the shared arrays designated by the kth idx as it is
+        collected. The observations and h vectors are written in place
+        at each step. The remaining values are written into reusable
+        host arrays and copied to the shared arrays once at the end of
+        the rollout.
+
+        idxs: list of ints (K,)
+            identification numbers distinguishing the portions of the
+            shared arrays designated for each environment
+        n_tsteps: int
+            number of steps to take for each environment
+        """
+        hyps = self.hyps
+        n_tsteps = hyps['n_tsteps'] if n_tsteps is None else n_tsteps
+        K = len(idxs)
+        env_ids = [self.rank*self.n_envs+k for k in range(K)]
+        use_server = self.server is not None
+        dummy_fwd = isinstance(self.fwd_model,DummyFwdModel)
+
+        self.model.eval()
+        self.fwd_model.eval()
+
+        # Each environment carries its most recent entry over into the
+        # next rollout. prev_h is only None for the first rollout
+        h_init = self.model.reset_h(batch_size=1).data[0]
+        if not dummy_fwd:
+            fwd_h_init = self.fwd_model.reset_h(batch_size=1).data[0]
+        if self.prev_h is None:
+            self.prev_obs,self.prev_targ = self.env.reset()
+            self.prev_h = h_init.repeat(K,1)
+            if not dummy_fwd:
+                self.fwd_h = fwd_h_init.repeat(K,1)
+            self.prev_rew = np.zeros(K, dtype=np.float32)
+            self.prev_reset = np.ones(K, dtype=np.int64)
+            self.server_reset = [1 for k in range(K)]
+        obsrs = self.prev_obs
+        targs = self.prev_targ.numpy()
+        hs = self.prev_h
+        fwd_hs = self.fwd_h
+
+        # Views of each environment's portion of the shared arrays
+        startxs = [idx*n_tsteps for idx in idxs]
+        shared = self.shared_data
+        obs_views = [shared['obsrs'][x:x+n_tsteps] for x in startxs]
+        h_views = [shared['hs'][x:x+n_tsteps] for x in startxs]
+        fwd_views = [shared['fwd_hs'][x:x+n_tsteps] for x in startxs]
+        host = self.get_host_bufs(K, n_tsteps, targs.shape[-1])
+        ptrs = np.zeros(K, dtype=np.int64)
+        def write(k, obs, h, fwd_h, targ, rew, done, start, reset):
+            t = ptrs[k]
+            obs_views[k][t] = obs
+            h_views[k][t] = h
+            if not dummy_fwd:
+                fwd_views[k][t] = fwd_h
+            host['targs'][k,t] = targ
+            host['rews'][k,t] = rew
+            #"starts":     idx 2
+            #"dones":      idx 3
+            #"resets":     idx 4
+            host['longs'][k,t,2] = start
+            host['longs'][k,t,3] = done
+            host['longs'][k,t,4] = reset
+            ptrs[k] += 1
+
+        for k in range(K):
+            if self.prev_reset[k]:
+                hs[k] = h_init
+                if not dummy_fwd:
+                    fwd_hs[k] = fwd_h_init
+                self.prev_rew[k] = 0
+            # Starts mark the beginning of a recorded segment
+            write(k, obsrs[k], hs[k], None if dummy_fwd else fwd_hs[k],
+                     targs[k], self.prev_rew[k], 0, 1,
+                     self.prev_reset[k])
+
+        timer = self.timer
+        with torch.no_grad():
+            active = np.arange(K)
+            all_active = True
+            while len(active) > 0:
+                t = timer.start()
+                if all_active:
+                    obs = obsrs.cuda()
+                    h = hs
+                    targ = self.prev_targ
+                else:
+                    t_active = torch.from_numpy(active)
+                    obs = obsrs[t_active].cuda()
+                    h = hs[t_active.to(hs.device)]
+                    targ = torch.from_numpy(targs[active])
+                # color, shape, and count indices in a single transfer
+                cat_idxs = targ[:,2:].long().cuda()
+                color_idx = cat_idxs[:,0:1]
+                shape_idx = cat_idxs[:,1:2]
+                count_idx = cat_idxs[:,2:3] if targ.shape[1]>=5 else None
+                float_obs = to_float_obs(obs, hyps['prep_fxn'])
+                t = timer.lap("stack", t, sync=True)
+                if use_server:
+                    ids = [env_ids[k] for k in active]
+                    resets = [self.server_reset[k] for k in active]
+                    preds,new_hs = self.server.infer(self.rank, ids,
+                                                     obs, targ.long(),
+                                                     resets)
+                    for k in active: self.server_reset[k] = 0
+                    new_hs = new_hs.to(hs.device)
+                else:
+                    tup = self.model(float_obs, h, color_idx=color_idx,
+                                                   shape_idx=shape_idx,
+                                                   count_idx=count_idx)
+                    preds = tup[0]
+                    new_hs = self.model.h.data
+                t = timer.lap("model_fwd", t, sync=True)
+                new_fwd_hs = None
+                if not dummy_fwd:
+                    fwd_h = fwd_hs if all_active else\
+                            fwd_hs[t_active.to(fwd_hs.device)]
+                    _ = self.fwd_model(float_obs, h=fwd_h,
+                                            color_idx=color_idx,
+                                            shape_idx=shape_idx,
+                                            count_idx=count_idx)
+                    new_fwd_hs = self.fwd_model.h.data
+                    t = timer.lap("fwd_model_fwd", t, sync=True)
+
+                tup = self.env.step(preds, idxs=active.tolist())
+                if self.ring is not None: self.ring.beat(self.rank)
+                t = timer.lap("env_step", t)
+                step_obsrs,step_targs,step_rews,step_dones,infos = tup
+                np_targs = step_targs.numpy()
+                np_rews = step_rews.numpy()
+                np_dones = step_dones.numpy()
+                for j,k in enumerate(active):
+                    new_fwd_h = None if dummy_fwd else new_fwd_hs[j]
+                    if np_dones[j] > 0:
+                        terminal_targ = infos[j]['terminal_targ']
+                        write(k, infos[j]['terminal_obs'], new_hs[j],
+                                 new_fwd_h, terminal_targ.numpy(),
+                                 np_rews[j], 1, 0, 0)
+                        # The env has already been reset
+                        hs[k] = h_init
+                        if not dummy_fwd:
+                            fwd_hs[k] = fwd_h_init
+                        self.prev_rew[k] = 0
+                        self.prev_reset[k] = 1
+                        self.server_reset[k] = 1
+                        if ptrs[k] < n_tsteps:
+                            write(k, step_obsrs[j], h_init,
+                                     None if dummy_fwd else fwd_h_init,
+                                     np_targs[j], 0, 0, 1, 1)
+                            self.prev_reset[k] = 0
+                    else:
+                        write(k, step_obsrs[j], new_hs[j], new_fwd_h,
+                                 np_targs[j], np_rews[j], 0, 0, 0)
+                        hs[k] = new_hs[j]
+                        if not dummy_fwd:
+                            fwd_hs[k] = new_fwd_h
+                        self.prev_rew[k] = np_rews[j]
+                        self.prev_reset[k] = 0
+                    obsrs[k] = step_obsrs[j]
+                    targs[k] = np_targs[j]
+                active = active[ptrs[active] < n_tsteps]
+                all_active = len(active) == K
+                t = timer.lap("shared_copy", t, sync=True)
+
+        self.prev_obs = obsrs
+        self.prev_targ = torch.from_numpy(targs)
+        self.prev_h = hs
+        self.fwd_h = fwd_hs
+
+        # Copy the remaining data into the shared arrays
+        t = timer.start()
+        host['longs'][:,-1,3] = 1
+        host['longs'][:,:,0] = host['targs'][:,:,2]
+        host['longs'][:,:,1] = host['targs'][:,:,3]
+        for k,x in enumerate(startxs):
+            shared['rews'][x:x+n_tsteps] = host['t_rews'][k]
+            shared['loc_targs'][x:x+n_tsteps] = host['t_targs'][k,:,:2]
+            shared['longs'][x:x+n_tsteps] = host['t_longs'][k]
+            if host['targs'].shape[-1] > 4:
+                shared['count_idxs'][x:x+n_tsteps] =\
+                                      host['t_targs'][k,:,4].long()
+            if dummy_fwd:
+                fwd_views[k].zero_()
+        timer.lap("shared_copy", t, sync=True)
+
+    def get_host_bufs(self, K, n_tsteps, targ_size):
+        """
+        Returns the reusable host arrays for a vec_rollout. The numpy
+        arrays are written to during the rollout and the tensor entries
+        (prefixed with t_) share their memory.
+
+        K: int
+            the number of environments
+        n_tsteps: int
+            the number of steps per environment
+        targ_size: int
+            the length of the target vectors
+        """
+        key = (K, n_tsteps, targ_size)
+        if getattr(self, "host_bufs", None) is None or\
+                                        self.host_bufs['key'] != key:
+            host = {
+                "targs": np.zeros((K,n_tsteps,targ_size),dtype=np.float32),
+                "rews":  np.zeros((K,n_tsteps), dtype=np.float32),
+                "longs": np.zeros((K,n_tsteps,5), dtype=np.int64),
+            }
+            for k in list(host.keys()):
+                host["t_"+k] = torch.from_numpy(host[k])
+            host['key'] = key
+            self.host_bufs = host
+        return self.host_bufs
+
+class BatchStager:
+    """
+    Moves batches of host tensors to the device in a single bulk
+    transfer. Each host tensor is copied into a pinned staging buffer
+    and then copied to the device with a non-blocking copy on a side
+    stream so that the transfer overlaps with the gpu work that is
+    still queued from the previous update. Tensors that are already on
+    the device are passed through.
+
+    The device buffers are cycled over n_slots so that a transfer
+    never overwrites a batch that queued gpu work may still read. A
+    staged batch is valid until n_slots-1 more batches are staged.
+    """
+    def __init__(self, n_slots=2):
+        """
+        n_slots: int
+            the number of staging buffers to cycle over. must be at
+            least 2 for the transfers to overlap with queued gpu work
+        """
+        assert n_slots >= 1
+        self.n_slots = n_slots
+        self.slot = 0
+        self.pinned = [dict() for _ in range(n_slots)]
+        self.device_bufs = [dict() for _ in range(n_slots)]
+        # Recorded on the side stream once a slot's transfer is queued
+        self.copied = [None for _ in range(n_slots)]
+        # Recorded on the compute stream once a slot's batch is no
+        # longer in use
+        self.freed = [None for _ in range(n_slots)]
+        self.stream = None
+        if torch.cuda.is_available():
+            self.stream = torch.cuda.Stream()
+
+    def get_bufs(self, slot, k, tensor):
+        """
+        Returns the pinned and device buffers for the argued key,
+        allocating them if the tensor's shape or dtype has changed.
+
+        slot: int
+        k: str
+        tensor: torch tensor
+        """
+        pinned = self.pinned[slot].get(k, None)
+        if pinned is None or pinned.shape != tensor.shape or\
+                             pinned.dtype != tensor.dtype:
+            pinned = torch.empty(tensor.shape, dtype=tensor.dtype,
+                                 pin_memory=self.stream is not None)
+            self.pinned[slot][k] = pinned
+            self.device_bufs[slot][k] = torch.empty(tensor.shape,
+                                                    dtype=tensor.dtype,
+                                                    device=DEVICE)
+        return pinned, self.device_bufs[slot][k]
+
+    def stage(self, data):
+        """
+        Queues the transfer of the argued tensors to the device. The
+        compute stream waits on the transfer, so the returned tensors
+        can be used immediately.
+
+        data: dict of torch tensors
+
+        Returns:
+            staged: dict of torch tensors
+                the same keys as data with every tensor on the device
+        """
+        if self.stream is None:
+            return {k:v.to(DEVICE) for k,v in data.items()}
+        compute_stream = torch.cuda.current_stream()
+        # All work queued so far belongs to the previous batches, so
+        # the previously staged slot is free once it completes
+        prev = (self.slot-1)%self.n_slots
+        self.freed[prev] = compute_stream.record_event()
+        slot = self.slot
+        self.slot = (self.slot+1)%self.n_slots
+        # The host can only overwrite the pinned buffers once their
+        # last transfer has completed
+        if self.copied[slot] is not None:
+            self.copied[slot].synchronize()
+        staged = dict()
+        with torch.cuda.stream(self.stream):
+            if self.freed[slot] is not None:
+                self.stream.wait_event(self.freed[slot])
+            for k,v in data.items():
+                if v.is_cuda:
+                    staged[k] = v
+                    continue
+                pinned, device_buf = self.get_bufs(slot, k, v)
+                pinned.copy_(v)
+                device_buf.copy_(pinned, non_blocking=True)
+                staged[k] = device_buf
+            self.copied[slot] = self.stream.record_event()
+        compute_stream.wait_event(self.copied[slot])
+        return staged
+
+def make_shared_data(hyps, img_shape, h_size, fwd_h_size=None):
+    """
+    Creates a single buffer of shared tensors that the runners fill
+    with their rollouts.
+
+    hyps: dict
+        must contain 'batch_size' and 'n_runs'
+    img_shape: tuple of ints (C,H,W)
+        the shape of the observations
+    h_size: int
+        the size of the model's h vector
+    fwd_h_size: int or None
+        the size of the fwd model's h vector. if None, the fwd_hs are
+        stored as a single value for each step
+    """
+    # Observations are optionally stored as uint8 and normalized on
+    # the trainer's device
+    obs_dtype = torch.float
+    if try_key(hyps,'uint8_obs',False): obs_dtype = torch.uint8
+    shared_data = {
+            'obsrs':     torch.zeros(hyps['batch_size'],*img_shape,
+                                     dtype=obs_dtype),
+            'rews':      torch.zeros(hyps['batch_size']),
+            "hs":        torch.zeros(hyps['batch_size'],h_size),
+            "fwd_hs":    torch.zeros(hyps['batch_size']),
+            "loc_targs": torch.zeros(hyps['batch_size'],2),
+            "count_idxs":torch.zeros(hyps['batch_size']).long(),
+            "longs":     torch.zeros(hyps['batch_size'],5).long(),
+            #"color_idxs": idx 0
+            #"shape_idxs": idx 1
+            #"starts":     idx 2
+            #"dones":      idx 3
+            #"resets":     idx 4
+            }
+    if fwd_h_size is not None:
+        shared_data['fwd_hs'] = torch.zeros(hyps['batch_size'],
+                                            fwd_h_size)
+    shared_data = {k:v.share_memory_() for k,v in shared_data.items()}
+    shared_data = {k:v.cuda() for k,v in shared_data.items()}
+    shared_data['obsrs'] = shared_data['obsrs'].cpu()
+    # The model version used to collect each run
+    versions = torch.zeros(hyps['n_runs']).long()
+    shared_data['versions'] = versions.share_memory_()
+    # The environment that collected each run and the runner's rollout
+    # count at the time of collection
+    env_ids = torch.zeros(hyps['n_runs']).long()
+    shared_data['env_ids'] = env_ids.share_memory_()
+    rollout_ids = torch.zeros(hyps['n_runs']).long()
+    shared_data['rollout_ids'] = rollout_ids.share_memory_()
+    return shared_data
+
+def get_trial_hyps(hyps, config):
+    """
+    Returns a copy of the hyps updated with the argued autotune config
+    and the n_tsteps and batch_size that train derives from it.
+
+    hyps: dict
+    config: dict
+        keys: "n_runs", "n_runners", "envs_per_runner"
+    """
+    trial = {**hyps, **config}
+    # Trials must not overwrite the traces of the training runners
+    trial['record_trace'] = None
+    if trial['n_runs'] >= trial['batch_size']:
+        trial['batch_size'] = 2*trial['n_runs']
+    trial['n_tsteps'] = trial['batch_size']//trial['n_runs']
+    trial['batch_size'] = trial['n_tsteps']*trial['n_runs']
+    return trial
+
+def calibrate(hyps, model, img_shape, n_rollouts=5):
+    """
+    Collects a few buffers of rollouts with the argued settings while
+    performing a forward and backward pass on each buffer as the
+    trainer would. The first buffer is treated as a warmup and is not
+    timed.
+
+    hyps: dict
+        the hyperparameters of the trial. must contain n_tsteps
+    model: torch Module
+    img_shape: tuple of ints (C,H,W)
+    n_rollouts: int
+        the number of timed buffers to collect
+
+    Returns:
+        dict
+            "steps_per_sec": float
+                the number of environment steps collected per second
+            "trainer_util": float
+                the fraction of the time that the trainer was busy
+                rather than waiting on the runners
+    """
+    n_envs = hyps['envs_per_runner']
+    n_gates = hyps['n_runs']//n_envs
+    n_bufs = try_key(hyps,'n_data_bufs',1)
+    shared_datas = []
+    for b in range(n_bufs):
+        shared_datas.append(make_shared_data(hyps, img_shape=img_shape,
+                                             h_size=model.h_shape[-1]))
+    runners = []
+    for i in range(hyps['n_runners']):
+        runners.append(Runner(rank=i, hyps=hyps,
+                                      shared_data=shared_datas))
+    pool = RunnerPool(runners, n_bufs=n_bufs, n_gates=n_gates,
+                          timeout=try_key(hyps,'runner_timeout',None))
+    pool.start(model)
+    model.train()
+    busy = 0
+    buf = 0
+    for rollout in range(n_rollouts+1):
+        if rollout == 1: starttime = time.time()
+        while not pool.collect(buf):
+            print("Waiting on runners for buffer", buf)
+        busy_start = time.time()
+        shared_data = shared_datas[buf]
+        longs = shared_data['longs']
+        if try_key(hyps,"use_bptt",False):
+            pred_tup = bptt(hyps=hyps,model=model,
+                                      obsrs=shared_data['obsrs'],
+                                      hs=shared_data['hs'],
+                                      dones=longs[:,3],
+                                      color_idxs=longs[:,0],
+                                      shape_idxs=longs[:,1],
+                                      count_idxs=shared_data['count_idxs'])
+        else:
+            obsrs = to_float_obs(shared_data['obsrs'].cuda(),
+                                 hyps['prep_fxn'])
+            pred_tup = model(obsrs,
+                             h=shared_data['hs'].cuda(),
+                             color_idx=longs[:,0],
+                             shape_idx=longs[:,1],
+                             count_idx=shared_data['count_idxs'])
+        loss = F.mse_loss(pred_tup[0], shared_data['loc_targs'].cuda())
+        loss.backward()
+        model.zero_grad()
+        torch.cuda.synchronize()
+        pool.release(buf)
+        buf = (buf+1)%n_bufs
+        if rollout > 0: busy += time.time()-busy_start
+    elapsed = time.time()-starttime
+    pool.close()
+    return {"steps_per_sec": n_rollouts*hyps['batch_size']/elapsed,
+            "trainer_util": busy/elapsed}
+
+def autotune(hyps, model, img_shape, verbose=True):
+    """
+    Searches over n_runs, n_runners, and envs_per_runner for the
+    settings that collect the most environment steps per second. Each
+    setting is searched in turn while holding the others at their best
+    values found so far. The batch_size is held fixed, so n_tsteps
+    changes with n_runs. The best settings are written into the hyps.
+
+    The candidate values for each setting can be argued as lists in
+    hyps['autotune_grid'] under the name of the setting. The
+    candidates default to halving and doubling the current value of
+    the setting. envs_per_runner defaults to only its current value.
+    The trials are run without the inference server.
+
+    hyps: dict
+    model: torch Module
+    img_shape: tuple of ints (C,H,W)
+    verbose: bool
+
+    Returns:
+        results: list of dicts
+            the config and calibration results of each trial
+    """
+    best = {
+        "n_runs":          try_key(hyps,'n_runs',1),
+        "n_runners":       try_key(hyps,'n_runners',None),
+        "envs_per_runner": try_key(hyps,'envs_per_runner',1),
+    }
+    if best['n_runners'] is None: best['n_runners'] = best['n_runs']
+    grid = try_key(hyps,'autotune_grid',dict())
+    if grid is None: grid = dict()
+    n_rollouts = try_key(hyps,'autotune_rollouts',5)
+    results = []
+    best_speed = -np.inf
+    for key in ["n_runners", "n_runs", "envs_per_runner"]:
+        val = best[key]
+        default = [val] if key=="envs_per_runner" else\
+                  [max(val//2,1), val, 2*val]
+        candidates = try_key(grid, key, default)
+        for candidate in sorted(set(candidates)):
+            config = {**best, key: candidate}
+            if config['n_runs'] % config['envs_per_runner'] != 0:
+                continue
+            n_gates = config['n_runs']//config['envs_per_runner']
+            if config['n_runners'] > n_gates: continue
+            if any(r['config']==config for r in results): continue
+            trial = get_trial_hyps(hyps, config)
+            if verbose: print("Autotune trial:", config)
+            result = calibrate(trial, model, img_shape,
+                                      n_rollouts=n_rollouts)
+            # Let the envs power down before the next trial
+            time.sleep(5)
+            results.append({"config": config, **result})
+            if verbose:
+                s = "Steps/Sec:{:.2f} | Trainer Util:{:.3f}"
+                print(s.format(result['steps_per_sec'],
+                               result['trainer_util']))
+            if result['steps_per_sec'] > best_speed:
+                best_speed = result['steps_per_sec']
+                best = config
+    if verbose: print("Autotune best:", best)
+    set_autotune_config(hyps, results)
+    return results
+
+def set_autotune_config(hyps, results):
+    """
+    Writes the fastest config of the autotune trials into the hyps.
+    The trials are measured through a RunnerPool, so the hyps are set
+    to use a RunnerPool even if the config has a single runner.
+
+    hyps: dict
+    results: list of dicts
+        the returned results of autotune
+    """
+    if len(results) == 0: return
+    speeds = [r['steps_per_sec'] for r in results]
+    best = results[int(np.argmax(speeds))]['config']
+    for k,v in best.items():
+        hyps[k] = v
+    hyps['runner_pool'] = True
+
+def calc_deferred_fwd_hs(hyps, fwd_model, shared_data, h_carry,
+                                                      runs=None):
+    """
+    Computes the fwd model's h vectors for a buffer of collected runs
+    that were collected without a fwd model. The runs are processed in
+    waves so that each wave contains at most one run from each
+    environment. The h vectors of each wave are computed in a single
+    batched pass over the timesteps. Runs from the same environment are
+    placed in waves according to the order in which they were
+    collected so that each run continues from the last h vector of the
+    environment's previous run.
+
+    hyps: dict
+        must contain 'n_runs' and 'n_tsteps'
+    fwd_model: torch Module
+    shared_data: dict of shared tensors
+        a buffer of collected runs. must contain 'env_ids' and
+        'rollout_ids'. the obsrs, count_idxs, and longs should already
+        be on the device
+    h_carry: torch float tensor (N_ENVS,E)
+        the last h vector from each environment's most recent run. This
+        is updated in place.
+    runs: torch long tensor (R,) or None
+        if argued, only these runs of the buffer are processed. Used
+        to advance h_carry over runs that are discarded before
+        training. the runs may remain on the host
+
+    Returns:
+        fwd_hs: torch float tensor (B,E) or (R*T,E)
+            the h vector that precedes each step
+    """
+    n_runs, n_tsteps = hyps['n_runs'], hyps['n_tsteps']
+    obsrs = shared_data['obsrs'].reshape(n_runs,n_tsteps,
+                                         *shared_data['obsrs'].shape[1:])
+    count_idxs = shared_data['count_idxs'].reshape(n_runs,n_tsteps)
+    longs = shared_data['longs'].reshape(n_runs,n_tsteps,-1)
+    #"color_idxs": idx 0
+    #"shape_idxs": idx 1
+    #"resets":     idx 4
+    env_ids = shared_data['env_ids'].clone()
+    rollout_ids = shared_data['rollout_ids'].clone()
+    if runs is not None:
+        device = h_carry.device
+        obsrs = obsrs[runs.to(obsrs.device)].to(device)
+        count_idxs = count_idxs[runs.to(count_idxs.device)].to(device)
+        longs = longs[runs.to(longs.device)].to(device)
+        env_ids = env_ids[runs.to(env_ids.device)]
+        rollout_ids = rollout_ids[runs.to(rollout_ids.device)]
+        n_runs = len(runs)
+
+    # Order each environment's runs by the time of their collection
+    waves = torch.zeros(n_runs).long()
+    for env_id in torch.unique(env_ids):
+        runs = torch.nonzero(env_ids==env_id).reshape(-1)
+        order = torch.argsort(rollout_ids[runs])
+        waves[runs[order]] = torch.arange(len(runs))
+
+    fwd_hs = torch.zeros(n_runs, n_tsteps, h_carry.shape[-1],
+                                           device=h_carry.device)
+    training = fwd_model.training
+    fwd_model.eval()
+    with torch.no_grad():
+        for wave in range(waves.max().item()+1):
+            runs = torch.nonzero(waves==wave).reshape(-1)
+            ids = env_ids[runs].to(h_carry.device)
+            cuda_runs = runs.to(longs.device)
+            resets = longs[cuda_runs,:,4].bool()
+            h_init = fwd_model.reset_h(batch_size=len(runs)).data
+            h = torch.where(resets[:,:1], h_init, h_carry[ids])
+            hs = [h]
+            for i in range(n_tsteps-1):
+                obs = to_float_obs(obsrs[runs.to(obsrs.device),i],
+                                   hyps['prep_fxn'])
+                idxs = longs[cuda_runs,i]
+                count_idx = count_idxs[cuda_runs,i:i+1]
+                _ = fwd_model(obs, h=h, color_idx=idxs[:,0:1],
+                                        shape_idx=idxs[:,1:2],
+                                        count_idx=count_idx)
+                # Runners use a fresh h at the first step of an episode
+                h = torch.where(resets[:,i+1:i+2], h_init,
+                                                   fwd_model.h.data)
+                hs.append(h)
+            hs = torch.stack(hs, dim=1)
+            fwd_hs[runs.to(fwd_hs.device)] = hs
+            h_carry[ids] = hs[:,-1]
+    fwd_model.train(training)
+    return fwd_hs.reshape(n_runs*n_tsteps,-1)
+
 def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
                 loc_targs,color_targs,shape_targs,rew_targs,
                 starts,dones,
                 post_obj_preds=False, post_rew_preds=False,
-                hyps=None, firsts=None):
+                hyps=None, firsts=None, valids=None):
     """
     loc_preds: FloatTensor (N,2)
         the location predictions
@@ -1006,6 +2899,10 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
         used. aka the real start of an episode. starts can be misleading
         because they can simply indicate where a model started in again
         in a partially completed episode.
+    valids: torch bool tensor (N,) or None
+        Binary array denoting the steps that should be included in the
+        losses. Must be constant over each run. If None, all steps are
+        included.
     """
     torch.cuda.empty_cache()
     smooth_movement = False
@@ -1013,12 +2910,18 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
         smooth_movement = hyps["float_params"]["smoothMovement"]
     d_idxs = (1-dones).bool()
     s_idxs = (1-starts).bool()
+    if valids is not None:
+        valids = valids.bool().to(d_idxs.device)
+        d_idxs = d_idxs&valids
+        s_idxs = s_idxs&valids
+        if firsts is not None:
+            firsts = firsts*valids.to(firsts.device)
 
     # Loc Loss
     l_preds = loc_preds[d_idxs]
     l_targs = loc_targs[s_idxs]
     # TODO HEADS UP: Added a multiplcation factor of 10
-    loc_loss = 10*F.mse_loss(l_preds.cuda(), l_targs.cuda())
+    loc_loss = 10*F.mse_loss(l_preds, l_targs)
     if firsts is not None and not smooth_movement:
         assert hyps is not None, "if using firsts, must argue hyps"
         n_runs = hyps['n_runs']
@@ -1039,8 +2942,8 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
         with torch.no_grad():
             l_preds = loc_preds[firsts]
             l_targs = loc_targs[roll]
-            first_loc_loss = 10*F.mse_loss(l_preds.cuda(),
-                                           l_targs.cuda())
+            first_loc_loss = 10*F.mse_loss(l_preds,
+                                           l_targs)
         # Last Move Calculations
         lasts[:,0] = 0 # can't look behind starting firsts
         lastroll = torch.roll(lasts,shifts=-1,dims=1).clone().bool()
@@ -1052,20 +2955,20 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
         with torch.no_grad():
             l_preds = loc_preds[lasts]
             l_targs = loc_targs[lastroll]
-            last_loc_loss = 10*F.mse_loss(l_preds.cuda(),
-                                          l_targs.cuda())
+            last_loc_loss = 10*F.mse_loss(l_preds,
+                                          l_targs)
     else:
-        first_loc_loss = torch.zeros(1).cuda()
-        last_loc_loss = torch.zeros(1).cuda()
+        first_loc_loss = torch.zeros(1, device=loc_preds.device)
+        last_loc_loss = torch.zeros(1, device=loc_preds.device)
 
     if len(color_preds) > 0:
         idxs = d_idxs
         if post_obj_preds:
             idxs = s_idxs
-        c_preds = color_preds[idxs].squeeze().cuda()
-        s_preds = shape_preds[idxs].squeeze().cuda()
-        c_targs = color_targs[s_idxs].squeeze().cuda()
-        s_targs = shape_targs[s_idxs].squeeze().cuda()
+        c_preds = color_preds[idxs].squeeze()
+        s_preds = shape_preds[idxs].squeeze()
+        c_targs = color_targs[s_idxs].squeeze()
+        s_targs = shape_targs[s_idxs].squeeze()
 
         color_loss = F.cross_entropy(c_preds, c_targs)
         shape_loss = F.cross_entropy(s_preds, s_targs)
@@ -1078,13 +2981,13 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
             with torch.no_grad():
                 # Firsts
                 if post_obj_preds:
-                    c_preds = color_preds[roll].squeeze().cuda()
-                    s_preds = shape_preds[roll].squeeze().cuda()
+                    c_preds = color_preds[roll].squeeze()
+                    s_preds = shape_preds[roll].squeeze()
                 else:
-                    c_preds = color_preds[firsts].squeeze().cuda()
-                    s_preds = shape_preds[firsts].squeeze().cuda()
-                c_targs = color_targs[roll].squeeze().cuda()
-                s_targs = shape_targs[roll].squeeze().cuda()
+                    c_preds = color_preds[firsts].squeeze()
+                    s_preds = shape_preds[firsts].squeeze()
+                c_targs = color_targs[roll].squeeze()
+                s_targs = shape_targs[roll].squeeze()
                 if c_targs.nelement() > 0:
                     first_color_loss = F.cross_entropy(c_preds, c_targs)
                     first_shape_loss = F.cross_entropy(s_preds, s_targs)
@@ -1101,13 +3004,13 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
                 # Lasts
                 # lastroll is one step ahead of lasts
                 if post_obj_preds:
-                    c_preds = color_preds[lastroll].squeeze().cuda()
-                    s_preds = shape_preds[lastroll].squeeze().cuda()
+                    c_preds = color_preds[lastroll].squeeze()
+                    s_preds = shape_preds[lastroll].squeeze()
                 else:
-                    c_preds = color_preds[lasts].squeeze().cuda()
-                    s_preds = shape_preds[lasts].squeeze().cuda()
-                c_targs = color_targs[lastroll].squeeze().cuda()
-                s_targs = shape_targs[lastroll].squeeze().cuda()
+                    c_preds = color_preds[lasts].squeeze()
+                    s_preds = shape_preds[lasts].squeeze()
+                c_targs = color_targs[lastroll].squeeze()
+                s_targs = shape_targs[lastroll].squeeze()
                 if c_targs.nelement() > 0:
                     last_color_loss = F.cross_entropy(c_preds, c_targs)
                     last_shape_loss = F.cross_entropy(s_preds, s_targs)
@@ -1130,8 +3033,8 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
             last_color_acc = torch.zeros(1)
             last_shape_acc = torch.zeros(1)
     else:
-        color_loss = torch.zeros(1).cuda()
-        shape_loss = torch.zeros(1).cuda()
+        color_loss = torch.zeros(1, device=loc_preds.device)
+        shape_loss = torch.zeros(1, device=loc_preds.device)
         color_acc = torch.zeros(1)
         shape_acc = torch.zeros(1)
         first_color_loss = torch.zeros(1)
@@ -1149,8 +3052,8 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
             idxs = s_idxs
         r_preds = rew_preds[d_idxs]
         r_targs = rew_targs[s_idxs]
-        rew_loss = F.mse_loss(r_preds.squeeze().cuda(),
-                              r_targs.squeeze().cuda())
+        rew_loss = F.mse_loss(r_preds.squeeze(),
+                              r_targs.squeeze())
         if firsts is not None and not smooth_movement:
             with torch.no_grad():
                 # Firsts
@@ -1160,8 +3063,8 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
                     r_preds = rew_preds[firsts]
                 r_targs = rew_targs[roll]
                 if r_targs.nelement() > 0:
-                    first_rew_loss = F.mse_loss(r_preds.squeeze().cuda(),
-                                      r_targs.squeeze().cuda())
+                    first_rew_loss = F.mse_loss(r_preds.squeeze(),
+                                      r_targs.squeeze())
                 else:
                     first_rew_loss = torch.zeros(1)
                 # Lasts
@@ -1171,16 +3074,16 @@ def calc_losses(loc_preds,color_preds,shape_preds,rew_preds,
                     r_preds = rew_preds[lasts]
                 r_targs = rew_targs[lastroll]
                 if r_targs.nelement() > 0:
-                    last_rew_loss = F.mse_loss(r_preds.squeeze().cuda(),
-                                      r_targs.squeeze().cuda())
+                    last_rew_loss = F.mse_loss(r_preds.squeeze(),
+                                      r_targs.squeeze())
                 else:
                     last_rew_loss = torch.zeros(1)
         else:
             first_rew_loss = torch.zeros(1)
             last_rew_loss = torch.zeros(1)
     else:
-        rew_loss = torch.zeros(1).cuda()
-        first_rew_loss = torch.zeros(1).cuda()
+        rew_loss = torch.zeros(1, device=loc_preds.device)
+        first_rew_loss = torch.zeros(1, device=loc_preds.device)
         last_rew_loss = torch.zeros(1)
 
     return loc_loss,color_loss,shape_loss,rew_loss,color_acc,shape_acc,\
@@ -1199,6 +3102,8 @@ def bptt(hyps, model, obsrs, hs, dones, color_idxs, shape_idxs,
     R = Number of runs
     N = Number of steps per run
 
+    All tensors are expected to already be on the model's device.
+
     obsrs: torch FloatTensor (R*N,C,H,W)
         MDP states at each timestep t
     hs: FloatTensor (R*N,H)
@@ -1236,11 +3141,11 @@ def bptt(hyps, model, obsrs, hs, dones, color_idxs, shape_idxs,
         color_idx = color_idxs[:,i]
         shape_idx = shape_idxs[:,i]
         count_idx = count_idxs[:,i]
-        loc_pred,color_pred,shape_pred,rew_pred = model(obs.cuda(), 
-                                            h.cuda(),
-                                            color_idx=color_idx.cuda(),
-                                            shape_idx=shape_idx.cuda(),
-                                            count_idx=count_idx.cuda())
+        obs = to_float_obs(obs, hyps['prep_fxn'])
+        loc_pred,color_pred,shape_pred,rew_pred = model(obs, h,
+                                                  color_idx=color_idx,
+                                                  shape_idx=shape_idx,
+                                                  count_idx=count_idx)
         loc_preds.append(loc_pred)
         color_preds.append(color_pred)
         shape_preds.append(shape_pred)
@@ -1284,19 +3189,41 @@ def fwd_train_loop(hyps,fwd_model,fwd_optim,exp_replay,verbose=False):
         for the forward model parameters
     exp_replay: ExperienceReplay object
         this holds all the data to be trained on
+
+    Returns:
+        obs_loss: float
+        state_loss: float
+        state_pred_loss: float
+        over_loss: float
+        obs_preds: torch FloatTensor or None
+            the predictions of the last batch. None if the replay does
+            not yet hold any valid sequences
     """
     torch.cuda.empty_cache()
     fwd_model.train()
     grad_norm = try_key(hyps,'fwd_grad_norm',None)
     horizon = hyps['fwd_horizon']
     bsize = hyps['fwd_bsize']
-    n_loops = len(exp_replay)//bsize
+    # Only sequences that stay within a single rollout segment are
+    # sampled
+    n_valid = exp_replay.n_valid(horizon)
+    if n_valid == 0:
+        # Episodes can be shorter than the fwd_horizon
+        if len(exp_replay) >= bsize:
+            s = "Warning: no sequences of fwd_horizon steps fit in a "
+            s += "rollout segment, skipping fwd training"
+            print(s)
+        return 0, 0, 0, 0, None
+    # Early replays may hold fewer valid starts than a full batch
+    bsize = min(bsize, n_valid)
+    n_loops = n_valid//bsize
+    stager = BatchStager()
     total_obs_loss = 0
     total_state_loss = 0
     total_state_pred_loss = 0
     total_over_loss = 0
     for epoch in range(hyps['fwd_epochs']):
-        perm = torch.randperm(len(exp_replay)-horizon-1)
+        perm = torch.randperm(n_valid)
         avg_obs_loss = 0
         avg_state_loss = 0
         avg_state_pred_loss = 0
@@ -1304,7 +3231,11 @@ def fwd_train_loop(hyps,fwd_model,fwd_optim,exp_replay,verbose=False):
         iter_start = time.time()
         for b in range(n_loops):
             idxs = perm[b*bsize:(b+1)*bsize]
+            idxs = exp_replay.get_valid_idxs(idxs, horizon)
             data = exp_replay.get_data(idxs, horizon=horizon)
+            data = stager.stage(data)
+            data['obs_seq'] = to_float_obs(data['obs_seq'],
+                                           hyps['prep_fxn'])
             tup = fwd_preds(hyps, fwd_model, data=data)
             obs_preds,hs,mus,sigmas,mu_preds,sigma_preds = tup
             exp_replay.update_hs(idxs, hs.data)
@@ -1353,9 +3284,9 @@ def fwd_train_loop(hyps,fwd_model,fwd_optim,exp_replay,verbose=False):
         arr = [data['obs_seq'][0,1].cpu(),obs_preds[0,1].cpu()]
         temp = torch.cat(arr,dim=-1).permute(1,2,0).data.numpy()
         if try_key(hyps,'end_sigmoid',False):
-            plt.imsave("imgs/debug.png", np.clip(temp,0,1))
+            imsave("imgs/debug.png", np.clip(temp,0,1))
         else:
-            plt.imsave("imgs/debug.png", np.clip(temp/6+0.5,0,1))
+            imsave("imgs/debug.png", np.clip(temp/6+0.5,0,1))
         total_obs_loss += avg_obs_loss/n_loops
         total_state_loss += avg_state_loss/n_loops
         total_state_pred_loss += avg_state_pred_loss/n_loops
@@ -1382,7 +3313,7 @@ def fwd_preds(hyps, fwd_model, data, overshoot=False):
     B = batch size
     S = horizon length
 
-    data: dict
+    data: dict of device tensors
         obs_seq: torch FloatTensor (B,S,C,H,W)
             MDP states at each timestep t
         h_seq: FloatTensor (B,S,H)
@@ -1426,40 +3357,28 @@ def fwd_preds(hyps, fwd_model, data, overshoot=False):
     resets = (resets.bool()|starts.bool()).float()
     h = h_seq[:,0].data # (B,H)
     for i in range(obs_seq.shape[1]):
-        # Here we set the h vector to the stored h vector if the start
-        # value is 1. This is because starts denote a new segment of
-        # rollout but do not necessarily denote the start of a rollout.
-        # resets do, however, mark the start of a new rollout, so if
-        # reset is true, we want to get the gradient update for the
-        # h_init vector. Sadly, we will have stale h vectors for many
-        # rollouts, but this is the best we can do. Setting the max
-        # experience replay size can help cycle data through to avoid
-        # stale h vectors
-        if resets[:,i].sum() > 0:
-            new_hs = []
-            for j in range(len(resets)):
-                if resets[j,i] > 1:
-                    new_h = h_seq[j,i].data
-                else:
-                    new_h = h[j]
-                new_hs.append(new_h)
-            h = torch.stack(new_hs)
-        hs.append(h.cpu())
+        # The h vector is carried from the stored h of the first
+        # step. Sequences sampled from the experience replay never
+        # cross a segment boundary after their first step. See
+        # ExperienceReplay.update_valids. Validation rollouts pass
+        # whole rollouts that can cross episode resets, in which case
+        # the h is carried across the reset
+        hs.append(h)
         if overshoot:
-            h,mu,sigma,mu_pred,sigma_pred=fwd_model(obs_seq[:,i].cuda(),
-                                      h=h.cuda(),
-                                      color_idx=color_seq[:,i].cuda(),
-                                      shape_idx=shape_seq[:,i].cuda(),
-                                      count_idx=count_seq[:,i].cuda(),
+            h,mu,sigma,mu_pred,sigma_pred=fwd_model(obs_seq[:,i],
+                                      h=h,
+                                      color_idx=color_seq[:,i],
+                                      shape_idx=shape_seq[:,i],
+                                      count_idx=count_seq[:,i],
                                       prev_mu=mu_pred,
                                       prev_sigma=sigma_pred,
-                                      resets=resets[:,i].cuda())
+                                      resets=resets[:,i])
         else:
-            h,mu,sigma,mu_pred,sigma_pred=fwd_model(obs_seq[:,i].cuda(),
-                                      h=h.cuda(),
-                                      color_idx=color_seq[:,i].cuda(),
-                                      shape_idx=shape_seq[:,i].cuda(),
-                                      count_idx=count_seq[:,i].cuda())
+            h,mu,sigma,mu_pred,sigma_pred=fwd_model(obs_seq[:,i],
+                                      h=h,
+                                      color_idx=color_seq[:,i],
+                                      shape_idx=shape_seq[:,i],
+                                      count_idx=count_seq[:,i])
         mu_preds.append(mu_pred)
         sigma_preds.append(sigma_pred)
         if not overshoot:
@@ -1468,7 +3387,7 @@ def fwd_preds(hyps, fwd_model, data, overshoot=False):
     mu_preds = torch.stack(mu_preds,dim=1)
     sigma_preds = torch.stack(sigma_preds,dim=1)
     if not overshoot:
-        hs.append(h.cpu())
+        hs.append(h)
         hs = torch.stack(hs,dim=1)
         mus = torch.stack(mus,dim=1)
         sigmas = torch.stack(sigmas,dim=1)
@@ -1479,7 +3398,7 @@ def fwd_preds(hyps, fwd_model, data, overshoot=False):
         sigma_flat = sigmas.reshape(-1,mus.shape[-1])
         s = models.sample_s(mu_flat,sigma_flat)
         h_flat = hs[:,1:].reshape(-1,hs.shape[-1])
-        obs_preds = fwd_model.decode(s,h_flat.cuda())
+        obs_preds = fwd_model.decode(s,h_flat)
         obs_preds = obs_preds.reshape(B,S,*obs_preds.shape[1:])
         hs = hs[:,:-1]
     return obs_preds, hs, mus, sigmas, mu_preds, sigma_preds
@@ -1506,8 +3425,8 @@ def calc_fwd_loss(obs_preds, mu_truths, sigma_truths, mu_preds,
         "reset_seq":    torch long tensor  (B,S)
     """
     torch.cuda.empty_cache()
-    obs_targs = data['obs_seq'].cuda()
-    obs_loss = F.mse_loss(obs_preds.cuda(), obs_targs)
+    obs_targs = data['obs_seq']
+    obs_loss = F.mse_loss(obs_preds, obs_targs)
 
     normal = Normal(torch.zeros_like(mu_truths),
                     torch.ones_like(sigma_truths))
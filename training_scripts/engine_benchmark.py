@@ -0,0 +1,131 @@
+import sys
+import time
+import json
+import torch
+import numpy as np
+from locgame.environments import UnityGymEnv, ENGINE_PROFILES
+
+"""
+Measures the env steps per second of each unity engine profile for a
+build and checks that each profile shows the model the same
+observations as the first profile. Every profile is run from the same
+seed with the same sequence of random actions so that any difference
+in the observations comes from the engine settings.
+
+$ python3 engine_benchmark.py <env_name> [n_steps] [profiles] [save_path]
+
+env_name: the path to the unity build
+n_steps: the number of timed steps for each profile. defaults to 1000
+profiles: comma separated profile names. the first is the reference.
+    defaults to all of ENGINE_PROFILES
+save_path: a json file to save the results to
+"""
+
+# The number of initial steps whose observations are compared
+N_COMPARE = 200
+# Frames whose pixels differ by no more than this are counted as equal
+TOLERANCE = 1/255
+
+def run_profile(env_name, engine_profile, n_steps=1000, seed=0):
+    """
+    Steps a fresh environment with the argued engine profile
+
+    env_name: str
+    engine_profile: str
+    n_steps: int
+    seed: int
+        the seed of the environment and of the actions
+
+    Returns:
+        results: dict
+            steps_per_sec: float
+            frames: ndarray (N_COMPARE+1,H,W,C)
+            rews: ndarray (N_COMPARE,)
+            dones: ndarray (N_COMPARE,)
+    """
+    env = UnityGymEnv(env_name, "null_prep", seed=seed,
+                                             engine_profile=engine_profile)
+    rng = np.random.RandomState(seed)
+    actions = rng.uniform(-1,1,size=(n_steps,2)).astype(np.float32)
+    actions = torch.from_numpy(actions)
+    frame,_ = env.split_obs(env.reset_raw())
+    frames = [np.array(frame)]
+    rews,dones = [],[]
+    start = time.time()
+    for i in range(n_steps):
+        obs,rew,done,_ = env.step_raw(actions[i])
+        if i < N_COMPARE:
+            frames.append(np.array(env.split_obs(obs)[0]))
+            rews.append(rew)
+            dones.append(done)
+        if done: env.reset_raw()
+    elapsed = time.time()-start
+    env.close()
+    return {
+        "steps_per_sec": n_steps/elapsed,
+        "frames": np.stack(frames),
+        "rews": np.asarray(rews, dtype=np.float32),
+        "dones": np.asarray(dones, dtype=bool),
+    }
+
+def compare(ref, results):
+    """
+    Compares the observations of a profile to those of the reference
+
+    ref: dict
+        the results of run_profile for the reference profile
+    results: dict
+        the results of run_profile for the compared profile
+
+    Returns:
+        stats: dict
+    """
+    n = min(len(ref['frames']), len(results['frames']))
+    diffs = np.abs(ref['frames'][:n].astype(np.float32)-\
+                   results['frames'][:n].astype(np.float32))
+    if ref['frames'].dtype == np.uint8: diffs = diffs/255
+    max_diffs = diffs.reshape(n,-1).max(-1)
+    unequal = np.nonzero(max_diffs > TOLERANCE)[0]
+    n = min(len(ref['dones']), len(results['dones']))
+    return {
+        "frac_equal_frames": float((max_diffs<=TOLERANCE).mean()),
+        "max_diff": float(max_diffs.max()),
+        "mean_diff": float(diffs.mean()),
+        "first_divergence": int(unequal[0]) if len(unequal)>0 else None,
+        "equal_rews": bool((ref['rews'][:n]==results['rews'][:n]).all()),
+        "equal_dones": bool((ref['dones'][:n]==results['dones'][:n]).all()),
+    }
+
+if __name__=="__main__":
+    env_name = sys.argv[1]
+    n_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    profiles = list(ENGINE_PROFILES.keys())
+    if len(sys.argv) > 3: profiles = sys.argv[3].split(",")
+    save_path = sys.argv[4] if len(sys.argv) > 4 else None
+    for profile in profiles:
+        assert profile in ENGINE_PROFILES, "unknown profile "+profile
+
+    stats = dict()
+    ref = None
+    for profile in profiles:
+        print("Running", profile, ENGINE_PROFILES[profile])
+        results = run_profile(env_name, profile, n_steps=n_steps)
+        if ref is None: ref = results
+        stats[profile] = {"steps_per_sec": results['steps_per_sec'],
+                          "speedup": results['steps_per_sec']/\
+                                     ref['steps_per_sec'],
+                          **compare(ref, results)}
+        st = stats[profile]
+        s = "{}: {:.1f} steps/s ({:.2f}x) | equal frames {:.1f}% | "
+        s += "max diff {:.4f} | first divergence {} | "
+        s += "equal rews {} | equal dones {}"
+        print(s.format(profile, st['steps_per_sec'], st['speedup'],
+                       100*st['frac_equal_frames'], st['max_diff'],
+                       st['first_divergence'], st['equal_rews'],
+                       st['equal_dones']))
+    if save_path is not None:
+        with open(save_path, 'w') as f:
+            json.dump({"env_name": env_name, "n_steps": n_steps,
+                       "reference": profiles[0],
+                       "profiles": {k:ENGINE_PROFILES[k] for k in profiles},
+                       "stats": stats}, f)
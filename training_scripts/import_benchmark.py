@@ -0,0 +1,97 @@
+import sys
+import time
+import json
+import subprocess
+import numpy as np
+import torch.multiprocessing as mp
+
+"""
+Measures the cold start costs of locgame. Each module import is timed
+in a fresh interpreter and the runner spawn is timed from the start of
+a forkserver process to the moment the child has imported
+locgame.training, which is what unpickling a Runner requires. Also
+reports which of the backend packages each import pulled in.
+
+$ python3 import_benchmark.py [n_trials] [save_path]
+"""
+
+MODULES = ["locgame.save_io", "locgame.training"]
+BACKENDS = ["mlagents_envs", "gym_unity", "gym", "skimage",
+            "matplotlib", "a2c"]
+
+def time_import(module, n_trials=5):
+    """
+    Times the import of the module in n_trials fresh interpreters.
+
+    module: str
+    n_trials: int
+
+    Returns:
+        times: list of floats
+            the import time of each trial in seconds
+        backends: list of str
+            the backend packages that were imported along with the
+            module
+    """
+    code = "import sys,time; t=time.perf_counter(); import {}; "
+    code += "print(time.perf_counter()-t); "
+    code += "print(','.join(m for m in {} if m in sys.modules))"
+    code = code.format(module, BACKENDS)
+    times = []
+    for trial in range(n_trials):
+        out = subprocess.run([sys.executable, "-c", code],
+                             capture_output=True, text=True, check=True)
+        # The final two lines are the time and the backends
+        lines = out.stdout.split("\n")
+        times.append(float(lines[-3]))
+        backends = [x for x in lines[-2].split(",") if x != ""]
+    return times, backends
+
+def runner_ready(queue):
+    import locgame.training
+    queue.put(time.time())
+
+def time_spawn(n_trials=5, method="forkserver"):
+    """
+    Times the start of a runner process from Process.start() until the
+    child has imported locgame.training. The first trial includes the
+    start of the forkserver.
+
+    n_trials: int
+    method: str
+        the multiprocessing start method
+
+    Returns:
+        times: list of floats
+    """
+    ctx = mp.get_context(method)
+    times = []
+    for trial in range(n_trials):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=runner_ready, args=(queue,))
+        start = time.time()
+        proc.start()
+        times.append(queue.get()-start)
+        proc.join()
+    return times
+
+if __name__=="__main__":
+    n_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    save_path = sys.argv[2] if len(sys.argv) > 2 else None
+    results = dict()
+    for module in MODULES:
+        times,backends = time_import(module, n_trials)
+        results[module] = {"median":float(np.median(times)),
+                           "times":times,
+                           "backends":backends}
+        s = "{}: median {:.3f}s | min {:.3f}s | backends: {}"
+        print(s.format(module, np.median(times), np.min(times),
+                                              ", ".join(backends)))
+    times = time_spawn(n_trials)
+    results['runner_spawn'] = {"median":float(np.median(times)),
+                               "times":times}
+    s = "runner spawn: median {:.3f}s | first {:.3f}s"
+    print(s.format(np.median(times), times[0]))
+    if save_path is not None:
+        with open(save_path, 'w') as f:
+            json.dump(results, f)
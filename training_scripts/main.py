@@ -1,5 +1,5 @@
 import torch
-import locgame
+import locgame.training
 import ml_utils
 import torch.multiprocessing as mp
 
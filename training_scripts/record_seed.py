@@ -53,6 +53,9 @@ print("Float Params")
 print("\n".join([k + ": " + str(v) for k,v in hyps['float_params'].items()]))
 
 print("Making Env")
+# The model is fed the env's observations directly
+hyps['uint8_obs'] = False
+hyps['env_pool'] = None
 env = environments.UnityGymEnv(**hyps)
 
 print("Making model")
@@ -0,0 +1,33 @@
+import sys
+from locgame.env_pool import EnvPool
+
+"""
+Starts a machine-wide pool of warm unity environments. Training and
+validation processes lease environments from the pool when their
+hyperparameters contain the pool's address under "env_pool".
+
+$ python3 run_env_pool.py <address> <env_name> <n_instances> [max_instances] [engine_profile]
+
+address: "host:port", ":port" for the loopback interface, or a unix
+    socket path. connections are authenticated with LOCGAME_POOL_KEY or
+    with the key that the pool saves to ~/.locgame/pool_key
+env_name: the path to the unity build to pre-launch
+n_instances: the number of instances to boot before serving
+max_instances: the maximum number of instances. defaults to no maximum
+engine_profile: the engine settings used by leases that do not argue
+    their own. defaults to "default"
+"""
+
+if __name__=="__main__":
+    address = sys.argv[1]
+    env_name = sys.argv[2]
+    n_instances = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    max_instances = None
+    if len(sys.argv) > 4 and sys.argv[4].lower() != "none":
+        max_instances = int(sys.argv[4])
+    engine_profile = sys.argv[5] if len(sys.argv) > 5 else "default"
+    pool = EnvPool(address, max_instances=max_instances,
+                            engine_profile=engine_profile)
+    print("Launching", n_instances, "instances of", env_name)
+    pool.prelaunch(env_name, n_instances)
+    pool.serve()
@@ -19,6 +19,7 @@ $ python3 watch_model.py <path_to_folder>
 """
 env_name = None
 seed = None
+env_pool = None # If not None, the address of an env pool to lease from
 
 if __name__=="__main__":
     torch.cuda.set_device(0)
@@ -60,6 +61,7 @@ if __name__=="__main__":
                 hyps['env_name'] = env_name
             if seed is not None:
                 hyps['seed'] = seed
+            hyps['env_pool'] = env_pool
             
             print("Making Env")
             table['seed'] = [hyps['seed']]
@@ -70,10 +72,7 @@ if __name__=="__main__":
             model.cuda()
             model.load_state_dict(checkpt["state_dict"])
             model.eval()
-            val_runner = Runner(rank=0,hyps=hyps, shared_data=None,
-                                                  gate_q=None,
-                                                  stop_q=None,
-                                                  end_q=None)
+            val_runner = Runner(rank=0,hyps=hyps, shared_data=None)
             val_runner.env = env
             val_runner.model = model
             rew_alpha = checkpt['hyps']['rew_alpha']
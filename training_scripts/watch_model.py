@@ -32,6 +32,9 @@ if env_name is not None:
 
 print("Making Env")
 hyps['seed'] = int(time.time())
+# The model is fed the env's observations directly
+hyps['uint8_obs'] = False
+hyps['env_pool'] = None
 env = environments.UnityGymEnv(**hyps)
 
 print("Making model")